@@ -1,6 +1,7 @@
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate
 from flask_cors import CORS
 from dotenv import load_dotenv
 import logging
@@ -14,6 +15,7 @@ load_dotenv()
 
 # Initialize database
 db = SQLAlchemy()
+migrate = Migrate()
 
 def create_app(test_config=None):
     # Create and configure the app
@@ -23,8 +25,8 @@ def create_app(test_config=None):
     CORS(app, resources={
         r"/*": {
             "origins": "*",
-            "methods": ["GET", "POST", "OPTIONS"],
-            "allow_headers": ["Content-Type", "Authorization"]
+            "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+            "allow_headers": ["Content-Type", "Content-Range", "Authorization", "X-Profile", "X-Device-Id"]
         }
     })
     
@@ -45,26 +47,98 @@ def create_app(test_config=None):
     else:
         # Load the test config if passed in
         app.config.from_mapping(test_config)
-
+    
+    # Pool sized for the server's worker model, with pre-ping and statement timeouts
+    from .pool import engine_options
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    
+    # Tunables that apply to both regular and test configs
+    app.config.setdefault('SCAN_BATCH_LIMIT', int(os.environ.get('SCAN_BATCH_LIMIT', 5000)))
+    app.config.setdefault('UPLOAD_BATCH_LIMIT', int(os.environ.get('UPLOAD_BATCH_LIMIT', 200)))
+    app.config.setdefault('DISK_USAGE_TTL', float(os.environ.get('DISK_USAGE_TTL', 5)))
+    app.config.setdefault('THUMBNAIL_FOLDER', os.environ.get('THUMBNAIL_FOLDER'))
+    app.config.setdefault('THUMBNAIL_CACHE_MAX_BYTES', int(os.environ.get('THUMBNAIL_CACHE_MAX_MB', 2048)) * 1024 * 1024)
+    app.config.setdefault('THUMBNAIL_PREGENERATE', os.environ.get('THUMBNAIL_PREGENERATE', '1') == '1')
+    app.config.setdefault('JOB_CONCURRENCY', os.environ.get('JOB_CONCURRENCY', 'thumbnails=1,scrub=1,prune=1,rebalance=1,upload_expiry=1'))
+    app.config.setdefault('JOB_MAX_ATTEMPTS', int(os.environ.get('JOB_MAX_ATTEMPTS', 5)))
+    app.config.setdefault('JOB_RETRY_DELAY', float(os.environ.get('JOB_RETRY_DELAY', 10)))
+    app.config.setdefault('JOB_LOCK_TIMEOUT', float(os.environ.get('JOB_LOCK_TIMEOUT', 600)))
+    app.config.setdefault('JOB_POLL_INTERVAL', float(os.environ.get('JOB_POLL_INTERVAL', 1)))
+    app.config.setdefault('PROFILE_REQUESTS', os.environ.get('PROFILE_REQUESTS', '0') == '1')
+    app.config.setdefault('PROFILE_HEADER_ENABLED', os.environ.get('PROFILE_HEADER_ENABLED', '1') == '1')
+    app.config.setdefault('PROFILE_SLOW_MS', float(os.environ.get('PROFILE_SLOW_MS', 1000)))
+    app.config.setdefault('PROFILE_FOLDER', os.environ.get('PROFILE_FOLDER'))
+    app.config.setdefault('PROFILE_KEEP', int(os.environ.get('PROFILE_KEEP', 50)))
+    app.config.setdefault('SCRUB_MAX_MBPS', float(os.environ.get('SCRUB_MAX_MBPS', 10)))
+    app.config.setdefault('SCRUB_BATCH_SIZE', int(os.environ.get('SCRUB_BATCH_SIZE', 500)))
+    app.config.setdefault('SCRUB_BATCH_SECONDS', float(os.environ.get('SCRUB_BATCH_SECONDS', 60)))
+    app.config.setdefault('SCRUB_INTERVAL_DAYS', float(os.environ.get('SCRUB_INTERVAL_DAYS', 30)))
+    app.config.setdefault('PRUNE_MAX_AGE_DAYS', float(os.environ.get('PRUNE_MAX_AGE_DAYS', 0)))
+    app.config.setdefault('PRUNE_DEVICES', os.environ.get('PRUNE_DEVICES', ''))
+    app.config.setdefault('PRUNE_FILE_TYPES', os.environ.get('PRUNE_FILE_TYPES', ''))
+    app.config.setdefault('PRUNE_MIN_FREE_PERCENT', float(os.environ.get('PRUNE_MIN_FREE_PERCENT', 0)))
+    app.config.setdefault('PRUNE_TARGET_FREE_PERCENT', float(os.environ.get('PRUNE_TARGET_FREE_PERCENT', 15)))
+    app.config.setdefault('PRUNE_BATCH_SIZE', int(os.environ.get('PRUNE_BATCH_SIZE', 200)))
+    app.config.setdefault('UPLOAD_MAX_CONCURRENT', int(os.environ.get('UPLOAD_MAX_CONCURRENT', 4)))
+    app.config.setdefault('UPLOAD_MAX_PER_DEVICE', int(os.environ.get('UPLOAD_MAX_PER_DEVICE', 2)))
+    app.config.setdefault('UPLOAD_QUEUE_SIZE', int(os.environ.get('UPLOAD_QUEUE_SIZE', 2)))
+    app.config.setdefault('UPLOAD_QUEUE_TIMEOUT', float(os.environ.get('UPLOAD_QUEUE_TIMEOUT', 5)))
+    app.config.setdefault('UPLOAD_MAX_MBPS', float(os.environ.get('UPLOAD_MAX_MBPS', 0)))
+    app.config.setdefault('UPLOAD_SESSION_TTL_HOURS', float(os.environ.get('UPLOAD_SESSION_TTL_HOURS', 72)))
+    app.config.setdefault('STORAGE_VOLUMES', os.environ.get('STORAGE_VOLUMES', ''))
+    app.config.setdefault('STORAGE_PLACEMENT', os.environ.get('STORAGE_PLACEMENT', 'free_space'))
+    app.config.setdefault('STORAGE_RESERVE_MB', int(os.environ.get('STORAGE_RESERVE_MB', 1024)))
+    app.config.setdefault('STORAGE_REBALANCE_SPREAD_PERCENT', float(os.environ.get('STORAGE_REBALANCE_SPREAD_PERCENT', 10)))
+    app.config.setdefault('STORAGE_REBALANCE_BATCH_SIZE', int(os.environ.get('STORAGE_REBALANCE_BATCH_SIZE', 100)))
+    app.config.setdefault('STORAGE_REBALANCE_BATCH_SECONDS', float(os.environ.get('STORAGE_REBALANCE_BATCH_SECONDS', 60)))
+    app.config.setdefault('COMPRESS_RESPONSES', os.environ.get('COMPRESS_RESPONSES', '1') == '1')
+    app.config.setdefault('COMPRESS_MIN_BYTES', int(os.environ.get('COMPRESS_MIN_BYTES', 1024)))
+    
     # Ensure the instance folder exists
     try:
         os.makedirs(app.instance_path)
     except OSError:
         pass
     
-    # Initialize app with database
+    # Initialize app with database, the schema is managed with `flask db upgrade`
     db.init_app(app)
+    migrate.init_app(app, db, directory=os.path.join(os.path.dirname(app.root_path), 'migrations'))
     
     # Register blueprints
-    from .routes import main_bp, photos_bp, storage_bp, backup_bp
+    from .routes import main_bp, photos_bp, storage_bp, backup_bp, jobs_bp, admin_bp
     app.register_blueprint(main_bp)
     app.register_blueprint(photos_bp)
     app.register_blueprint(storage_bp)
     app.register_blueprint(backup_bp)
+    app.register_blueprint(jobs_bp)
+    app.register_blueprint(admin_bp)
+    
+    # Request latency, database and upload metrics served at /metrics
+    from . import metrics
+    metrics.init_app(app)
+    
+    # Per-device and overall limits on uploads in progress, 429 with Retry-After when full
+    from . import admission
+    admission.init_app(app)
+    
+    # gzip or brotli for large JSON and MessagePack responses
+    from . import encoding
+    encoding.init_app(app)
+    
+    # Opt-in cProfile capture of slow requests, listed at /admin/profiles
+    from .profiling import SlowRequestProfiler
+    app.wsgi_app = SlowRequestProfiler(app.wsgi_app, app)
     
-    # Create tables in the database
-    with app.app_context():
-        db.create_all()
-        logger.info("Database tables created successfully")
+    # Register CLI commands
+    from .stats import rebuild_stats_command
+    from .scrub import scrub_command
+    from .prune import prune_command
+    from .storage import rebalance_command
+    from .uploads import expire_uploads_command
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(scrub_command)
+    app.cli.add_command(prune_command)
+    app.cli.add_command(rebalance_command)
+    app.cli.add_command(expire_uploads_command)
     
     return app 
\ No newline at end of file
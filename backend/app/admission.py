@@ -0,0 +1,276 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+from flask import current_app, g, jsonify, request
+from .metrics import UPLOAD_ENDPOINTS, UPLOAD_QUEUE_WAIT, UPLOAD_REJECTIONS, UPLOADS_QUEUED
+from .models import UploadSession
+from . import db
+
+# Bounds of the Retry-After hint given to a rejected upload, in seconds
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+
+# Upload plans size a chunk to take about this long at the measured upload speed
+PLAN_REQUEST_SECONDS = 10
+MIN_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Typical size of an iPhone photo, for the files per batch request
+TYPICAL_PHOTO_BYTES = 3 * 1024 * 1024
+# Parallel uploads offered to a lone device when UPLOAD_MAX_CONCURRENT is off
+DEFAULT_PLAN_CONCURRENCY = 4
+
+class UploadRejected(Exception):
+    """Raised when an upload can't be admitted, with the seconds to wait before retrying"""
+
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+class Ticket:
+    """One upload waiting for a slot"""
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.admitted = False
+
+class UploadAdmission:
+    """Admits uploads under a global and a per-device limit, queued fairly across devices.
+    
+    Limits apply to one server process. Waiting uploads hold a server thread,
+    so the queue is kept short and each device may only have one upload in it.
+    When a slot frees, the waiting device with the fewest uploads in progress
+    goes first, ties go to the device that waited longest.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = {}
+        self.total_active = 0
+        # device_id -> Ticket, in the order the devices started waiting
+        self.waiting = OrderedDict()
+        # Moving average of how long an upload holds its slot, for Retry-After
+        self.average_hold = 1.0
+
+    def has_room(self, device_id, config):
+        max_total = config['UPLOAD_MAX_CONCURRENT']
+        max_per_device = config['UPLOAD_MAX_PER_DEVICE']
+        if max_total and self.total_active >= max_total:
+            return False
+        return not max_per_device or self.active.get(device_id, 0) < max_per_device
+
+    def admit(self, device_id):
+        self.active[device_id] = self.active.get(device_id, 0) + 1
+        self.total_active += 1
+
+    def dispatch(self, config):
+        """Hands free slots to waiting devices, fewest uploads in progress first"""
+        while self.waiting:
+            ready = [device_id for device_id in self.waiting if self.has_room(device_id, config)]
+            if not ready:
+                return
+            device_id = min(ready, key=lambda device_id: self.active.get(device_id, 0))
+            ticket = self.waiting.pop(device_id)
+            ticket.admitted = True
+            self.admit(device_id)
+            self.condition.notify_all()
+
+    def retry_after(self, config):
+        """Returns about how long until a slot frees for a rejected upload"""
+        slots = config['UPLOAD_MAX_CONCURRENT'] or max(self.total_active, 1)
+        estimate = self.average_hold * (len(self.waiting) + 1) / slots
+        return min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, math.ceil(estimate)))
+
+    def acquire(self, device_id):
+        """Waits for an upload slot for the device, raises UploadRejected when there is none"""
+        config = current_app.config
+        started = time.monotonic()
+        with self.condition:
+            if not self.waiting and self.has_room(device_id, config):
+                self.admit(device_id)
+                return
+            
+            if device_id in self.waiting:
+                raise UploadRejected(
+                    'This device already has an upload waiting', self.retry_after(config), 'device_queued'
+                )
+            if len(self.waiting) >= config['UPLOAD_QUEUE_SIZE']:
+                raise UploadRejected('The server is busy with other uploads', self.retry_after(config), 'queue_full')
+            
+            ticket = Ticket(device_id)
+            self.waiting[device_id] = ticket
+            # A device at its own limit must not hold up the others
+            self.dispatch(config)
+            UPLOADS_QUEUED.inc()
+            try:
+                deadline = started + config['UPLOAD_QUEUE_TIMEOUT']
+                while not ticket.admitted:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        del self.waiting[device_id]
+                        raise UploadRejected(
+                            'Timed out waiting for an upload slot', self.retry_after(config), 'timeout'
+                        )
+                    self.condition.wait(remaining)
+            finally:
+                UPLOADS_QUEUED.dec()
+
+    def plan(self, device_id):
+        """Returns the parallel uploads, chunk size and batch size a device should use now"""
+        config = current_app.config
+        with self.condition:
+            others = (set(self.active) | set(self.waiting)) - {device_id}
+            in_progress = self.total_active
+            waiting = len(self.waiting)
+            retry_after = self.retry_after(config) if waiting else None
+        
+        # An even share of the slots, but never more than the device may use
+        slots = config['UPLOAD_MAX_CONCURRENT'] or DEFAULT_PLAN_CONCURRENCY
+        concurrency = max(1, slots // (len(others) + 1))
+        if config['UPLOAD_MAX_PER_DEVICE']:
+            concurrency = min(concurrency, config['UPLOAD_MAX_PER_DEVICE'])
+        
+        receive_rate, write_rate = upload_speed.snapshot()
+        if receive_rate and write_rate:
+            # Past what the drive can absorb, parallel uploads only queue on it
+            concurrency = min(concurrency, max(1, int(write_rate // receive_rate)))
+        if waiting:
+            concurrency = 1
+        
+        rate = receive_rate
+        if rate and config['UPLOAD_MAX_MBPS']:
+            rate = min(rate, config['UPLOAD_MAX_MBPS'] * 1024 * 1024 / concurrency)
+        chunk_size = DEFAULT_CHUNK_SIZE
+        if rate:
+            chunk_size = int(rate * PLAN_REQUEST_SECONDS) // MIN_CHUNK_SIZE * MIN_CHUNK_SIZE
+            chunk_size = min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, chunk_size))
+        
+        return {
+            'concurrency': concurrency,
+            'chunk_size': chunk_size,
+            # Photos per /photos/upload/batch request, about a chunk's worth
+            'batch_size': min(config['UPLOAD_BATCH_LIMIT'], max(1, chunk_size // TYPICAL_PHOTO_BYTES)),
+            'retry_after': retry_after,
+            'uploads_in_progress': in_progress,
+            'uploads_waiting': waiting,
+            'receive_bytes_per_second': int(receive_rate) if receive_rate else None,
+            'disk_write_bytes_per_second': int(write_rate) if write_rate else None
+        }
+
+    def release(self, device_id, held_seconds):
+        """Frees a device's upload slot and hands it to the next waiting device"""
+        with self.condition:
+            self.active[device_id] -= 1
+            if not self.active[device_id]:
+                del self.active[device_id]
+            self.total_active -= 1
+            self.average_hold = 0.8 * self.average_hold + 0.2 * held_seconds
+            self.dispatch(current_app.config)
+
+class UploadSpeed:
+    """Moving averages of how fast one upload body arrives and is written to the drive"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.receive_rate = None
+        self.write_rate = None
+
+    def observe(self, size, read_seconds, write_seconds):
+        # Small bodies measure the round trip more than the bandwidth
+        if size < MIN_CHUNK_SIZE or read_seconds <= 0 or write_seconds <= 0:
+            return
+        with self._lock:
+            for name, rate in (('receive_rate', size / read_seconds), ('write_rate', size / write_seconds)):
+                average = getattr(self, name)
+                setattr(self, name, rate if average is None else 0.8 * average + 0.2 * rate)
+
+    def snapshot(self):
+        with self._lock:
+            return self.receive_rate, self.write_rate
+
+# Speeds are per process, like the admission limits
+upload_speed = UploadSpeed()
+
+class TokenBucket:
+    """Spreads UPLOAD_MAX_MBPS over the uploads of one process, bursts up to one second's worth"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    def consume(self, size, rate):
+        """Takes size bytes from the bucket, returns how long to sleep to stay under rate"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= size
+            return -self.tokens / rate if self.tokens < 0 else 0.0
+
+def throttle(size):
+    """Sleeps as needed so upload bodies are received no faster than UPLOAD_MAX_MBPS"""
+    rate = current_app.config['UPLOAD_MAX_MBPS'] * 1024 * 1024
+    if not rate:
+        return
+    delay = current_app.extensions['upload_bandwidth'].consume(size, rate)
+    if delay > 0:
+        time.sleep(delay)
+
+def upload_device():
+    """Returns who an upload counts against, read without touching the request body.
+    
+    The X-Device-Id header or the device_id query parameter, the device of a
+    chunked upload session, and otherwise the client's address.
+    """
+    device_id = request.headers.get('X-Device-Id') or request.args.get('device_id')
+    if device_id:
+        return device_id
+    session_id = (request.view_args or {}).get('session_id')
+    if session_id:
+        session = db.session.get(UploadSession, session_id)
+        # Don't hold a pooled connection while waiting for a slot
+        db.session.rollback()
+        if session is not None:
+            return session.device_id
+    return request.remote_addr or 'unknown'
+
+def before_request():
+    if request.endpoint not in UPLOAD_ENDPOINTS:
+        return None
+    device_id = upload_device()
+    started = time.monotonic()
+    try:
+        current_app.extensions['upload_admission'].acquire(device_id)
+    except UploadRejected as e:
+        UPLOAD_QUEUE_WAIT.observe(time.monotonic() - started)
+        UPLOAD_REJECTIONS.labels(e.reason).inc()
+        response = jsonify({
+            'status': 'error',
+            'message': str(e),
+            'retry_after': e.retry_after
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    
+    g.admission_device = device_id
+    g.admission_started = time.monotonic()
+    UPLOAD_QUEUE_WAIT.observe(g.admission_started - started)
+    return None
+
+def teardown_request(exception):
+    # Runs even when the view raised, so the slot is always given back
+    if 'admission_device' not in g:
+        return
+    held = time.monotonic() - g.pop('admission_started')
+    current_app.extensions['upload_admission'].release(g.pop('admission_device'), held)
+
+def init_app(app):
+    """Registers the hooks that admit uploads and the per-process limiters they share"""
+    app.extensions['upload_admission'] = UploadAdmission()
+    app.extensions['upload_bandwidth'] = TokenBucket()
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
@@ -0,0 +1,156 @@
+import os
+import re
+import io
+import logging
+import datetime
+import tarfile
+import zipfile
+from .models import Backup
+from .storage import stored_path
+from .uploads import STREAM_BUFFER_SIZE
+from . import db
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {
+    'tar': 'application/x-tar',
+    'zip': 'application/zip',
+}
+
+# Backups read from the database at a time, the connection is released while their files are sent
+ARCHIVE_BATCH_SIZE = 500
+
+# Prefix of the tar and zip entry comments holding the resume cursor
+CURSOR_KEY = 'ICLOOD.cursor'
+
+class StreamBuffer(io.RawIOBase):
+    """Collects what zipfile writes until it is handed to the server"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        """Yields what was written since the last drain, if anything"""
+        if self.chunks:
+            data = b''.join(self.chunks)
+            self.chunks.clear()
+            yield data
+
+def entry_name(backup):
+    """Returns the archive path of a backup, its device followed by its path on the device"""
+    path = re.sub(r'^[a-z]+://', '', backup.original_path or backup.file_name)
+    parts = [part for part in path.split('/') if part not in ('', '.', '..')]
+    device = (backup.device_id or 'unknown').replace('/', '_')
+    return '/'.join([device] + (parts or [backup.file_name]))
+
+def archive_backups(query, after):
+    """Yields the completed backups of a filtered query oldest first, starting after a (timestamp, id)"""
+    query = query.with_entities(
+        Backup.id, Backup.timestamp, Backup.file_name, Backup.volume, Backup.file_path,
+        Backup.original_path, Backup.device_id
+    ).filter(Backup.status == 'Completed').order_by(Backup.timestamp, Backup.id)
+    
+    while True:
+        batch = query
+        if after is not None:
+            batch = batch.filter(db.tuple_(Backup.timestamp, Backup.id) > db.tuple_(*after))
+        rows = batch.limit(ARCHIVE_BATCH_SIZE).all()
+        # Don't hold a pooled connection while the files are sent
+        db.session.commit()
+        yield from rows
+        if len(rows) < ARCHIVE_BATCH_SIZE:
+            return
+        after = (rows[-1].timestamp, rows[-1].id)
+
+def open_stored(backup):
+    """Opens a backup's stored file for a sequential read, None when it is gone"""
+    try:
+        path = stored_path(backup.volume, backup.file_path)
+        stored = open(path, 'rb')
+    except OSError as e:
+        logger.warning(f"Leaving backup {backup.id} out of the archive, can't open {backup.file_path}: {e}")
+        return None
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(stored.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return stored
+
+def read_blocks(stored, size):
+    """Yields exactly size bytes of a file, padded with zeros if it shrank since its size was taken"""
+    remaining = size
+    while remaining > 0:
+        block = stored.read(min(STREAM_BUFFER_SIZE, remaining))
+        if not block:
+            logger.warning(f'{stored.name} is shorter than expected, padding its archive entry')
+            block = bytes(min(STREAM_BUFFER_SIZE, remaining))
+        remaining -= len(block)
+        yield block
+    
+    # A restore reads the whole library once, keep it from evicting what uploads use
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(stored.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+def tar_stream(backups, cursor_for):
+    """Yields a pax tar of the backups, each entry's comment is its resume cursor"""
+    for backup in backups:
+        stored = open_stored(backup)
+        if stored is None:
+            continue
+        with stored:
+            info = tarfile.TarInfo(entry_name(backup))
+            info.size = os.fstat(stored.fileno()).st_size
+            info.mtime = int(backup.timestamp.replace(tzinfo=datetime.UTC).timestamp())
+            info.mode = 0o644
+            # The standard pax comment, tar ignores it when extracting
+            info.pax_headers = {'comment': f'{CURSOR_KEY}={cursor_for(backup)}'}
+            yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            yield from read_blocks(stored, info.size)
+            if info.size % tarfile.BLOCKSIZE:
+                yield bytes(tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    
+    # End of archive marker
+    yield bytes(2 * tarfile.BLOCKSIZE)
+
+def zip_stream(backups, cursor_for):
+    """Yields a zip of the backups stored without compression, each entry's comment is its resume cursor.
+    
+    Entries are written with data descriptors since the output can't be seeked.
+    The central directory at the end keeps a small record per entry in memory.
+    """
+    buffer = StreamBuffer()
+    archive = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED)
+    for backup in backups:
+        stored = open_stored(backup)
+        if stored is None:
+            continue
+        with stored:
+            # Zip dates start in 1980
+            date_time = max(backup.timestamp.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+            info = zipfile.ZipInfo(entry_name(backup), date_time=date_time)
+            info.file_size = os.fstat(stored.fileno()).st_size
+            info.comment = f'{CURSOR_KEY}={cursor_for(backup)}'.encode()
+            with archive.open(info, 'w') as entry:
+                for block in read_blocks(stored, info.file_size):
+                    entry.write(block)
+                    yield from buffer.drain()
+        yield from buffer.drain()
+    
+    archive.close()
+    yield from buffer.drain()
+
+def stream_archive(query, fmt, after, cursor_for):
+    """Yields a tar or zip of the completed backups a query selects, built as it is sent.
+    
+    after resumes the archive behind a (timestamp, id) position, cursor_for
+    encodes the position of a backup for the client to resume from.
+    """
+    backups = archive_backups(query, after)
+    if fmt == 'zip':
+        return zip_stream(backups, cursor_for)
+    return tar_stream(backups, cursor_for)
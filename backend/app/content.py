@@ -0,0 +1,130 @@
+import os
+import datetime
+import unicodedata
+from urllib.parse import quote
+from flask import current_app, request
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+from .storage import stored_path
+from .uploads import STREAM_BUFFER_SIZE
+
+class RangeFile:
+    """Iterates over length bytes of a file from its current position, then closes it"""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.length = length
+
+    def __iter__(self):
+        remaining = self.length
+        while remaining > 0:
+            block = self.file.read(min(STREAM_BUFFER_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+    def close(self):
+        self.file.close()
+
+def content_etag(backup):
+    """Returns the ETag of a backup's content, its checksum when it has one"""
+    if backup.content_hash:
+        return backup.content_hash
+    return f'{backup.id}-{backup.file_size}-{int(backup.timestamp.timestamp())}'
+
+def requested_range(etag, last_modified, size):
+    """Returns the (start, stop) byte range to send, None for the whole file.
+    
+    Raises ValueError when the range lies past the end of the file. A range
+    whose If-Range no longer matches, or a multi-range, gets the whole file.
+    """
+    if request.range is None or request.range.units != 'bytes' or len(request.range.ranges) != 1:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and last_modified > if_range.date:
+        return None
+    
+    byte_range = request.range.range_for_length(size)
+    if byte_range is None:
+        raise ValueError('Range not satisfiable')
+    return byte_range
+
+def file_body(file, length):
+    """Returns the response body for length bytes from the file's position.
+    
+    gunicorn serves its wsgi.file_wrapper with sendfile(), from the file's
+    position for Content-Length bytes, so the content never passes through
+    Python. Other servers may send the wrapped file to the end, they get a
+    plain iterator over the range instead.
+    """
+    environ = request.environ
+    if 'wsgi.file_wrapper' in environ and environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+        return wrap_file(environ, file, STREAM_BUFFER_SIZE)
+    return RangeFile(file, length)
+
+def send_stored_file(backup, as_attachment=False):
+    """Serves a backup's stored file with conditional GETs and single byte ranges.
+    
+    Raises FileNotFoundError when the file is gone from the drive, or its volume
+    is no longer configured.
+    """
+    file = open(stored_path(backup.volume, backup.file_path), 'rb')
+    try:
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        last_modified = datetime.datetime.fromtimestamp(int(stat.st_mtime), datetime.UTC)
+        etag = content_etag(backup)
+        
+        response = current_app.response_class(
+            mimetype=backup.mime_type or 'application/octet-stream', direct_passthrough=True
+        )
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.accept_ranges = 'bytes'
+        response.cache_control.no_cache = True
+        set_disposition(response, backup.file_name, as_attachment)
+        
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            file.close()
+            response.status_code = 304
+            return response
+        
+        try:
+            byte_range = requested_range(etag, last_modified, size)
+        except ValueError:
+            file.close()
+            response.status_code = 416
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        
+        start, stop = byte_range or (0, size)
+        if byte_range is not None:
+            response.status_code = 206
+            response.content_range = f'bytes {start}-{stop - 1}/{size}'
+        response.content_length = stop - start
+        
+        file.seek(start)
+        # Videos are read front to back, let the kernel read ahead further on the USB drive
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), start, stop - start, os.POSIX_FADV_SEQUENTIAL)
+        response.response = file_body(file, stop - start)
+        return response
+    except BaseException:
+        file.close()
+        raise
+
+def set_disposition(response, file_name, as_attachment):
+    """Sets Content-Disposition with the original file name, like send_file does"""
+    disposition = 'attachment' if as_attachment else 'inline'
+    try:
+        file_name.encode('ascii')
+        response.headers.set('Content-Disposition', disposition, filename=file_name)
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', file_name).encode('ascii', 'ignore').decode('ascii')
+        response.headers.set('Content-Disposition', disposition, **{
+            'filename': simple,
+            'filename*': f"UTF-8''{quote(file_name, safe='')}"
+        })
@@ -0,0 +1,137 @@
+import time
+import logging
+import datetime
+from flask import current_app
+from sqlalchemy import update
+from .models import Job
+from . import db
+
+logger = logging.getLogger(__name__)
+
+# Registered job handlers, keyed by job type
+JOB_HANDLERS = {}
+
+def job_handler(job_type):
+    """Registers a function as the handler for a job type, it receives the job payload"""
+    def register(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return register
+
+def utcnow():
+    """Returns the current time as naive UTC, matching the DateTime columns"""
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+def enqueue(job_type, payload, max_attempts=None):
+    """Adds a job to the session, so it is committed with the work that caused it"""
+    job = Job(
+        job_type=job_type,
+        payload=payload,
+        status='Pending',
+        attempts=0,
+        max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'],
+        run_after=utcnow()
+    )
+    db.session.add(job)
+    return job
+
+def claim_job(job_type):
+    """Marks the oldest runnable job of a type as Running and returns it, or None"""
+    query = db.session.query(Job.id).filter(
+        Job.job_type == job_type,
+        Job.status == 'Pending',
+        Job.run_after <= utcnow()
+    ).order_by(Job.run_after, Job.id).limit(1)
+    
+    # Postgres lets concurrent workers skip rows another worker is claiming
+    if db.engine.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+    
+    job_id = query.scalar()
+    if job_id is None:
+        db.session.rollback()
+        return None
+    
+    # The status check makes the claim safe on SQLite too, where there is no SKIP LOCKED
+    result = db.session.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.status == 'Pending')
+        .values(status='Running', locked_at=utcnow(), attempts=Job.attempts + 1)
+    )
+    db.session.commit()
+    if result.rowcount != 1:
+        return None
+    return db.session.get(Job, job_id)
+
+def run_job(job):
+    """Runs a claimed job, scheduling a retry with backoff if it fails"""
+    try:
+        handler = JOB_HANDLERS[job.job_type]
+        handler(job.payload)
+        job.status = 'Completed'
+        job.last_error = None
+        job.finished_at = utcnow()
+    except Exception as e:
+        db.session.rollback()
+        job.last_error = f'{type(e).__name__}: {e}'
+        if job.attempts < job.max_attempts:
+            job.status = 'Pending'
+            job.run_after = utcnow() + datetime.timedelta(
+                seconds=current_app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            )
+        else:
+            job.status = 'Failed'
+            job.finished_at = utcnow()
+        logger.warning(f"Job {job.id} ({job.job_type}) failed on attempt {job.attempts}: {e}")
+    db.session.commit()
+
+def release_stale_jobs():
+    """Puts jobs back in the queue whose worker died while running them"""
+    cutoff = utcnow() - datetime.timedelta(seconds=current_app.config['JOB_LOCK_TIMEOUT'])
+    result = db.session.execute(
+        update(Job)
+        .where(Job.status == 'Running', Job.locked_at < cutoff)
+        .values(status='Pending', run_after=utcnow())
+    )
+    db.session.commit()
+    return result.rowcount
+
+def work(job_type, stop_event):
+    """Processes jobs of one type until stop_event is set"""
+    poll_interval = current_app.config['JOB_POLL_INTERVAL']
+    last_release = 0
+    
+    while not stop_event.is_set():
+        if time.monotonic() - last_release > current_app.config['JOB_LOCK_TIMEOUT']:
+            release_stale_jobs()
+            last_release = time.monotonic()
+        
+        job = claim_job(job_type)
+        if job is None:
+            stop_event.wait(poll_interval)
+            continue
+        run_job(job)
+
+def queue_depth():
+    """Returns job counts by type and status, plus the age of the oldest pending job"""
+    counts = db.session.query(
+        Job.job_type, Job.status, db.func.count(Job.id)
+    ).filter(Job.status.in_(['Pending', 'Running', 'Failed'])).group_by(Job.job_type, Job.status).all()
+    
+    depth = {}
+    for job_type, status, count in counts:
+        depth.setdefault(job_type, {'Pending': 0, 'Running': 0, 'Failed': 0})[status] = count
+    
+    oldest = db.session.query(db.func.min(Job.run_after)).filter(
+        Job.status == 'Pending', Job.run_after <= utcnow()
+    ).scalar()
+    oldest_age = (utcnow() - oldest).total_seconds() if oldest else 0
+    return depth, oldest_age
+
+def parse_concurrency(value):
+    """Parses "thumbnails=2,verify=1" into {'thumbnails': 2, 'verify': 1}"""
+    limits = {}
+    for part in filter(None, (item.strip() for item in value.split(','))):
+        job_type, _, count = part.partition('=')
+        limits[job_type.strip()] = int(count or 1)
+    return limits
@@ -0,0 +1,123 @@
+import os
+import time
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Uploads of large videos take minutes, so the latency buckets go well past the usual 10s
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10)
+UPLOAD_QUEUE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Endpoints whose request body is a file being backed up
+UPLOAD_ENDPOINTS = {
+    'photos.upload_photo',
+    'photos.upload_photo_batch',
+    'photos.upload_photo_stream',
+    'photos.upload_chunk'
+}
+
+REQUEST_LATENCY = Histogram(
+    'iclood_request_duration_seconds', 'Time to build the response, by route',
+    ['method', 'endpoint'], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter('iclood_requests_total', 'Requests served, by route and status', ['method', 'endpoint', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('iclood_requests_in_flight', 'Requests being handled', multiprocess_mode='livesum')
+UPLOADS_IN_FLIGHT = Gauge('iclood_uploads_in_flight', 'Upload requests being received', multiprocess_mode='livesum')
+
+DB_QUERIES = Histogram(
+    'iclood_db_queries_per_request', 'SQL statements run by one request, by route',
+    ['endpoint'], buckets=QUERY_COUNT_BUCKETS
+)
+DB_SECONDS = Histogram(
+    'iclood_db_seconds_per_request', 'Time one request spent in SQL statements, by route',
+    ['endpoint'], buckets=LATENCY_BUCKETS
+)
+DB_POOL_WAIT = Histogram(
+    'iclood_db_pool_wait_seconds', 'Time spent waiting for a pooled connection', buckets=POOL_WAIT_BUCKETS
+)
+DB_POOL_TIMEOUTS = Counter('iclood_db_pool_timeouts_total', 'Checkouts that gave up waiting for a connection')
+
+# Where upload time goes: waiting on the network, writing to the drive, or hashing
+UPLOAD_BYTES = Counter('iclood_upload_bytes_total', 'File bytes received in upload bodies')
+UPLOAD_READ_SECONDS = Counter('iclood_upload_read_seconds_total', 'Time spent reading upload bodies')
+DISK_WRITE_BYTES = Counter('iclood_disk_write_bytes_total', 'Bytes written to the backup drive')
+DISK_WRITE_SECONDS = Counter('iclood_disk_write_seconds_total', 'Time spent in writes to the backup drive')
+HASH_SECONDS = Counter('iclood_hash_seconds_total', 'Time spent hashing uploaded content')
+
+# Upload admission: how long uploads wait for a slot, and those turned away with a 429
+UPLOAD_QUEUE_WAIT = Histogram(
+    'iclood_upload_queue_wait_seconds', 'Time an upload waited for a slot, admitted or not', buckets=UPLOAD_QUEUE_BUCKETS
+)
+UPLOADS_QUEUED = Gauge('iclood_uploads_queued', 'Uploads waiting for a slot', multiprocess_mode='livesum')
+UPLOAD_REJECTIONS = Counter('iclood_upload_rejections_total', 'Uploads answered with 429, by reason', ['reason'])
+
+def endpoint_label():
+    """Returns the route pattern of the request, so ids don't create new series"""
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+def record_upload_io(received, read_seconds, write_seconds, hash_seconds):
+    """Adds the totals of one copied upload body"""
+    UPLOAD_BYTES.inc(received)
+    UPLOAD_READ_SECONDS.inc(read_seconds)
+    DISK_WRITE_BYTES.inc(received)
+    DISK_WRITE_SECONDS.inc(write_seconds)
+    HASH_SECONDS.inc(hash_seconds)
+
+def before_request():
+    g.metrics_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+    REQUESTS_IN_FLIGHT.inc()
+    if request.endpoint in UPLOAD_ENDPOINTS:
+        g.metrics_upload = True
+        UPLOADS_IN_FLIGHT.inc()
+
+def after_request(response):
+    endpoint = endpoint_label()
+    REQUEST_LATENCY.labels(request.method, endpoint).observe(time.perf_counter() - g.metrics_started)
+    REQUESTS.labels(request.method, endpoint, str(response.status_code)).inc()
+    DB_QUERIES.labels(endpoint).observe(g.db_queries)
+    DB_SECONDS.labels(endpoint).observe(g.db_seconds)
+    return response
+
+def teardown_request(exception):
+    # Runs even when the view raised, so the gauges always come back down
+    if 'metrics_started' not in g:
+        return
+    REQUESTS_IN_FLIGHT.dec()
+    if g.pop('metrics_upload', False):
+        UPLOADS_IN_FLIGHT.dec()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context():
+        context.metrics_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'metrics_started', None)
+    if started is not None and 'db_queries' in g:
+        g.db_queries += 1
+        g.db_seconds += time.perf_counter() - started
+
+def init_app(app):
+    """Registers the request hooks that feed the metrics"""
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+
+def metrics_response():
+    """Returns every metric in the Prometheus text format, summed over gunicorn workers"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -1,18 +1,78 @@
+import uuid
 from datetime import datetime, UTC
+from sqlalchemy.dialects import postgresql, sqlite
 from . import db
 
+def insert_for(model):
+    """Returns an INSERT for the active database that supports ON CONFLICT clauses"""
+    if db.engine.dialect.name == 'sqlite':
+        return sqlite.insert(model)
+    return postgresql.insert(model)
+
+class Blob(db.Model):
+    """Model for stored file content, one row per distinct content hash"""
+    __tablename__ = 'blobs'
+    __table_args__ = (
+        # Rebalancing walks the blobs of one volume in hash order
+        db.Index('ix_blobs_volume_hash', 'volume', 'hash'),
+    )
+    
+    hash = db.Column(db.String(64), primary_key=True)  # SHA-256 hex digest
+    volume = db.Column(db.String, nullable=False, default='default', server_default='default')  # Storage volume holding the file
+    file_path = db.Column(db.String, nullable=False, index=True)  # Relative to the volume's folder
+    file_size = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    verified_at = db.Column(db.DateTime, nullable=True)  # Last time a scrub re-read the file and its hash matched
+    
+    def __repr__(self):
+        return f'<Blob {self.hash}>'
+    
+    def to_dict(self):
+        return {
+            'hash': self.hash,
+            'volume': self.volume,
+            'file_path': self.file_path,
+            'file_size': self.file_size,
+            'created_at': self.created_at.isoformat(),
+            'verified_at': self.verified_at.isoformat() if self.verified_at else None
+        }
+
 class Backup(db.Model):
     """Model for tracking backed up files"""
     __tablename__ = 'backups'
+    __table_args__ = (
+        # One row per file on each device, also backs the path lookups done by /photos/new and uploads
+        db.UniqueConstraint('device_id', 'original_path', name='uq_backups_device_id_original_path'),
+        # Keyset pagination over (timestamp, id), optionally narrowed by device
+        db.Index('ix_backups_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_backups_device_id_timestamp_id', 'device_id', 'timestamp', 'id'),
+        # Nearly every row is Completed, so history gets a partial index of its own and
+        # the few Pending and Failed rows a small one for the log's status filter
+        db.Index(
+            'ix_backups_completed_timestamp_id', 'timestamp', 'id',
+            postgresql_where=db.text("status = 'Completed'"), sqlite_where=db.text("status = 'Completed'")
+        ),
+        db.Index(
+            'ix_backups_incomplete_status_timestamp_id', 'status', 'timestamp', 'id',
+            postgresql_where=db.text("status <> 'Completed'"), sqlite_where=db.text("status <> 'Completed'")
+        ),
+        # Backups from before content addressing share files by path, pruning looks them up
+        db.Index(
+            'ix_backups_legacy_file_path', 'file_path',
+            postgresql_where=db.text('content_hash IS NULL'), sqlite_where=db.text('content_hash IS NULL')
+        ),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     file_name = db.Column(db.String, nullable=False)
-    file_path = db.Column(db.String, nullable=False)
+    volume = db.Column(db.String, nullable=False, default='default', server_default='default')  # Storage volume holding the file
+    file_path = db.Column(db.String, nullable=False)  # Relative to the volume's folder
     original_path = db.Column(db.String, nullable=True)  # Original path on the iPhone
     file_size = db.Column(db.Integer, nullable=False)  # Size in bytes
     file_type = db.Column(db.String, nullable=False)  # 'photo' or 'video'
     mime_type = db.Column(db.String, nullable=True)
     device_id = db.Column(db.String, nullable=True)  # For multiple devices tracking
+    content_hash = db.Column(db.String(64), db.ForeignKey('blobs.hash'), nullable=True, index=True)
     timestamp = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
     status = db.Column(db.String, nullable=False, default='Pending')  # 'Pending', 'Completed', 'Failed'
     
@@ -23,10 +83,12 @@ class Backup(db.Model):
         return {
             'id': self.id,
             'file_name': self.file_name,
+            'volume': self.volume,
             'file_path': self.file_path,
             'file_size': self.file_size,
             'file_type': self.file_type,
             'mime_type': self.mime_type,
+            'content_hash': self.content_hash,
             'timestamp': self.timestamp.isoformat(),
             'status': self.status
         }
@@ -34,6 +96,10 @@ class Backup(db.Model):
 class IgnoredFile(db.Model):
     """Model for tracking files that the user has chosen to ignore"""
     __tablename__ = 'ignored_files'
+    __table_args__ = (
+        # Lets bulk ignores use INSERT ... ON CONFLICT DO NOTHING
+        db.UniqueConstraint('device_id', 'original_path', name='uq_ignored_files_device_id_original_path'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     file_name = db.Column(db.String, nullable=False)
@@ -50,4 +116,177 @@ class IgnoredFile(db.Model):
             'file_name': self.file_name,
             'original_path': self.original_path,
             'timestamp': self.timestamp.isoformat()
-        } 
\ No newline at end of file
+        }
+
+class UploadSession(db.Model):
+    """Model for tracking resumable, chunked uploads until they are finalized"""
+    __tablename__ = 'upload_sessions'
+    
+    id = db.Column(db.String, primary_key=True, default=lambda: uuid.uuid4().hex)
+    file_name = db.Column(db.String, nullable=False)
+    original_path = db.Column(db.String, nullable=True)
+    file_type = db.Column(db.String, nullable=False)
+    mime_type = db.Column(db.String, nullable=True)
+    device_id = db.Column(db.String, nullable=True)
+    total_size = db.Column(db.BigInteger, nullable=False)  # Expected size in bytes
+    received_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    volume = db.Column(db.String, nullable=False, default='default', server_default='default')  # Volume the chunks are staged on
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.file_name}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'file_name': self.file_name,
+            'original_path': self.original_path,
+            'file_type': self.file_type,
+            'total_size': self.total_size,
+            'received_bytes': self.received_bytes,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat()
+        }
+
+class BackupStats(db.Model):
+    """Model for running totals of completed backups, one row per file type"""
+    __tablename__ = 'backup_stats'
+    
+    file_type = db.Column(db.String, primary_key=True)
+    file_count = db.Column(db.BigInteger, nullable=False, default=0)
+    total_size = db.Column(db.BigInteger, nullable=False, default=0)  # Size in bytes
+    last_backup = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<BackupStats {self.file_type}: {self.file_count}>'
+
+class Job(db.Model):
+    """Model for background post-processing work, claimed by the worker processes"""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # Workers poll for the oldest runnable job of their type
+        db.Index('ix_jobs_job_type_status_run_after', 'job_type', 'status', 'run_after'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String, nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String, nullable=False, default='Pending')  # 'Pending', 'Running', 'Completed', 'Failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(UTC).replace(tzinfo=None))
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String, nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<Job {self.id} {self.job_type} {self.status}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'payload': self.payload,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'last_error': self.last_error,
+            'created_at': self.created_at.isoformat()
+        }
+
+class ScrubRun(db.Model):
+    """Model for one integrity pass over the completed backups, resumed from its cursor"""
+    __tablename__ = 'scrub_runs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String, nullable=False, default='Pending')  # 'Pending', 'Running', 'Completed'
+    last_backup_id = db.Column(db.Integer, nullable=False, default=0)  # Backups are checked in id order
+    total_files = db.Column(db.Integer, nullable=False, default=0)  # Completed backups when the pass started
+    checked_files = db.Column(db.Integer, nullable=False, default=0)
+    checked_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    hashed_files = db.Column(db.Integer, nullable=False, default=0)  # Older backups given a checksum
+    missing_files = db.Column(db.Integer, nullable=False, default=0)
+    corrupt_files = db.Column(db.Integer, nullable=False, default=0)
+    scheduled_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<ScrubRun {self.id} {self.status}>'
+    
+    def to_dict(self):
+        # Backups made during the pass are checked too, so the count can pass the total
+        if self.total_files:
+            progress = min(1.0, self.checked_files / self.total_files)
+        else:
+            progress = 1.0 if self.status == 'Completed' else 0.0
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total_files': self.total_files,
+            'checked_files': self.checked_files,
+            'checked_bytes': self.checked_bytes,
+            'hashed_files': self.hashed_files,
+            'missing_files': self.missing_files,
+            'corrupt_files': self.corrupt_files,
+            'progress': round(progress, 4),
+            'scheduled_at': self.scheduled_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class ScrubFinding(db.Model):
+    """Model for a backup whose file a scrub found missing or corrupt"""
+    __tablename__ = 'scrub_findings'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('scrub_runs.id'), nullable=False, index=True)
+    backup_id = db.Column(db.Integer, nullable=False)  # Kept after the backup itself is deleted
+    file_path = db.Column(db.String, nullable=False)
+    problem = db.Column(db.String, nullable=False)  # 'missing' or 'corrupt'
+    expected_hash = db.Column(db.String(64), nullable=True)
+    actual_hash = db.Column(db.String(64), nullable=True)
+    found_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    
+    def __repr__(self):
+        return f'<ScrubFinding {self.backup_id} {self.problem}>'
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'run_id': self.run_id,
+            'backup_id': self.backup_id,
+            'file_path': self.file_path,
+            'problem': self.problem,
+            'expected_hash': self.expected_hash,
+            'actual_hash': self.actual_hash,
+            'found_at': self.found_at.isoformat()
+        }
+
+class DeviceSyncState(db.Model):
+    """Model for how far a device's library is known to be backed up, for delta scans"""
+    __tablename__ = 'device_sync_states'
+    
+    device_id = db.Column(db.String, primary_key=True)
+    # Every asset the device modified before this time (ms since the epoch) is backed up or ignored
+    synced_until = db.Column(db.BigInteger, nullable=False, default=0)
+    # The scan in progress: where it started, its oldest asset still needing backup and newest asset seen
+    scan_token = db.Column(db.String, nullable=True)
+    scan_since = db.Column(db.BigInteger, nullable=True)
+    scan_min_needed = db.Column(db.BigInteger, nullable=True)
+    scan_max_seen = db.Column(db.BigInteger, nullable=True)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(UTC))
+    
+    def __repr__(self):
+        return f'<DeviceSyncState {self.device_id} {self.synced_until}>'
+    
+    def to_dict(self):
+        return {
+            'device_id': self.device_id,
+            'synced_until': self.synced_until,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+import threading
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool, QueuePool
+from .metrics import DB_POOL_TIMEOUTS, DB_POOL_WAIT
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the checkout wait histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10)
+
+class PoolMetrics:
+    """Counts pool checkouts and how long each one waited for a connection"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.buckets = [0] * len(WAIT_BUCKETS)
+
+    def observe(self, seconds, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            for i, bound in enumerate(WAIT_BUCKETS):
+                if seconds <= bound:
+                    self.buckets[i] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_total, 6),
+                'wait_seconds_max': round(self.wait_max, 6),
+                # Cumulative, like a Prometheus histogram
+                'wait_buckets': {str(bound): count for bound, count in zip(WAIT_BUCKETS, self.buckets)}
+            }
+
+# Metrics are per process, every gunicorn worker keeps its own pool
+pool_metrics = PoolMetrics()
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records the time spent waiting for a connection in pool_metrics"""
+    
+    _in_checkout = threading.local()
+
+    def _do_get(self):
+        # QueuePool._do_get retries by calling itself, only time the outer call
+        if getattr(self._in_checkout, 'active', False):
+            return super()._do_get()
+        
+        self._in_checkout.active = True
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self._in_checkout.active = False
+            waited = time.perf_counter() - started
+            pool_metrics.observe(waited, timed_out)
+            DB_POOL_WAIT.observe(waited)
+            if timed_out:
+                DB_POOL_TIMEOUTS.inc()
+
+def default_pool_size():
+    """Returns how many requests one server process handles at once, per gunicorn.conf.py"""
+    worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+    if worker_class == 'sync':
+        return 1
+    if worker_class == 'gevent':
+        # Greenlets only hold a connection while they query, most are waiting on the network
+        return 10
+    return int(os.environ.get('GUNICORN_THREADS', 8))
+
+def engine_options(database_uri):
+    """Returns SQLALCHEMY_ENGINE_OPTIONS for the database and the server's worker model"""
+    if not database_uri.startswith('postgresql'):
+        # SQLite is only used for tests and benchmarks, keep the Flask-SQLAlchemy defaults
+        return {}
+    
+    statement_timeout_ms = int(float(os.environ.get('DB_STATEMENT_TIMEOUT', 30)) * 1000)
+    connect_args = {'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 10))}
+    
+    if os.environ.get('DB_PGBOUNCER', '0') == '1':
+        # PgBouncer does the pooling, so connections are closed on release, and it
+        # rejects startup options, so set statement_timeout on the database role instead
+        logger.info("PgBouncer mode: using NullPool, set statement_timeout with ALTER ROLE")
+        return {'poolclass': NullPool, 'connect_args': connect_args}
+    
+    if statement_timeout_ms > 0:
+        connect_args['options'] = f'-c statement_timeout={statement_timeout_ms}'
+    
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', default_pool_size())),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 2)),
+        # Fail fast under a connection storm instead of piling up requests
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        # Connections go stale while the Pi sleeps, test them before use
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        # Reuse the most recent connection so idle ones can be recycled
+        'pool_use_lifo': True,
+        'connect_args': connect_args
+    }
+
+def pool_status(pool):
+    """Returns the pool's current size and usage, plus the checkout wait metrics"""
+    status = {'pool_class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow()
+        })
+    status.update(pool_metrics.snapshot())
+    return status
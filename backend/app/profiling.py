@@ -0,0 +1,121 @@
+import io
+import os
+import re
+import json
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Header a client sets to profile one request, whatever its duration
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_NAME = re.compile(r'^[\w.-]+\.prof$')
+
+def profile_folder(app):
+    """Returns the folder profiles are written to, inside the instance folder by default"""
+    return app.config.get('PROFILE_FOLDER') or os.path.join(app.instance_path, 'profiles')
+
+class SlowRequestProfiler:
+    """WSGI middleware that runs requests under cProfile and keeps the slow ones.
+    
+    Profiling is opt-in: PROFILE_REQUESTS profiles every request and keeps those
+    slower than PROFILE_SLOW_MS, the X-Profile: 1 header profiles and keeps a
+    single request. Only one request is profiled at a time, the others run as
+    usual, so the overhead stays bounded on the Pi.
+    """
+
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.app = app
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        config = self.app.config
+        forced = config['PROFILE_HEADER_ENABLED'] and environ.get(PROFILE_HEADER) == '1'
+        if not (config['PROFILE_REQUESTS'] or forced) or not self._lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+        
+        statuses = []
+        def capture_status(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+        
+        try:
+            profiler = cProfile.Profile()
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                return self.wsgi_app(environ, capture_status)
+            finally:
+                profiler.disable()
+                duration_ms = (time.perf_counter() - started) * 1000
+                if forced or duration_ms >= config['PROFILE_SLOW_MS']:
+                    self.save(profiler, environ, statuses[-1] if statuses else None, duration_ms)
+        finally:
+            self._lock.release()
+
+    def save(self, profiler, environ, status, duration_ms):
+        """Writes the profile and its request details, then drops the oldest beyond PROFILE_KEEP"""
+        try:
+            folder = profile_folder(self.app)
+            os.makedirs(folder, exist_ok=True)
+            
+            now = datetime.datetime.now(datetime.UTC)
+            path = environ.get('PATH_INFO', '/')
+            slug = re.sub(r'[^\w]+', '_', path).strip('_') or 'root'
+            name = f"{now:%Y%m%dT%H%M%S%f}_{environ.get('REQUEST_METHOD', 'GET')}_{slug}_{int(duration_ms)}ms.prof"
+            
+            profiler.dump_stats(os.path.join(folder, name))
+            with open(os.path.join(folder, name[:-len('.prof')] + '.json'), 'w') as details:
+                json.dump({
+                    'name': name,
+                    'method': environ.get('REQUEST_METHOD'),
+                    'path': path,
+                    'query_string': environ.get('QUERY_STRING', ''),
+                    'status': int(status.split()[0]) if status else None,
+                    'duration_ms': round(duration_ms, 1),
+                    'created': now.isoformat()
+                }, details)
+            
+            prune_profiles(folder, self.app.config['PROFILE_KEEP'])
+        except OSError as e:
+            logger.warning(f"Could not save request profile: {e}")
+
+def prune_profiles(folder, keep):
+    """Removes the oldest profiles so at most keep remain"""
+    names = sorted(name for name in os.listdir(folder) if PROFILE_NAME.match(name))
+    for name in names[:max(0, len(names) - keep)]:
+        for path in (name, name[:-len('.prof')] + '.json'):
+            try:
+                os.remove(os.path.join(folder, path))
+            except FileNotFoundError:
+                pass
+
+def list_profiles(folder):
+    """Returns the details of the saved profiles, newest first"""
+    if not os.path.isdir(folder):
+        return []
+    
+    profiles = []
+    for name in sorted(os.listdir(folder), reverse=True):
+        if not PROFILE_NAME.match(name):
+            continue
+        try:
+            with open(os.path.join(folder, name[:-len('.prof')] + '.json')) as details:
+                profile = json.load(details)
+        except (OSError, ValueError):
+            profile = {'name': name}
+        profile['size'] = os.path.getsize(os.path.join(folder, name))
+        profiles.append(profile)
+    return profiles
+
+def profile_summary(path, sort='cumulative', limit=50):
+    """Returns a pstats report of a saved profile, for reading it without extra tools"""
+    output = io.StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return output.getvalue()
@@ -0,0 +1,317 @@
+import os
+import logging
+import datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete
+from .jobs import enqueue, job_handler, utcnow
+from .models import Backup, Blob, IgnoredFile, Job, insert_for
+from .stats import invalidate_disk_usage, subtract_deleted
+from .storage import DEFAULT_VOLUME, stored_path, total_usage
+from . import db
+
+logger = logging.getLogger(__name__)
+
+FILE_TYPES = ('photo', 'video')
+
+# Maximum number of bound parameters per IN (...) lookup
+LOOKUP_CHUNK_SIZE = 1000
+
+def parse_list(value):
+    """Parses "a,b" into ['a', 'b']"""
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def parse_policy(data):
+    """Validates a pruning policy, raises ValueError with a message for the client.
+    
+    older_than_days, device_ids and file_types select the backups that may go,
+    oldest first. free_percent stops once enough space would be free on the
+    drives, without it every selected backup is pruned.
+    """
+    policy = {
+        'older_than_days': data.get('older_than_days'),
+        'device_ids': data.get('device_ids') or [],
+        'file_types': data.get('file_types') or [],
+        'free_percent': data.get('free_percent')
+    }
+    for key in ('older_than_days', 'free_percent'):
+        if policy[key] is not None and (not isinstance(policy[key], (int, float)) or policy[key] <= 0):
+            raise ValueError(f'{key} must be a positive number')
+    if policy['free_percent'] is not None and policy['free_percent'] >= 100:
+        raise ValueError('free_percent must be below 100')
+    for key in ('device_ids', 'file_types'):
+        if not isinstance(policy[key], list) or not all(isinstance(item, str) for item in policy[key]):
+            raise ValueError(f'{key} must be a list of strings')
+    if any(file_type not in FILE_TYPES for file_type in policy['file_types']):
+        raise ValueError(f"file_types may only contain {', '.join(FILE_TYPES)}")
+    
+    # A file type alone would select a whole library
+    if policy['older_than_days'] is None and policy['free_percent'] is None and not policy['device_ids']:
+        raise ValueError('A policy needs older_than_days, device_ids or free_percent')
+    return policy
+
+def configured_policy():
+    """Returns the automatic policy from the PRUNE_* settings, or None when pruning is off"""
+    config = current_app.config
+    min_free = config['PRUNE_MIN_FREE_PERCENT']
+    if not config['PRUNE_MAX_AGE_DAYS'] and not min_free:
+        return None
+    return parse_policy({
+        'older_than_days': config['PRUNE_MAX_AGE_DAYS'] or None,
+        'device_ids': parse_list(config['PRUNE_DEVICES']),
+        'file_types': parse_list(config['PRUNE_FILE_TYPES']),
+        'free_percent': max(min_free, config['PRUNE_TARGET_FREE_PERCENT']) if min_free else None
+    })
+
+def bytes_to_free(policy):
+    """Returns how many bytes must go to reach the policy's free space, None without a target"""
+    if policy['free_percent'] is None:
+        return None
+    invalidate_disk_usage()
+    total, _, free = total_usage()
+    return max(0, int(total * policy['free_percent'] / 100) - free)
+
+def find_candidates(policy, after, limit):
+    """Returns the next completed backups the policy selects, oldest first"""
+    query = db.session.query(
+        Backup.id, Backup.timestamp, Backup.file_name, Backup.volume, Backup.file_path, Backup.file_size,
+        Backup.file_type, Backup.device_id, Backup.original_path, Backup.content_hash
+    ).filter(Backup.status == 'Completed')
+    
+    if policy['older_than_days'] is not None:
+        query = query.filter(Backup.timestamp < utcnow() - datetime.timedelta(days=policy['older_than_days']))
+    if policy['device_ids']:
+        query = query.filter(Backup.device_id.in_(policy['device_ids']))
+    if policy['file_types']:
+        query = query.filter(Backup.file_type.in_(policy['file_types']))
+    if after is not None:
+        query = query.filter(db.tuple_(Backup.timestamp, Backup.id) > db.tuple_(*after))
+    
+    # Walks ix_backups_completed_timestamp_id, or the device index for one device
+    return query.order_by(Backup.timestamp, Backup.id).limit(limit).all()
+
+def count_references(column, values, *filters):
+    """Returns {value: backups referring to it} for content hashes or file paths"""
+    counts = {}
+    values = list(values)
+    for start in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        rows = db.session.query(column, db.func.count(Backup.id)).filter(
+            column.in_(values[start:start + LOOKUP_CHUNK_SIZE]), *filters
+        ).group_by(column)
+        counts.update(rows)
+    return counts
+
+def freed_files(rows, pruned_refs):
+    """Returns the stored files no backup outside the pruned ones refers to, with the
+    index of the last row needing each, as {key: (volume, file_path, file_size, index)}.
+    
+    Content is shared between backups, so only the last reference frees a file.
+    pruned_refs counts the pruned references per key and is updated in place.
+    """
+    last_row = {}
+    for index, row in enumerate(rows):
+        key = row.content_hash or row.file_path
+        pruned_refs[key] = pruned_refs.get(key, 0) + 1
+        last_row[key] = index
+    
+    hashes = list({row.content_hash for row in rows if row.content_hash})
+    references = count_references(Backup.content_hash, hashes)
+    blobs = {}
+    for start in range(0, len(hashes), LOOKUP_CHUNK_SIZE):
+        blobs.update((row.hash, row) for row in db.session.query(Blob.hash, Blob.volume, Blob.file_path, Blob.file_size).filter(
+            Blob.hash.in_(hashes[start:start + LOOKUP_CHUNK_SIZE])
+        ))
+    
+    # Backups from before content addressing share a file only by its path
+    paths = {row.file_path for row in rows if not row.content_hash}
+    if paths:
+        references.update(count_references(Backup.file_path, paths, Backup.content_hash.is_(None)))
+        # A scrub may have made the file a blob's copy since
+        for (file_path,) in db.session.query(Blob.file_path).filter(
+            Blob.volume == DEFAULT_VOLUME, Blob.file_path.in_(paths)
+        ):
+            references[file_path] = float('inf')
+    
+    freed = {}
+    for key, index in last_row.items():
+        if references.get(key, 0) > pruned_refs[key]:
+            continue
+        if key in blobs:
+            blob = blobs[key]
+            freed[key] = (blob.volume, blob.file_path, blob.file_size, index)
+        else:
+            row = rows[index]
+            freed[key] = (row.volume, row.file_path, row.file_size, index)
+    return freed
+
+def delete_backups(rows, freed):
+    """Deletes backups and the blobs only they referred to, and ignores their paths (caller commits)"""
+    ids = [row.id for row in rows]
+    db.session.execute(delete(Backup).where(Backup.id.in_(ids)))
+    
+    hashes = {row.content_hash for row in rows if row.content_hash}.intersection(freed)
+    if hashes:
+        db.session.execute(delete(Blob).where(Blob.hash.in_(list(hashes))))
+    
+    # Devices still have these files, without an ignore the next scan would upload them again
+    now = utcnow()
+    ignores = {
+        (row.device_id, row.original_path): {
+            'file_name': row.file_name,
+            'device_id': row.device_id,
+            'original_path': row.original_path,
+            'timestamp': now
+        }
+        for row in rows if row.original_path
+    }
+    if ignores:
+        db.session.execute(
+            insert_for(IgnoredFile).values(list(ignores.values())).on_conflict_do_nothing(
+                index_elements=['device_id', 'original_path']
+            )
+        )
+    
+    subtract_deleted(rows)
+
+def remove_files(freed):
+    """Removes freed files from their drives, after the rows pointing at them are gone"""
+    for volume, file_path, _, _ in freed.values():
+        try:
+            os.remove(stored_path(volume, file_path))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove pruned file {file_path}: {e}")
+    invalidate_disk_usage()
+
+def prune(policy, dry_run=True):
+    """Prunes the backups a policy selects in batches, or only reports them when dry_run is set"""
+    batch_size = current_app.config['PRUNE_BATCH_SIZE']
+    target = bytes_to_free(policy)
+    report = {
+        'dry_run': dry_run,
+        'policy': policy,
+        'target_bytes': target,
+        'pruned_files': 0,
+        'pruned_bytes': 0,  # Size of the pruned backups
+        'reclaimed_bytes': 0,  # Space freed on the drive, shared content only counts once
+        'by_device': {}
+    }
+    
+    # A dry run deletes nothing, so references pruned by earlier batches must be remembered
+    pruned_refs = {}
+    after = None
+    while target is None or report['reclaimed_bytes'] < target:
+        rows = find_candidates(policy, after, batch_size)
+        if not rows:
+            break
+        after = (rows[-1].timestamp, rows[-1].id)
+        if not dry_run:
+            pruned_refs = {}
+        freed = freed_files(rows, pruned_refs)
+        
+        if target is not None:
+            # Stop at the row that frees enough, shared files count at their last reference
+            needed = target - report['reclaimed_bytes']
+            reclaimed = 0
+            for _, _, size, index in sorted(freed.values(), key=lambda value: value[3]):
+                reclaimed += size
+                if reclaimed >= needed:
+                    rows = rows[:index + 1]
+                    freed = {key: value for key, value in freed.items() if value[3] <= index}
+                    break
+        
+        if not dry_run:
+            delete_backups(rows, freed)
+            db.session.commit()
+            remove_files(freed)
+        
+        report['pruned_files'] += len(rows)
+        report['pruned_bytes'] += sum(row.file_size for row in rows)
+        report['reclaimed_bytes'] += sum(size for _, _, size, _ in freed.values())
+        for row in rows:
+            report['by_device'][row.device_id] = report['by_device'].get(row.device_id, 0) + 1
+    
+    if not dry_run:
+        logger.info(
+            f"Pruned {report['pruned_files']} backups, reclaimed {report['reclaimed_bytes']} bytes"
+        )
+    return report
+
+def request_prune_if_low():
+    """Queues a prune once free space drops under PRUNE_MIN_FREE_PERCENT, committed with the upload"""
+    min_free = current_app.config['PRUNE_MIN_FREE_PERCENT']
+    if not min_free:
+        return
+    total, _, free = total_usage()
+    if free * 100 >= total * min_free:
+        return
+    if db.session.query(Job.id).filter(Job.job_type == 'prune', Job.status.in_(['Pending', 'Running'])).first():
+        return
+    enqueue('prune', {})
+
+def request_release(backup):
+    """Queues removing the content a backup is about to stop pointing at, committed with it"""
+    if backup.content_hash:
+        enqueue('prune', {'release': {'content_hash': backup.content_hash}})
+    else:
+        # A backup from before content addressing owns its file by path
+        enqueue('prune', {'release': {'volume': backup.volume, 'file_path': backup.file_path}})
+
+def release_content(release):
+    """Removes a blob, or a file from before content addressing, once no backup refers to it"""
+    if release.get('content_hash'):
+        freed = {}
+        blob = db.session.get(Blob, release['content_hash'])
+        if blob is not None and not count_references(Backup.content_hash, [blob.hash]):
+            freed[blob.hash] = (blob.volume, blob.file_path, blob.file_size, None)
+            db.session.delete(blob)
+    else:
+        volume, file_path = release['volume'], release['file_path']
+        in_use = db.session.query(Backup.id).filter(
+            Backup.volume == volume, Backup.file_path == file_path
+        ).first() or db.session.query(Blob.hash).filter(
+            Blob.volume == volume, Blob.file_path == file_path
+        ).first()
+        freed = {} if in_use else {file_path: (volume, file_path, 0, None)}
+    db.session.commit()
+    remove_files(freed)
+
+@job_handler('prune')
+def prune_job(payload):
+    """Job handler that releases replaced content, or applies a policy from the payload or the configured one"""
+    if payload.get('release'):
+        release_content(payload['release'])
+        return
+    policy = parse_policy(payload['policy']) if payload.get('policy') else configured_policy()
+    if policy is not None:
+        prune(policy, dry_run=False)
+
+@click.command('prune')
+@click.option('--dry-run', is_flag=True, help='Only report what would be pruned.')
+@click.option('--older-than-days', type=float, default=None, help='Backups made more than this many days ago.')
+@click.option('--device', 'device_ids', multiple=True, help='Backups of this device, may be repeated.')
+@click.option('--file-type', 'file_types', multiple=True, type=click.Choice(FILE_TYPES), help='Backups of this type.')
+@click.option('--free-percent', type=float, default=None, help='Stop once this much of the drive is free.')
+@with_appcontext
+def prune_command(dry_run, older_than_days, device_ids, file_types, free_percent):
+    """Prune old backups, by default with the PRUNE_* policy."""
+    try:
+        if older_than_days or device_ids or free_percent:
+            policy = parse_policy({
+                'older_than_days': older_than_days,
+                'device_ids': list(device_ids),
+                'file_types': list(file_types),
+                'free_percent': free_percent
+            })
+        else:
+            policy = configured_policy()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    if policy is None:
+        raise click.ClickException('No pruning policy, set PRUNE_MAX_AGE_DAYS or PRUNE_MIN_FREE_PERCENT')
+    
+    report = prune(policy, dry_run=dry_run)
+    verb = 'Would prune' if dry_run else 'Pruned'
+    click.echo(f"{verb} {report['pruned_files']} backups, reclaiming {report['reclaimed_bytes']} bytes")
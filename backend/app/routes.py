@@ -1,9 +1,29 @@
 import os
-import shutil
+import base64
 import datetime
-from flask import Blueprint, jsonify, request, current_app
+from flask import Blueprint, jsonify, request, current_app, send_file, send_from_directory, stream_with_context
 from werkzeug.utils import secure_filename
-from .models import Backup, IgnoredFile
+from werkzeug.http import parse_content_range_header
+from sqlalchemy import update
+from .admission import upload_device
+from .archive import FORMATS as ARCHIVE_FORMATS, stream_archive
+from .content import send_stored_file
+from .models import Backup, Blob, IgnoredFile, ScrubFinding, ScrubRun, UploadSession, insert_for
+from .stats import get_stats
+from .jobs import enqueue, queue_depth
+from .metrics import metrics_response
+from .encoding import list_response
+from .pool import pool_status
+from .profiling import PROFILE_NAME, list_profiles, profile_folder, profile_summary
+from .prune import configured_policy, parse_policy, prune
+from .scrub import ScrubInProgress, latest_run, start_scrub
+from .storage import VolumeUnavailable, choose_volume, queue_rebalance, rebalance_plan, total_usage, volume_usage
+from .sync import encode_needed, find_scan, finish_scan, record_page, reset_sync_state, start_scan
+from .thumbnails import FORMATS, cache_key, enqueue_thumbnails, get_thumbnail, is_thumbnailable, snap_size, thumbnail_etag
+from .uploads import (
+    find_backup, hash_file, locked_staging_file, receive_blob, record_backup, request_upload_expiry, staging_path,
+    store_blob, write_stream
+)
 from . import db
 
 # Blueprint for main routes
@@ -18,6 +38,12 @@ storage_bp = Blueprint('storage', __name__, url_prefix='/storage')
 # Blueprint for backup related routes
 backup_bp = Blueprint('backup', __name__, url_prefix='/backup')
 
+# Blueprint for background job routes
+jobs_bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+# Blueprint for admin and diagnostics routes
+admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
+
 @main_bp.route('/ping', methods=['GET'])
 def ping():
     """Endpoint to check if the server is reachable"""
@@ -26,6 +52,19 @@ def ping():
         'message': 'iClood server is online'
     }), 200
 
+@main_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Returns request, database and upload metrics for Prometheus to scrape"""
+    return metrics_response()
+
+@main_bp.route('/db/pool', methods=['GET'])
+def get_db_pool_status():
+    """Returns connection pool usage and checkout wait times for this server process"""
+    return jsonify({
+        'status': 'success',
+        'pool': pool_status(db.engine.pool)
+    }), 200
+
 @photos_bp.route('/new', methods=['POST'])
 def get_new_photos():
     """Returns list of new photos/videos to back up"""
@@ -37,31 +76,123 @@ def get_new_photos():
             'message': 'No file data provided'
         }), 400
     
-    device_id = data.get('device_id', 'unknown')
+    files = data['files']
+    if len(files) > current_app.config['SCAN_BATCH_LIMIT']:
+        return jsonify({
+            'status': 'error',
+            'message': f"Too many files in one request, send at most {current_app.config['SCAN_BATCH_LIMIT']} per page"
+        }), 413
     
-    # Get list of files already backed up or ignored
-    backed_up_files = db.session.query(Backup.original_path).filter_by(
-        device_id=device_id,
-        status='Completed'
-    ).all()
-    backed_up_paths = [file[0] for file in backed_up_files]
+    device_id = data.get('device_id', 'unknown')
+    paths = list({file['path'] for file in files})
     
-    ignored_files = db.session.query(IgnoredFile.original_path).filter_by(
-        device_id=device_id
-    ).all()
-    ignored_paths = [file[0] for file in ignored_files]
+    # Let the database resolve which of this page's paths it already knows about
+    known_paths = find_known_paths(Backup, device_id, paths, status='Completed')
+    known_paths |= find_known_paths(IgnoredFile, device_id, paths)
     
     # Filter out files that have already been backed up or ignored
-    new_files = [
-        file for file in data['files']
-        if file['path'] not in backed_up_paths and file['path'] not in ignored_paths
-    ]
+    new_files = [file for file in files if file['path'] not in known_paths]
     
-    return jsonify({
+    return list_response({
         'status': 'success',
         'new_files': new_files,
         'count': len(new_files)
-    }), 200
+    }, ['new_files'])
+
+@photos_bp.route('/sync/start', methods=['POST'])
+def start_sync_scan():
+    """Starts a delta scan, the device sends only assets modified at or after synced_until"""
+    data = request.get_json(silent=True) or {}
+    device_id = data.get('device_id', 'unknown')
+    
+    try:
+        state = start_scan(device_id)
+        db.session.commit()
+        
+        return jsonify({
+            'status': 'success',
+            'scan': state.scan_token,
+            'synced_until': state.synced_until
+        }), 200
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to start sync: {str(e)}'
+        }), 500
+
+@photos_bp.route('/sync', methods=['POST'])
+def sync_scan_page():
+    """Returns which assets of a delta scan page need a backup, by index into the page"""
+    data = request.get_json(silent=True)
+    
+    if not data or not data.get('scan') or 'paths' not in data or 'modified' not in data:
+        return jsonify({
+            'status': 'error',
+            'message': 'scan, paths and modified are required'
+        }), 400
+    
+    # Columns instead of one object per asset keep the page small
+    paths, modified = data['paths'], data['modified']
+    try:
+        if not isinstance(paths, list) or not isinstance(modified, list):
+            raise TypeError
+        modified = [int(value) for value in modified]
+    except (TypeError, ValueError):
+        return jsonify({
+            'status': 'error',
+            'message': 'paths and modified must be lists, modified of millisecond timestamps'
+        }), 400
+    
+    if len(paths) != len(modified):
+        return jsonify({
+            'status': 'error',
+            'message': 'paths and modified must have the same length'
+        }), 400
+    
+    if len(paths) > current_app.config['SCAN_BATCH_LIMIT']:
+        return jsonify({
+            'status': 'error',
+            'message': f"Too many files in one request, send at most {current_app.config['SCAN_BATCH_LIMIT']} per page"
+        }), 413
+    
+    device_id = data.get('device_id', 'unknown')
+    
+    try:
+        state = find_scan(device_id, data['scan'])
+        if state is None:
+            db.session.rollback()
+            # Another scan started, or the server needs the whole library again
+            return jsonify({
+                'status': 'error',
+                'message': 'Scan is no longer current, start a new one'
+            }), 409
+        
+        unique_paths = list(set(paths))
+        known_paths = find_known_paths(Backup, device_id, unique_paths, status='Completed')
+        known_paths |= find_known_paths(IgnoredFile, device_id, unique_paths)
+        needed = [index for index, path in enumerate(paths) if path not in known_paths]
+        
+        record_page(state, modified, needed)
+        if data.get('done'):
+            finish_scan(state)
+        synced_until = state.synced_until
+        db.session.commit()
+        
+        return jsonify({
+            'status': 'success',
+            'count': len(needed),
+            'synced_until': synced_until,
+            **encode_needed(needed, len(paths))
+        }), 200
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to sync files: {str(e)}'
+        }), 500
 
 @photos_bp.route('/upload', methods=['POST'])
 def upload_photo():
@@ -87,24 +218,9 @@ def upload_photo():
     # Ensure the filename is secure
     filename = secure_filename(file.filename)
     
-    # Create year/month folder structure
-    today = datetime.datetime.now()
-    year_month = f"{today.year}/{today.month:02d}"
-    folder_path = os.path.join(current_app.config['UPLOAD_FOLDER'], year_month)
-    
-    # Create directory if it doesn't exist
-    os.makedirs(folder_path, exist_ok=True)
-    
-    # Full path to save the file
-    file_path = os.path.join(folder_path, filename)
-    relative_path = os.path.join(year_month, filename)
-    
     try:
         # Check if a backup record already exists
-        existing_backup = Backup.query.filter_by(
-            original_path=original_path,
-            device_id=device_id
-        ).first()
+        existing_backup = find_backup(original_path, device_id)
         
         if existing_backup and existing_backup.status == 'Completed':
             return jsonify({
@@ -113,32 +229,16 @@ def upload_photo():
                 'backup': existing_backup.to_dict()
             }), 200
         
-        # Save the file
-        file.save(file_path)
-        
-        # Get file size
-        file_size = os.path.getsize(file_path)
+        # Save the file, hashing it on the way so identical content is stored once
+        blob = receive_blob(file.stream, filename)
         
         # Create or update backup record
-        if existing_backup:
-            existing_backup.file_path = relative_path
-            existing_backup.file_size = file_size
-            existing_backup.status = 'Completed'
-            existing_backup.timestamp = datetime.datetime.utcnow()
-            backup = existing_backup
-        else:
-            backup = Backup(
-                file_name=filename,
-                file_path=relative_path,
-                original_path=original_path,
-                file_size=file_size,
-                file_type=file_type,
-                mime_type=file.content_type,
-                device_id=device_id,
-                status='Completed'
-            )
-            db.session.add(backup)
+        backup = record_backup(
+            existing_backup, filename, blob, original_path,
+            file_type, file.content_type, device_id
+        )
         
+        enqueue_thumbnails([backup])
         db.session.commit()
         
         return jsonify({
@@ -146,7 +246,7 @@ def upload_photo():
             'message': 'File uploaded successfully',
             'backup': backup.to_dict()
         }), 201
-        
+    
     except Exception as e:
         # Log the failed backup
         if 'backup' in locals() and backup.id:
@@ -158,6 +258,503 @@ def upload_photo():
             'message': f'Failed to upload file: {str(e)}'
         }), 500
 
+@photos_bp.route('/upload/batch', methods=['POST'])
+def upload_photo_batch():
+    """Uploads many files in one multipart request and commits them together"""
+    files = request.files.getlist('file')
+    
+    if not files:
+        return jsonify({
+            'status': 'error',
+            'message': 'No file part'
+        }), 400
+    
+    if len(files) > current_app.config['UPLOAD_BATCH_LIMIT']:
+        return jsonify({
+            'status': 'error',
+            'message': f"Too many files in one request, send at most {current_app.config['UPLOAD_BATCH_LIMIT']}"
+        }), 413
+    
+    # Per-file fields are repeated in the same order as the file parts
+    original_paths = request.form.getlist('original_path')
+    file_types = request.form.getlist('file_type')
+    device_id = request.form.get('device_id', 'unknown')
+    
+    if len(original_paths) != len(files):
+        return jsonify({
+            'status': 'error',
+            'message': 'Each file part needs a matching original_path field'
+        }), 400
+    
+    try:
+        # One lookup for the whole batch instead of one per file
+        existing_backups = {
+            backup.original_path: backup
+            for backup in Backup.query.filter(
+                Backup.device_id == device_id,
+                Backup.original_path.in_(set(original_paths))
+            )
+        }
+        
+        results = []
+        for index, file in enumerate(files):
+            original_path = original_paths[index]
+            file_type = file_types[index] if index < len(file_types) else 'photo'
+            filename = secure_filename(file.filename or '')
+            existing_backup = existing_backups.get(original_path)
+            
+            if filename == '':
+                results.append({'original_path': original_path, 'status': 'error', 'message': 'No selected file'})
+            elif existing_backup and existing_backup.status == 'Completed':
+                results.append({'original_path': original_path, 'status': 'exists', 'backup': existing_backup})
+            else:
+                try:
+                    blob = receive_blob(file.stream, filename)
+                except OSError as e:
+                    results.append({'original_path': original_path, 'status': 'error', 'message': str(e)})
+                    continue
+                
+                backup = record_backup(
+                    existing_backup, filename, blob, original_path,
+                    file_type, file.content_type, device_id
+                )
+                existing_backups[original_path] = backup
+                results.append({'original_path': original_path, 'status': 'uploaded', 'backup': backup})
+        
+        # New rows go out as one batched INSERT in a single transaction
+        enqueue_thumbnails([result['backup'] for result in results if result['status'] == 'uploaded'])
+        db.session.commit()
+        
+        for result in results:
+            if 'backup' in result:
+                result['backup'] = result['backup'].to_dict()
+        
+        return jsonify({
+            'status': 'success',
+            'results': results,
+            'uploaded_count': sum(1 for result in results if result['status'] == 'uploaded'),
+            'failed_count': sum(1 for result in results if result['status'] == 'error')
+        }), 200
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to upload files: {str(e)}'
+        }), 500
+
+@photos_bp.route('/upload/plan', methods=['GET'])
+def get_upload_plan():
+    """Returns how many uploads a device should run at once and how large to make them"""
+    try:
+        plan = current_app.extensions['upload_admission'].plan(upload_device())
+        return jsonify({
+            'status': 'success',
+            'plan': plan
+        }), 200
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to get upload plan: {str(e)}'
+        }), 500
+
+@photos_bp.route('/upload/stream', methods=['POST'])
+def upload_photo_stream():
+    """Uploads a file sent as the raw request body, metadata in the query string"""
+    filename = secure_filename(request.args.get('file_name', ''))
+    
+    if filename == '':
+        return jsonify({
+            'status': 'error',
+            'message': 'No file name provided'
+        }), 400
+    
+    original_path = request.args.get('original_path', '')
+    file_type = request.args.get('file_type', 'photo')
+    device_id = request.args.get('device_id', 'unknown')
+    
+    try:
+        existing_backup = find_backup(original_path, device_id)
+        
+        if existing_backup and existing_backup.status == 'Completed':
+            return jsonify({
+                'status': 'success',
+                'message': 'File already backed up',
+                'backup': existing_backup.to_dict()
+            }), 200
+        
+        # Don't hold a pooled connection while the body arrives
+        db.session.rollback()
+        
+        # Bypass the form parser so the body is written once, straight to the backup drive
+        blob = receive_blob(request.stream, filename, request.content_length)
+        
+        backup = record_backup(
+            existing_backup, filename, blob, original_path,
+            file_type, request.mimetype or None, device_id
+        )
+        enqueue_thumbnails([backup])
+        db.session.commit()
+        
+        return jsonify({
+            'status': 'success',
+            'message': 'File uploaded successfully',
+            'backup': backup.to_dict()
+        }), 201
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to upload file: {str(e)}'
+        }), 500
+
+@photos_bp.route('/uploads', methods=['POST'])
+def create_upload_session():
+    """Starts a resumable upload and returns its session"""
+    data = request.json
+    
+    if not data or not data.get('file_name') or data.get('total_size') is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'file_name and total_size are required'
+        }), 400
+    
+    try:
+        total_size = int(data['total_size'])
+    except (TypeError, ValueError):
+        total_size = -1
+    if total_size < 0:
+        return jsonify({
+            'status': 'error',
+            'message': 'total_size must be a non-negative integer'
+        }), 400
+    
+    original_path = data.get('original_path', '')
+    device_id = data.get('device_id', 'unknown')
+    
+    existing_backup = find_backup(original_path, device_id)
+    if existing_backup and existing_backup.status == 'Completed':
+        return jsonify({
+            'status': 'success',
+            'message': 'File already backed up',
+            'backup': existing_backup.to_dict()
+        }), 200
+    
+    try:
+        session = UploadSession(
+            file_name=secure_filename(data['file_name']),
+            original_path=original_path,
+            file_type=data.get('file_type', 'photo'),
+            mime_type=data.get('mime_type'),
+            device_id=device_id,
+            total_size=total_size,
+            received_bytes=0,
+            volume=choose_volume(total_size)
+        )
+        db.session.add(session)
+        db.session.flush()
+        
+        # Chunks are appended to a staging file on the drive the file will be stored on
+        open(staging_path(session.id, session.volume), 'wb').close()
+        request_upload_expiry()
+        db.session.commit()
+        
+        return jsonify({
+            'status': 'success',
+            'session': session.to_dict()
+        }), 201
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to create upload session: {str(e)}'
+        }), 500
+
+@photos_bp.route('/uploads/<session_id>', methods=['GET'])
+def get_upload_session(session_id):
+    """Returns the upload session, including the offset received so far"""
+    session = db.session.get(UploadSession, session_id)
+    if session is None:
+        return upload_session_not_found()
+    
+    return jsonify({
+        'status': 'success',
+        'session': session.to_dict()
+    }), 200
+
+@photos_bp.route('/uploads/<session_id>', methods=['PUT'])
+def upload_chunk(session_id):
+    """Writes one byte range, described by Content-Range, to the staging file"""
+    session = db.session.get(UploadSession, session_id)
+    if session is None:
+        return upload_session_not_found()
+    
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    if content_range is None or content_range.units != 'bytes' or content_range.start is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'A Content-Range header such as "bytes 0-1023/4096" is required'
+        }), 400
+    
+    if content_range.length not in (None, session.total_size) or content_range.stop > session.total_size:
+        return jsonify({
+            'status': 'error',
+            'message': 'Content-Range does not match the session size'
+        }), 400
+    
+    try:
+        # The staging file is locked while the chunk is written, so a retried
+        # chunk can't write the same range at the same time
+        with locked_staging_file(session.id, session.volume) as staging_file:
+            # Another request may have moved the offset before this one got the lock
+            db.session.refresh(session)
+            
+            # Chunks must arrive in order; tell the client where to resume from
+            if content_range.start != session.received_bytes:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Chunk does not start at the received offset',
+                    'session': session.to_dict()
+                }), 409
+            
+            # Don't hold a pooled connection while the chunk arrives
+            db.session.rollback()
+            
+            # Overwrite anything past the committed offset left by an interrupted chunk
+            staging_file.seek(content_range.start)
+            written = write_stream(request.stream, staging_file)
+            staging_file.truncate()
+            
+            if written != content_range.stop - content_range.start:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'Expected {content_range.stop - content_range.start} bytes, received {written}',
+                    'session': session.to_dict()
+                }), 400
+            
+            # Only moves the offset if the session is still where this chunk started
+            result = db.session.execute(
+                update(UploadSession)
+                .where(UploadSession.id == session_id, UploadSession.received_bytes == content_range.start)
+                .values(received_bytes=content_range.stop, updated_at=datetime.datetime.now(datetime.UTC))
+            )
+            db.session.commit()
+        
+        session = db.session.get(UploadSession, session_id)
+        if result.rowcount == 0 or session is None:
+            # Aborted or expired while the chunk arrived
+            return upload_session_not_found()
+        
+        return jsonify({
+            'status': 'success',
+            'session': session.to_dict()
+        }), 200
+    
+    except BlockingIOError:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': 'Another chunk of this upload is being written'
+        }), 409
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to write chunk: {str(e)}'
+        }), 500
+
+@photos_bp.route('/uploads/<session_id>/finalize', methods=['POST'])
+def finalize_upload_session(session_id):
+    """Moves a fully received upload into place and records the backup"""
+    session = db.session.get(UploadSession, session_id)
+    if session is None:
+        return upload_session_not_found()
+    
+    if session.received_bytes != session.total_size:
+        return jsonify({
+            'status': 'error',
+            'message': 'Upload is not complete',
+            'session': session.to_dict()
+        }), 409
+    
+    try:
+        # Chunks arrive over many requests, so the hash is computed once here,
+        # without holding a pooled connection while the file is read
+        path = staging_path(session.id, session.volume)
+        db.session.rollback()
+        content_hash = hash_file(path)
+        
+        existing_backup = find_backup(session.original_path, session.device_id)
+        
+        # The staging folder is on the same drive, so storing it is a cheap rename
+        blob = store_blob(path, session.file_name, session.total_size, content_hash, session.volume)
+        
+        backup = record_backup(
+            existing_backup, session.file_name, blob, session.original_path,
+            session.file_type, session.mime_type, session.device_id
+        )
+        db.session.delete(session)
+        enqueue_thumbnails([backup])
+        db.session.commit()
+        
+        return jsonify({
+            'status': 'success',
+            'message': 'File uploaded successfully',
+            'backup': backup.to_dict()
+        }), 201
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to finalize upload: {str(e)}'
+        }), 500
+
+@photos_bp.route('/uploads/<session_id>', methods=['DELETE'])
+def abort_upload_session(session_id):
+    """Discards an upload session and its staging file"""
+    session = db.session.get(UploadSession, session_id)
+    if session is None:
+        return upload_session_not_found()
+    
+    try:
+        os.remove(staging_path(session.id, session.volume))
+    except (FileNotFoundError, VolumeUnavailable):
+        pass
+    
+    db.session.delete(session)
+    db.session.commit()
+    
+    return jsonify({
+        'status': 'success',
+        'message': 'Upload session aborted'
+    }), 200
+
+def upload_session_not_found():
+    """Standard response for an unknown upload session"""
+    return jsonify({
+        'status': 'error',
+        'message': 'Upload session not found'
+    }), 404
+
+@photos_bp.route('/link', methods=['POST'])
+def link_known_content():
+    """Records backups for files whose content hash is already stored, so they need no upload"""
+    data = request.json
+    
+    if not data or 'files' not in data:
+        return jsonify({
+            'status': 'error',
+            'message': 'No file data provided'
+        }), 400
+    
+    device_id = data.get('device_id', 'unknown')
+    files = [file for file in data['files'] if file.get('hash')]
+    
+    try:
+        hashes = list({file['hash'].lower() for file in files})
+        blobs = {
+            blob.hash: blob
+            for blob in Blob.query.filter(Blob.hash.in_(hashes))
+        } if hashes else {}
+        
+        linked = []
+        missing = []
+        for file in files:
+            blob = blobs.get(file['hash'].lower())
+            if blob is None:
+                missing.append(file)
+                continue
+            
+            existing_backup = find_backup(file['path'], device_id)
+            if existing_backup and existing_backup.status == 'Completed':
+                linked.append(existing_backup)
+                continue
+            
+            linked.append(record_backup(
+                existing_backup, secure_filename(file.get('name') or os.path.basename(file['path'])),
+                blob, file['path'], file.get('type', 'photo'), file.get('mime_type'), device_id
+            ))
+        
+        db.session.commit()
+        
+        return jsonify({
+            'status': 'success',
+            'linked': [backup.to_dict() for backup in linked],
+            'missing': missing,
+            'linked_count': len(linked)
+        }), 200
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to link files: {str(e)}'
+        }), 500
+
+@photos_bp.route('/<int:backup_id>/thumbnail', methods=['GET'])
+def get_photo_thumbnail(backup_id):
+    """Serves a cached JPEG or WebP thumbnail of a backed up photo, HEIC needs pillow-heif"""
+    backup = db.session.get(Backup, backup_id)
+    if backup is None or not is_thumbnailable(backup):
+        return jsonify({
+            'status': 'error',
+            'message': 'No thumbnail available for this file'
+        }), 404
+    
+    size = snap_size(request.args.get('size', 256, type=int))
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+    if fmt not in FORMATS:
+        return jsonify({
+            'status': 'error',
+            'message': f'Unsupported thumbnail format: {fmt}'
+        }), 400
+    
+    # Answer repeat views before touching the disk
+    etag = thumbnail_etag(cache_key(backup), size, fmt)
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    try:
+        path = get_thumbnail(backup, size, fmt)
+    except OSError as e:
+        # Also covers files Pillow cannot decode, e.g. HEIC without pillow-heif
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to generate thumbnail: {str(e)}'
+        }), 404
+    
+    return send_file(path, mimetype=FORMATS[fmt][1], etag=etag, max_age=THUMBNAIL_MAX_AGE)
+
+@photos_bp.route('/<int:backup_id>/content', methods=['GET'])
+def get_photo_content(backup_id):
+    """Serves a backed up file for restores, with Range requests so videos can seek"""
+    backup = db.session.get(Backup, backup_id)
+    if backup is None or backup.status != 'Completed':
+        return jsonify({
+            'status': 'error',
+            'message': 'Backup not found'
+        }), 404
+    
+    # Don't hold a pooled connection while the file is sent
+    db.session.commit()
+    
+    try:
+        return send_stored_file(backup, as_attachment=request.args.get('download') == '1')
+    except (FileNotFoundError, VolumeUnavailable):
+        return jsonify({
+            'status': 'error',
+            'message': 'The backed up file is missing from the drive'
+        }), 404
+
 @photos_bp.route('/ignore', methods=['POST'])
 def ignore_file():
     """Mark files to be ignored for future backups"""
@@ -172,22 +769,25 @@ def ignore_file():
     device_id = data.get('device_id', 'unknown')
     
     try:
+        now = datetime.datetime.utcnow()
+        paths = list(dict.fromkeys(file_data['path'] for file_data in data['files']))
+        
+        # One set-based insert per chunk; rows that already exist are skipped by the database
         ignored_count = 0
-        for file_data in data['files']:
-            # Check if already ignored
-            existing = IgnoredFile.query.filter_by(
-                original_path=file_data['path'],
-                device_id=device_id
-            ).first()
+        for start in range(0, len(paths), INSERT_CHUNK_SIZE):
+            rows = [{
+                'file_name': os.path.basename(path),
+                'original_path': path,
+                'device_id': device_id,
+                'timestamp': now
+            } for path in paths[start:start + INSERT_CHUNK_SIZE]]
             
-            if not existing:
-                ignored_file = IgnoredFile(
-                    file_name=os.path.basename(file_data['path']),
-                    original_path=file_data['path'],
-                    device_id=device_id
+            result = db.session.execute(
+                insert_for(IgnoredFile).values(rows).on_conflict_do_nothing(
+                    index_elements=['device_id', 'original_path']
                 )
-                db.session.add(ignored_file)
-                ignored_count += 1
+            )
+            ignored_count += result.rowcount
         
         db.session.commit()
         
@@ -196,50 +796,80 @@ def ignore_file():
             'message': f'{ignored_count} files marked as ignored',
             'ignored_count': ignored_count
         }), 200
-        
+    
     except Exception as e:
+        db.session.rollback()
         return jsonify({
             'status': 'error',
             'message': f'Failed to ignore files: {str(e)}'
         }), 500
 
+@photos_bp.route('/unignore', methods=['POST'])
+def unignore_file():
+    """Removes files from the ignore list so they show up for backup again"""
+    data = request.json
+    
+    if not data or 'files' not in data or not data['files']:
+        return jsonify({
+            'status': 'error',
+            'message': 'No files provided to unignore'
+        }), 400
+    
+    device_id = data.get('device_id', 'unknown')
+    
+    try:
+        paths = list({file_data['path'] for file_data in data['files']})
+        
+        unignored_count = 0
+        for start in range(0, len(paths), PATH_LOOKUP_CHUNK_SIZE):
+            unignored_count += IgnoredFile.query.filter(
+                IgnoredFile.device_id == device_id,
+                IgnoredFile.original_path.in_(paths[start:start + PATH_LOOKUP_CHUNK_SIZE])
+            ).delete(synchronize_session=False)
+        
+        # The files are below the device's high-water mark, only a full scan sends them again
+        if unignored_count:
+            reset_sync_state([device_id])
+        db.session.commit()
+        
+        return jsonify({
+            'status': 'success',
+            'message': f'{unignored_count} files removed from the ignore list',
+            'unignored_count': unignored_count
+        }), 200
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to unignore files: {str(e)}'
+        }), 500
+
 @storage_bp.route('/status', methods=['GET'])
 def get_storage_status():
-    """Returns storage usage & available space"""
+    """Returns storage usage & available space, over all drives and per volume"""
     upload_folder = current_app.config['UPLOAD_FOLDER']
     
     try:
         # Create upload folder if it doesn't exist
         os.makedirs(upload_folder, exist_ok=True)
         
-        try:
-            total, used, free = shutil.disk_usage(upload_folder)
-        except OSError:
-            # Fallback values if we can't access the storage
-            total = 1000 * 1024 * 1024 * 1024  # 1000 GB
-            used = 0
-            free = total
-            
-        # Get total size of backed up files
-        total_backed_up = db.session.query(db.func.sum(Backup.file_size)).filter_by(
-            status='Completed'
-        ).scalar() or 0
-        
-        # Get backup count by type
-        photo_count = db.session.query(db.func.count(Backup.id)).filter_by(
-            status='Completed',
-            file_type='photo'
-        ).scalar() or 0
-        
-        video_count = db.session.query(db.func.count(Backup.id)).filter_by(
-            status='Completed',
-            file_type='video'
-        ).scalar() or 0
+        # A drive holding several volumes is counted once in the totals
+        total, used, free = total_usage()
+        volumes = [{
+            'name': volume['name'],
+            'total_bytes': volume['total'],
+            'used_bytes': volume['used'],
+            'free_bytes': volume['free'],
+            'usage_percent': round((volume['used'] / volume['total']) * 100, 2) if volume['total'] > 0 else 0
+        } for volume in volume_usage()]
         
-        # Get last backup timestamp
-        last_backup = db.session.query(db.func.max(Backup.timestamp)).filter_by(
-            status='Completed'
-        ).scalar()
+        # Running totals are kept up to date on every upload, no table scans needed
+        stats = get_stats()
+        total_backed_up = sum(row.total_size for row in stats.values())
+        photo_count = stats['photo'].file_count if 'photo' in stats else 0
+        video_count = stats['video'].file_count if 'video' in stats else 0
+        last_backup = max((row.last_backup for row in stats.values() if row.last_backup), default=None)
         
         return jsonify({
             'status': 'success',
@@ -250,7 +880,9 @@ def get_storage_status():
                 'total_human': format_size(total),
                 'used_human': format_size(used),
                 'free_human': format_size(free),
-                'usage_percent': round((used / total) * 100, 2) if total > 0 else 0
+                'usage_percent': round((used / total) * 100, 2) if total > 0 else 0,
+                'placement': current_app.config['STORAGE_PLACEMENT'],
+                'volumes': volumes
             },
             'backups': {
                 'total_size_bytes': total_backed_up,
@@ -261,7 +893,7 @@ def get_storage_status():
                 'last_backup': last_backup.isoformat() if last_backup else None
             }
         }), 200
-        
+    
     except Exception as e:
         # Return default values on error
         return jsonify({
@@ -294,13 +926,7 @@ def get_storage_usage():
         # Create upload folder if it doesn't exist
         os.makedirs(upload_folder, exist_ok=True)
         
-        try:
-            total, used, free = shutil.disk_usage(upload_folder)
-        except OSError:
-            # Fallback values if we can't access the storage
-            total = 1000 * 1024 * 1024 * 1024  # 1000 GB
-            used = 0
-            free = total
+        total, used, free = total_usage()
         
         return jsonify({
             'status': 'success',
@@ -308,7 +934,7 @@ def get_storage_usage():
             'total_bytes': total,
             'available_bytes': free
         }), 200
-        
+    
     except Exception as e:
         # Return default values on error
         return jsonify({
@@ -320,19 +946,30 @@ def get_storage_usage():
 
 @backup_bp.route('/log', methods=['GET'])
 def get_backup_logs():
-    """Returns logs of backed up files"""
-    limit = request.args.get('limit', 100, type=int)
-    offset = request.args.get('offset', 0, type=int)
+    """Returns logs of backed up files, newest first, one cursor page at a time"""
+    limit = max(1, min(request.args.get('limit', 100, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
     
     try:
-        backups = Backup.query.order_by(Backup.timestamp.desc()).limit(limit).offset(offset).all()
+        query = filter_backups(Backup.query, request.args)
         
-        return jsonify({
+        # Offset paging is kept for older clients, cursors stay fast on deep pages
+        cursor = request.args.get('cursor')
+        backups, next_cursor = paginate_backups(query, limit, cursor, offset=0 if cursor else offset)
+        
+        return list_response({
             'status': 'success',
             'backups': [backup.to_dict() for backup in backups],
-            'count': len(backups)
-        }), 200
-        
+            'count': len(backups),
+            'next_cursor': next_cursor
+        }, ['backups'])
+    
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
     except Exception as e:
         return jsonify({
             'status': 'error',
@@ -342,12 +979,15 @@ def get_backup_logs():
 @backup_bp.route('/history', methods=['GET'])
 def get_backup_history():
     """Returns backup history"""
+    limit = max(1, min(request.args.get('limit', 100, type=int), MAX_PAGE_SIZE))
+    
     try:
-        # Get the last 100 successful backups
-        backups = Backup.query.filter_by(status='Completed')\
-            .order_by(Backup.timestamp.desc())\
-            .limit(100)\
-            .all()
+        # Successful backups unless another status is asked for
+        args = request.args.copy()
+        args.setdefault('status', 'Completed')
+        query = filter_backups(Backup.query, args)
+        
+        backups, next_cursor = paginate_backups(query, limit, request.args.get('cursor'))
         
         history = [{
             'id': backup.id,
@@ -359,17 +999,325 @@ def get_backup_history():
             'status': backup.status
         } for backup in backups]
         
+        return list_response({
+            'status': 'success',
+            'history': history,
+            'next_cursor': next_cursor
+        }, ['history'])
+    
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to fetch backup history: {str(e)}'
+        }), 500
+
+@backup_bp.route('/archive', methods=['GET'])
+def get_backup_archive():
+    """Streams a tar or zip of the completed backups of a device or date range, for restores"""
+    fmt = request.args.get('format', 'tar')
+    if fmt not in ARCHIVE_FORMATS:
+        return jsonify({
+            'status': 'error',
+            'message': f"format must be one of {', '.join(ARCHIVE_FORMATS)}"
+        }), 400
+    
+    try:
+        args = request.args.copy()
+        args.pop('status', None)
+        query = filter_backups(Backup.query, args)
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor) if cursor else None
+    
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
+    # Built while it is sent, a restore interrupted midway resumes with the cursor of the last complete entry
+    name = secure_filename(f"iclood-{request.args.get('device_id') or 'all'}.{fmt}")
+    response = current_app.response_class(
+        stream_with_context(stream_archive(query, fmt, after, encode_cursor)),
+        mimetype=ARCHIVE_FORMATS[fmt]
+    )
+    response.headers.set('Content-Disposition', 'attachment', filename=name)
+    return response
+
+# Upper bound on rows returned by one page of /backup/log or /backup/history
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(backup):
+    """Returns an opaque cursor pointing just after the given backup"""
+    raw = f"{backup.timestamp.isoformat()}|{backup.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    """Returns the (timestamp, id) position encoded in a cursor"""
+    try:
+        timestamp, backup_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(timestamp), int(backup_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+def parse_date_arg(value, name):
+    """Parses an ISO 8601 query argument into a naive UTC datetime"""
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Invalid {name} date: {value}')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.UTC).replace(tzinfo=None)
+    return parsed
+
+def filter_backups(query, args):
+    """Applies the device, file type, status and date range filters from the query string"""
+    for key in ('device_id', 'file_type', 'status'):
+        if args.get(key):
+            query = query.filter(getattr(Backup, key) == args[key])
+    if args.get('since'):
+        query = query.filter(Backup.timestamp >= parse_date_arg(args['since'], 'since'))
+    if args.get('until'):
+        query = query.filter(Backup.timestamp < parse_date_arg(args['until'], 'until'))
+    return query
+
+def paginate_backups(query, limit, cursor=None, offset=0):
+    """Returns one page of backups, newest first, and the cursor for the next page"""
+    if cursor:
+        timestamp, backup_id = decode_cursor(cursor)
+        query = query.filter(db.tuple_(Backup.timestamp, Backup.id) < db.tuple_(timestamp, backup_id))
+    
+    query = query.order_by(Backup.timestamp.desc(), Backup.id.desc())
+    if offset:
+        query = query.offset(offset)
+    
+    # Fetch one extra row to know whether another page exists
+    backups = query.limit(limit + 1).all()
+    if len(backups) <= limit:
+        return backups, None
+    backups = backups[:limit]
+    return backups, encode_cursor(backups[-1])
+
+@jobs_bp.route('/status', methods=['GET'])
+def get_job_status():
+    """Returns the depth of the post-processing queue per job type"""
+    try:
+        depth, oldest_pending_age = queue_depth()
+        
         return jsonify({
             'status': 'success',
-            'history': history
+            'queues': depth,
+            'pending_total': sum(counts['Pending'] for counts in depth.values()),
+            'oldest_pending_seconds': round(oldest_pending_age, 1)
         }), 200
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to get job status: {str(e)}'
+        }), 500
+
+@admin_bp.route('/profiles', methods=['GET'])
+def get_profiles():
+    """Returns the saved slow-request profiles, newest first"""
+    try:
+        profiles = list_profiles(profile_folder(current_app))
         
+        return jsonify({
+            'status': 'success',
+            'profiles': profiles,
+            'count': len(profiles)
+        }), 200
+    
     except Exception as e:
         return jsonify({
             'status': 'error',
-            'message': f'Failed to fetch backup history: {str(e)}'
+            'message': f'Failed to list profiles: {str(e)}'
+        }), 500
+
+@admin_bp.route('/profiles/<name>', methods=['GET'])
+def get_profile(name):
+    """Downloads a saved profile, or a text report of it with ?format=text"""
+    folder = profile_folder(current_app)
+    if not PROFILE_NAME.match(name) or not os.path.isfile(os.path.join(folder, name)):
+        return jsonify({
+            'status': 'error',
+            'message': 'Profile not found'
+        }), 404
+    
+    if request.args.get('format') == 'text':
+        sort = request.args.get('sort', 'cumulative')
+        if sort not in PROFILE_SORT_KEYS:
+            return jsonify({
+                'status': 'error',
+                'message': f"sort must be one of {', '.join(PROFILE_SORT_KEYS)}"
+            }), 400
+        
+        report = profile_summary(os.path.join(folder, name), sort, request.args.get('limit', 50, type=int))
+        return current_app.response_class(report, mimetype='text/plain')
+    
+    # Open with `python -m pstats <file>` or a viewer such as snakeviz
+    return send_from_directory(folder, name, as_attachment=True, mimetype='application/octet-stream')
+
+@admin_bp.route('/scrub', methods=['POST'])
+def start_integrity_scrub():
+    """Queues an integrity scrub now, or brings the scheduled one forward"""
+    try:
+        run = start_scrub()
+        db.session.commit()
+        
+        return jsonify({
+            'status': 'success',
+            'message': f'Scrub {run.id} queued',
+            'run': run.to_dict()
+        }), 202
+    
+    except ScrubInProgress as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to start scrub: {str(e)}'
         }), 500
 
+@admin_bp.route('/scrub', methods=['GET'])
+def get_integrity_scrub():
+    """Returns the progress of the latest scrub, or of ?run_id, with the problems it found"""
+    try:
+        run_id = request.args.get('run_id', type=int)
+        run = db.session.get(ScrubRun, run_id) if run_id else latest_run()
+        if run_id and run is None:
+            return jsonify({
+                'status': 'error',
+                'message': 'Scrub not found'
+            }), 404
+        
+        next_run = ScrubRun.query.filter_by(status='Pending').order_by(ScrubRun.id).first()
+        findings = []
+        if run is not None:
+            limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+            findings = ScrubFinding.query.filter_by(run_id=run.id).order_by(ScrubFinding.id).limit(limit).all()
+        
+        return jsonify({
+            'status': 'success',
+            'run': run.to_dict() if run else None,
+            'next_run_at': next_run.scheduled_at.isoformat() if next_run else None,
+            'findings': [finding.to_dict() for finding in findings]
+        }), 200
+    
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to get scrub status: {str(e)}'
+        }), 500
+
+@admin_bp.route('/prune', methods=['POST'])
+def prune_backups():
+    """Reports what a pruning policy would reclaim, or queues it with "dry_run": false"""
+    data = request.get_json(silent=True) or {}
+    dry_run = data.get('dry_run', True) is not False
+    
+    try:
+        policy_data = {key: value for key, value in data.items() if key != 'dry_run'}
+        policy = parse_policy(policy_data) if policy_data else configured_policy()
+    except ValueError as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 400
+    
+    if policy is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'No pruning policy given and none configured'
+        }), 400
+    
+    try:
+        if dry_run:
+            report = prune(policy, dry_run=True)
+            db.session.rollback()
+            return jsonify({
+                'status': 'success',
+                'report': report
+            }), 200
+        
+        # Deleting runs on the prune worker, uploads carry on meanwhile
+        job = enqueue('prune', {'policy': policy})
+        db.session.commit()
+        return jsonify({
+            'status': 'success',
+            'message': 'Prune queued',
+            'job_id': job.id
+        }), 202
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to prune backups: {str(e)}'
+        }), 500
+
+@admin_bp.route('/rebalance', methods=['POST'])
+def rebalance_volumes():
+    """Queues moving backups from the fullest drive to the emptiest"""
+    try:
+        plan = rebalance_plan()
+        if plan is None:
+            return jsonify({
+                'status': 'success',
+                'message': 'The drives are already balanced'
+            }), 200
+        
+        source, target, to_move = plan
+        job = queue_rebalance()
+        db.session.commit()
+        return jsonify({
+            'status': 'success',
+            'message': f'Rebalance queued from {source} to {target}',
+            'job_id': job.id,
+            'bytes_to_move': to_move
+        }), 202
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({
+            'status': 'error',
+            'message': f'Failed to rebalance volumes: {str(e)}'
+        }), 500
+
+# Thumbnails never change for a given backup, let clients cache them for a month
+THUMBNAIL_MAX_AGE = 30 * 24 * 60 * 60
+
+# Orderings accepted for the text report of a profile
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls')
+
+# Maximum number of bound parameters per IN (...) lookup
+PATH_LOOKUP_CHUNK_SIZE = 1000
+
+# Maximum number of rows per multi-row INSERT
+INSERT_CHUNK_SIZE = 1000
+
+def find_known_paths(model, device_id, paths, **filters):
+    """Returns the subset of paths recorded in model's table for the device"""
+    known = set()
+    for start in range(0, len(paths), PATH_LOOKUP_CHUNK_SIZE):
+        chunk = paths[start:start + PATH_LOOKUP_CHUNK_SIZE]
+        rows = db.session.query(model.original_path).filter(
+            model.device_id == device_id,
+            model.original_path.in_(chunk)
+        ).filter_by(**filters)
+        known.update(row[0] for row in rows)
+    return known
+
 # Helper function for formatting file sizes
 def format_size(size_bytes):
     """Format bytes to human readable string"""
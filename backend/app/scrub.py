@@ -0,0 +1,255 @@
+import os
+import time
+import logging
+import datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import update
+from .jobs import enqueue, job_handler, utcnow
+from .models import Backup, Blob, Job, ScrubFinding, ScrubRun, insert_for
+from .storage import VolumeUnavailable, relocate_blob, stored_file_exists, stored_path, volume_folder
+from .sync import reset_sync_state
+from .uploads import STREAM_BUFFER_SIZE, new_hasher
+from . import db
+
+logger = logging.getLogger(__name__)
+
+class ScrubInProgress(Exception):
+    """Raised when a pass is requested while another one is running"""
+
+def quarantine_folder(volume):
+    """Returns the folder a volume's corrupt files are moved to, on the same drive"""
+    folder = os.path.join(volume_folder(volume), '.quarantine')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def read_checksum(file_path, max_bytes_per_second):
+    """Hashes a stored file no faster than max_bytes_per_second (0 for no limit), returns (hash, bytes read)"""
+    hasher = new_hasher()
+    read = 0
+    started = time.monotonic()
+    with open(file_path, 'rb') as stored:
+        while True:
+            block = stored.read(STREAM_BUFFER_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+            read += len(block)
+            if max_bytes_per_second:
+                ahead = read / max_bytes_per_second - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        
+        # A pass reads the whole library once, keep it from evicting what uploads and thumbnails use
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(stored.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return hasher.hexdigest(), read
+
+def start_scrub(scheduled_at=None):
+    """Creates a pass and queues its first batch, or brings a scheduled one forward (caller commits)"""
+    running = ScrubRun.query.filter_by(status='Running').first()
+    if running is not None:
+        if Job.query.filter(Job.job_type == 'scrub', Job.status.in_(['Pending', 'Running'])).first():
+            raise ScrubInProgress(f'Scrub {running.id} is already running')
+        # Its batches gave up after repeated errors, carry on from its cursor
+        enqueue('scrub', {'run_id': running.id})
+        return running
+    
+    now = utcnow()
+    run = ScrubRun.query.filter_by(status='Pending').order_by(ScrubRun.id).first()
+    if run is not None:
+        run.scheduled_at = scheduled_at or now
+        db.session.execute(
+            update(Job)
+            .where(Job.job_type == 'scrub', Job.status == 'Pending')
+            .values(run_after=run.scheduled_at)
+        )
+        return run
+    
+    run = ScrubRun(status='Pending', scheduled_at=scheduled_at or now)
+    db.session.add(run)
+    db.session.flush()
+    job = enqueue('scrub', {'run_id': run.id})
+    job.run_after = run.scheduled_at
+    return run
+
+def latest_run():
+    """Returns the most recent pass that has started, or None"""
+    return ScrubRun.query.filter(ScrubRun.started_at.isnot(None)).order_by(ScrubRun.id.desc()).first()
+
+def record_problem(run, backups, problem, volume, file_path, expected_hash, actual_hash=None):
+    """Marks the backups of a missing or corrupt file as Failed so devices upload them again"""
+    for backup in backups:
+        backup.status = 'Failed'
+        db.session.add(ScrubFinding(
+            run_id=run.id,
+            backup_id=backup.id,
+            file_path=backup.file_path,
+            problem=problem,
+            expected_hash=expected_hash,
+            actual_hash=actual_hash
+        ))
+    # Devices consider these files safe, make them scan their whole library again
+    reset_sync_state(backup.device_id for backup in backups)
+    
+    if problem == 'missing':
+        run.missing_files += len(backups)
+        return
+    run.corrupt_files += len(backups)
+    
+    # The blob keeps pointing at a path with no file, so the next upload of the content restores it
+    source = stored_path(volume, file_path)
+    try:
+        os.replace(source, os.path.join(quarantine_folder(volume), file_path.replace(os.sep, '_')))
+    except OSError as e:
+        logger.warning(f"Could not quarantine corrupt file {source}: {e}")
+    logger.warning(f"Scrub {run.id} found {file_path} corrupt, {len(backups)} backups marked Failed")
+
+def check_backup(run, backup):
+    """Re-reads the file of one completed backup and records what was found"""
+    blob = db.session.get(Blob, backup.content_hash) if backup.content_hash else None
+    if blob is not None and blob.verified_at is not None and blob.verified_at >= run.started_at:
+        # Content shared with a backup already checked in this pass
+        return
+    
+    volume = blob.volume if blob else backup.volume
+    file_path = blob.file_path if blob else backup.file_path
+    expected_hash = backup.content_hash
+    expected_size = blob.file_size if blob else backup.file_size
+    try:
+        absolute_path = stored_path(volume, file_path)
+    except VolumeUnavailable as e:
+        # The drive was taken out of STORAGE_VOLUMES, its files aren't known to be lost
+        logger.warning(f"Scrub {run.id} skipped {file_path}: {e}")
+        return
+    
+    # Don't hold a pooled connection while reading the drive
+    db.session.commit()
+    
+    actual_hash = None
+    try:
+        actual_size = os.path.getsize(absolute_path)
+        if actual_size == expected_size:
+            actual_hash, actual_size = read_checksum(
+                absolute_path, current_app.config['SCRUB_MAX_MBPS'] * 1024 * 1024
+            )
+        problem = None if actual_size == expected_size else 'corrupt'
+    except FileNotFoundError:
+        problem = 'missing'
+        actual_size = 0
+    except OSError as e:
+        # Read errors on a USB drive usually mean bad sectors, the copy can't be trusted
+        logger.warning(f"Could not read {absolute_path}: {e}")
+        problem = 'corrupt'
+        actual_size = 0
+    
+    run.checked_bytes += actual_size
+    if problem is None and expected_hash is not None and actual_hash != expected_hash:
+        problem = 'corrupt'
+    
+    if problem is not None:
+        if blob is not None:
+            backups = Backup.query.filter_by(content_hash=blob.hash, status='Completed').all()
+        else:
+            backups = [backup]
+        record_problem(run, backups, problem, volume, file_path, expected_hash, actual_hash)
+    elif blob is not None:
+        blob.verified_at = utcnow()
+    else:
+        # Backups from before content addressing get their checksum now
+        result = db.session.execute(
+            insert_for(Blob).values(
+                hash=actual_hash, volume=volume, file_path=file_path, file_size=actual_size, verified_at=utcnow()
+            ).on_conflict_do_nothing(index_elements=['hash'])
+        )
+        backup.content_hash = actual_hash
+        run.hashed_files += 1
+        if result.rowcount == 0:
+            adopt_duplicate(run, db.session.get(Blob, actual_hash), volume, file_path)
+
+def adopt_duplicate(run, blob, volume, file_path):
+    """Keeps one copy when an old backup's file turns out to hold a blob's content"""
+    if (blob.volume, blob.file_path) == (volume, file_path):
+        return
+    if not stored_file_exists(blob.volume, blob.file_path):
+        # The blob lost its file, this copy takes its place
+        relocate_blob(blob, volume, file_path)
+        return
+    
+    # Every old backup sharing the file moves to the blob's copy, then the duplicate goes
+    db.session.execute(
+        update(Backup)
+        .where(Backup.volume == volume, Backup.file_path == file_path, Backup.content_hash.is_(None))
+        .values(content_hash=blob.hash)
+    )
+    db.session.execute(
+        update(Backup)
+        .where(Backup.volume == volume, Backup.file_path == file_path, Backup.content_hash == blob.hash)
+        .values(volume=blob.volume, file_path=blob.file_path)
+    )
+    db.session.commit()
+    try:
+        os.remove(stored_path(volume, file_path))
+    except OSError as e:
+        logger.warning(f"Scrub {run.id} could not remove duplicate {file_path}: {e}")
+
+@job_handler('scrub')
+def scrub_batch(payload):
+    """Job handler that checks the next batch of backups of a pass, then queues the rest"""
+    run = db.session.get(ScrubRun, payload['run_id'])
+    if run is None or run.status == 'Completed':
+        return
+    
+    if run.status == 'Pending':
+        run.status = 'Running'
+        run.started_at = utcnow()
+        run.total_files = Backup.query.filter_by(status='Completed').count()
+        db.session.commit()
+    
+    config = current_app.config
+    deadline = time.monotonic() + config['SCRUB_BATCH_SECONDS']
+    backup_ids = [row[0] for row in db.session.query(Backup.id).filter(
+        Backup.status == 'Completed',
+        Backup.id > run.last_backup_id
+    ).order_by(Backup.id).limit(config['SCRUB_BATCH_SIZE'])]
+    
+    more = len(backup_ids) == config['SCRUB_BATCH_SIZE']
+    for backup_id in backup_ids:
+        backup = db.session.get(Backup, backup_id)
+        # An earlier check in this pass may have failed the backup through shared content
+        if backup is not None and backup.status == 'Completed':
+            check_backup(run, backup)
+        run.checked_files += 1
+        run.last_backup_id = backup_id
+        run.updated_at = utcnow()
+        
+        # Every file is committed on its own, a restart resumes right after it
+        db.session.commit()
+        if time.monotonic() > deadline and backup_id != backup_ids[-1]:
+            more = True
+            break
+    
+    if more:
+        enqueue('scrub', {'run_id': run.id})
+        return
+    
+    run.status = 'Completed'
+    run.finished_at = utcnow()
+    logger.info(
+        f"Scrub {run.id} checked {run.checked_files} backups: "
+        f"{run.missing_files} missing, {run.corrupt_files} corrupt"
+    )
+    if config['SCRUB_INTERVAL_DAYS']:
+        start_scrub(utcnow() + datetime.timedelta(days=config['SCRUB_INTERVAL_DAYS']))
+
+@click.command('scrub')
+@with_appcontext
+def scrub_command():
+    """Queue an integrity scrub of the stored backups."""
+    try:
+        run = start_scrub()
+    except ScrubInProgress as e:
+        raise click.ClickException(str(e))
+    db.session.commit()
+    click.echo(f'Scrub {run.id} queued, the scrub worker will run it')
@@ -0,0 +1,173 @@
+import time
+import shutil
+import threading
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from .models import Backup, BackupStats, insert_for
+from . import db
+
+# Fallback values if we can't access the storage
+DEFAULT_DISK_TOTAL = 1000 * 1024 * 1024 * 1024  # 1000 GB
+
+_disk_usage_cache = {}
+_disk_usage_lock = threading.Lock()
+
+def disk_usage(path):
+    """Returns (total, used, free) for path, cached for DISK_USAGE_TTL seconds"""
+    ttl = current_app.config['DISK_USAGE_TTL']
+    now = time.monotonic()
+    
+    with _disk_usage_lock:
+        cached = _disk_usage_cache.get(path)
+        if cached and now - cached[0] < ttl:
+            return cached[1]
+    
+    try:
+        usage = tuple(shutil.disk_usage(path))
+    except OSError:
+        usage = (DEFAULT_DISK_TOTAL, 0, DEFAULT_DISK_TOTAL)
+    
+    with _disk_usage_lock:
+        _disk_usage_cache[path] = (now, usage)
+    return usage
+
+def invalidate_disk_usage():
+    """Drops cached disk usage so the next read hits the filesystem"""
+    with _disk_usage_lock:
+        _disk_usage_cache.clear()
+
+def get_stats():
+    """Returns the running totals keyed by file type"""
+    rows = BackupStats.query.all()
+    if not rows and db.session.query(Backup.id).filter_by(status='Completed').first():
+        # Totals were never built for this library, seed them once
+        rebuild_stats()
+        db.session.commit()
+        rows = BackupStats.query.all()
+    return {row.file_type: row for row in rows}
+
+def rebuild_stats():
+    """Recomputes the running totals from the backups table (caller commits)"""
+    totals = db.session.query(
+        Backup.file_type,
+        db.func.count(Backup.id),
+        db.func.coalesce(db.func.sum(Backup.file_size), 0),
+        db.func.max(Backup.timestamp)
+    ).filter_by(status='Completed').group_by(Backup.file_type).all()
+    
+    db.session.query(BackupStats).filter(
+        BackupStats.file_type.notin_([row[0] for row in totals])
+    ).delete(synchronize_session=False)
+    
+    for file_type, file_count, total_size, last_backup in totals:
+        values = {
+            'file_type': file_type,
+            'file_count': file_count,
+            'total_size': total_size,
+            'last_backup': last_backup
+        }
+        db.session.execute(
+            insert_for(BackupStats).values(values).on_conflict_do_update(
+                index_elements=['file_type'], set_=values
+            )
+        )
+
+def _apply_deltas(connection, deltas):
+    """Adds per file type deltas to the totals in one statement each"""
+    table = BackupStats.__table__
+    for file_type, (count, size, last_backup) in deltas.items():
+        statement = insert_for(BackupStats).values(
+            file_type=file_type,
+            file_count=count,
+            total_size=size,
+            last_backup=last_backup
+        )
+        excluded = statement.excluded
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['file_type'],
+            set_={
+                'file_count': table.c.file_count + excluded.file_count,
+                'total_size': table.c.total_size + excluded.total_size,
+                'last_backup': db.case(
+                    (excluded.last_backup.is_(None), table.c.last_backup),
+                    (table.c.last_backup > excluded.last_backup, table.c.last_backup),
+                    else_=excluded.last_backup
+                )
+            }
+        ))
+
+def subtract_deleted(backups):
+    """Takes completed backups removed by a bulk DELETE off the running totals (caller commits)"""
+    deltas = {}
+    for backup in backups:
+        count, size, _ = deltas.get(backup.file_type, (0, 0, None))
+        deltas[backup.file_type] = (count - 1, size - (backup.file_size or 0), None)
+    if deltas:
+        _apply_deltas(db.session.connection(), deltas)
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    """No-op, registered only to turn on active history"""
+
+# Without active history, setting an expired attribute (e.g. after a commit)
+# keeps no old value and the flush hook could not undo the previous totals
+for _attribute in (Backup.status, Backup.file_size, Backup.file_type):
+    event.listen(_attribute, 'set', _load_previous_value, active_history=True)
+
+def _previous_value(state, key):
+    """Returns an attribute's value as it was before the flush"""
+    history = state.attrs[key].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(state.object, key)
+
+@event.listens_for(Session, 'after_flush')
+def track_backup_changes(session, flush_context):
+    """Keeps the running totals in step with every flushed change to completed backups"""
+    deltas = {}
+    
+    def add(file_type, count, size, timestamp=None):
+        current = deltas.get(file_type, (0, 0, None))
+        latest = current[2]
+        if timestamp is not None and timestamp.tzinfo is not None:
+            # Columns are naive UTC, new rows may still carry an aware value
+            timestamp = timestamp.replace(tzinfo=None)
+        if timestamp is not None and (latest is None or timestamp > latest):
+            latest = timestamp
+        deltas[file_type] = (current[0] + count, current[1] + size, latest)
+    
+    for obj in session.new:
+        if isinstance(obj, Backup) and obj.status == 'Completed':
+            add(obj.file_type, 1, obj.file_size or 0, obj.timestamp)
+    
+    for obj in session.dirty:
+        if not isinstance(obj, Backup):
+            continue
+        state = inspect(obj)
+        if not any(state.attrs[key].history.has_changes() for key in ('status', 'file_size', 'file_type')):
+            continue
+        if _previous_value(state, 'status') == 'Completed':
+            add(_previous_value(state, 'file_type'), -1, -(_previous_value(state, 'file_size') or 0))
+        if obj.status == 'Completed':
+            add(obj.file_type, 1, obj.file_size or 0, obj.timestamp)
+    
+    # Deletes cannot lower last_backup, a rebuild recomputes it exactly
+    for obj in session.deleted:
+        if isinstance(obj, Backup) and _previous_value(inspect(obj), 'status') == 'Completed':
+            add(_previous_value(inspect(obj), 'file_type'), -1, -(_previous_value(inspect(obj), 'file_size') or 0))
+    
+    deltas = {key: value for key, value in deltas.items() if value[0] or value[1] or value[2]}
+    if deltas:
+        _apply_deltas(session.connection(), deltas)
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    """Recompute storage statistics from the backups table."""
+    rebuild_stats()
+    db.session.commit()
+    click.echo('Storage statistics rebuilt')
@@ -0,0 +1,371 @@
+import os
+import time
+import errno
+import datetime
+import shutil
+import hashlib
+import logging
+import tempfile
+import itertools
+import threading
+import contextlib
+from collections import namedtuple
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import update
+from .jobs import enqueue, job_handler, utcnow
+from .models import Backup, Blob, Job
+from .stats import disk_usage, invalidate_disk_usage
+from . import db
+
+logger = logging.getLogger(__name__)
+
+# The volume at UPLOAD_FOLDER, where everything stored before volumes existed lives
+DEFAULT_VOLUME = 'default'
+
+PLACEMENT_POLICIES = {}
+
+VolumeSpace = namedtuple('VolumeSpace', ['name', 'folder', 'free'])
+
+# Writes in progress per volume in this process, so parallel uploads go to different drives
+_writes_in_flight = {}
+_writes_lock = threading.Lock()
+_round_robin = itertools.count()
+
+# Bytes of backups per volume, summed from the blobs table
+_stored_bytes_cache = {}
+_stored_bytes_lock = threading.Lock()
+
+# A rebalance that moved nothing waits this long before trying again
+REBALANCE_RETRY_HOURS = 24
+
+class VolumeUnavailable(OSError):
+    """Raised for a file on a volume that is no longer in STORAGE_VOLUMES"""
+
+def configured_volumes():
+    """Returns {name: folder} for the default volume and every STORAGE_VOLUMES entry"""
+    volumes = {DEFAULT_VOLUME: current_app.config['UPLOAD_FOLDER']}
+    for entry in current_app.config['STORAGE_VOLUMES'].split(','):
+        if not entry.strip():
+            continue
+        name, separator, folder = entry.partition('=')
+        if not separator or not name.strip() or not folder.strip():
+            raise ValueError(f'STORAGE_VOLUMES entries look like name=/mnt/drive/iclood, got "{entry}"')
+        volumes[name.strip()] = folder.strip()
+    return volumes
+
+def volume_folder(volume):
+    """Returns the root folder of a volume"""
+    volumes = configured_volumes()
+    if volume not in volumes:
+        raise VolumeUnavailable(f'Storage volume {volume} is not configured')
+    return volumes[volume]
+
+def stored_path(volume, file_path):
+    """Returns the absolute path of a stored file from its volume and relative path"""
+    return os.path.join(volume_folder(volume), file_path)
+
+def stored_file_exists(volume, file_path):
+    """Returns whether a stored file is there, False when its volume is gone"""
+    try:
+        return os.path.exists(stored_path(volume, file_path))
+    except VolumeUnavailable:
+        return False
+
+def placement_policy(name):
+    """Registers a function choosing a volume for new content under STORAGE_PLACEMENT=name.
+    
+    It is called with the VolumeSpace of every volume with room for the file,
+    and the content hash when it is already known, and returns one of them.
+    """
+    def register(func):
+        PLACEMENT_POLICIES[name] = func
+        return func
+    return register
+
+@placement_policy('free_space')
+def place_by_free_space(volumes, content_hash):
+    """Picks the drive with the fewest writes in progress, then the most free space"""
+    with _writes_lock:
+        busy = dict(_writes_in_flight)
+    return min(volumes, key=lambda volume: (busy.get(volume.name, 0), -volume.free))
+
+@placement_policy('round_robin')
+def place_round_robin(volumes, content_hash):
+    """Cycles through the drives"""
+    return volumes[next(_round_robin) % len(volumes)]
+
+@placement_policy('hash')
+def place_by_hash(volumes, content_hash):
+    """Picks a drive from the content hash by rendezvous hashing, so adding a drive moves few files"""
+    if content_hash is None:
+        return place_by_free_space(volumes, content_hash)
+    return max(volumes, key=lambda volume: hashlib.sha256(f'{volume.name}:{content_hash}'.encode()).digest())
+
+def choose_volume(file_size=0, content_hash=None):
+    """Returns the volume new content goes to under the STORAGE_PLACEMENT policy"""
+    volumes = configured_volumes()
+    if len(volumes) == 1:
+        return DEFAULT_VOLUME
+    
+    reserve = current_app.config['STORAGE_RESERVE_MB'] * 1024 * 1024
+    spaces = [VolumeSpace(volume['name'], volume['folder'], volume['free']) for volume in volume_usage()]
+    with_room = [space for space in spaces if space.free - (file_size or 0) > reserve]
+    if not with_room:
+        # Every drive is nearly full, the emptiest one gets it
+        return max(spaces, key=lambda space: space.free).name
+    return PLACEMENT_POLICIES[current_app.config['STORAGE_PLACEMENT']](with_room, content_hash).name
+
+@contextlib.contextmanager
+def writing_to(volume):
+    """Counts a write in progress on a volume for the free_space policy"""
+    with _writes_lock:
+        _writes_in_flight[volume] = _writes_in_flight.get(volume, 0) + 1
+    try:
+        yield
+    finally:
+        with _writes_lock:
+            _writes_in_flight[volume] -= 1
+
+def candidate_paths(file_path, content_hash):
+    """Yields names for a stored file, its own first, then suffixed with its content hash"""
+    yield file_path
+    stem, ext = os.path.splitext(file_path)
+    yield f'{stem}_{content_hash[:12]}{ext}'
+    for n in itertools.count(2):
+        yield f'{stem}_{content_hash[:12]}_{n}{ext}'
+
+def place_file(source_path, volume, file_path, content_hash):
+    """Moves a file into a volume under the first free name for it, returns that name.
+    
+    The name is claimed with O_EXCL before the file is renamed over the claim, so
+    concurrent uploads never overwrite each other's files. A rename on the same
+    drive, a copy across drives.
+    """
+    for candidate in candidate_paths(file_path, content_hash):
+        target_path = stored_path(volume, candidate)
+        try:
+            os.close(os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            continue
+        try:
+            move_over(source_path, target_path)
+        except BaseException:
+            os.remove(target_path)
+            raise
+        return candidate
+
+def move_over(source_path, target_path):
+    """Renames a file over target_path, copying it first when it is on another drive"""
+    try:
+        os.replace(source_path, target_path)
+    except OSError as e:
+        # The staging file is on another drive
+        if e.errno != errno.EXDEV:
+            raise
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix='.part')
+        os.close(fd)
+        try:
+            shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, target_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        os.remove(source_path)
+
+def relocate_blob(blob, volume, file_path):
+    """Points a blob and every backup of its content at a new copy (caller commits)"""
+    blob.volume = volume
+    blob.file_path = file_path
+    db.session.execute(
+        update(Backup)
+        .where(Backup.content_hash == blob.hash)
+        .values(volume=volume, file_path=file_path)
+    )
+
+def volume_usage():
+    """Returns the disk usage of every volume, and the id of the drive it is on.
+    
+    A volume whose folder can't be read, such as an unplugged drive, reports no space.
+    """
+    usage = []
+    for name, folder in configured_volumes().items():
+        # UPLOAD_FOLDER is created on first use, the other drives must be mounted
+        if name == DEFAULT_VOLUME:
+            os.makedirs(folder, exist_ok=True)
+        try:
+            total, used, free = disk_usage(folder)
+            device = os.stat(folder).st_dev
+        except OSError as e:
+            logger.warning(f"Can't read the space on volume {name} at {folder}: {e}")
+            total, used, free, device = 0, 0, 0, folder
+        usage.append({'name': name, 'folder': folder, 'device': device, 'total': total, 'used': used, 'free': free})
+    return usage
+
+def total_usage():
+    """Returns (total, used, free) over every drive holding a volume, each drive counted once"""
+    drives = {volume['device']: volume for volume in volume_usage()}
+    return tuple(sum(volume[key] for volume in drives.values()) for key in ('total', 'used', 'free'))
+
+def stored_bytes():
+    """Returns {volume: bytes of backups stored on it}, cached for DISK_USAGE_TTL seconds"""
+    now = time.monotonic()
+    with _stored_bytes_lock:
+        cached = _stored_bytes_cache.get('volumes')
+        if cached and now - cached[0] < current_app.config['DISK_USAGE_TTL']:
+            return cached[1]
+    
+    totals = dict(
+        db.session.query(Blob.volume, db.func.coalesce(db.func.sum(Blob.file_size), 0)).group_by(Blob.volume).all()
+    )
+    with _stored_bytes_lock:
+        _stored_bytes_cache['volumes'] = (now, totals)
+    return totals
+
+def rebalance_plan():
+    """Returns (source, target, bytes to move) to even out the fullest and emptiest drives, or None.
+    
+    A drive's fill is the backups stored on it over what it could hold, those
+    plus its free space, so other files on the drive don't count.
+    """
+    stored = stored_bytes()
+    drives = {}
+    for volume in volume_usage():
+        if volume['total'] <= 0:
+            continue
+        drive = drives.setdefault(volume['device'], {'names': [], 'stored': 0, 'free': volume['free']})
+        drive['names'].append(volume['name'])
+        drive['stored'] += stored.get(volume['name'], 0)
+    drives = [drive for drive in drives.values() if drive['stored'] + drive['free'] > 0]
+    if len(drives) < 2:
+        return None
+    
+    capacity = lambda drive: drive['stored'] + drive['free']
+    fill = lambda drive: drive['stored'] / capacity(drive)
+    source = max(drives, key=fill)
+    target = min(drives, key=fill)
+    if (fill(source) - fill(target)) * 100 <= current_app.config['STORAGE_REBALANCE_SPREAD_PERCENT']:
+        return None
+    
+    # Moving x bytes leaves both drives equally full: (stored_s - x) / capacity_s == (stored_t + x) / capacity_t
+    to_move = (source['stored'] * capacity(target) - target['stored'] * capacity(source)) / (
+        capacity(source) + capacity(target)
+    )
+    source_name = max(source['names'], key=lambda name: stored.get(name, 0))
+    return source_name, target['names'][0], int(to_move)
+
+def move_blob(blob, volume):
+    """Copies a blob to another volume, repoints its backups, then removes the old copy.
+    
+    Returns the bytes moved, 0 when the stored file is missing.
+    """
+    source_path = stored_path(blob.volume, blob.file_path)
+    target_folder = os.path.dirname(stored_path(volume, blob.file_path))
+    
+    # Don't hold a pooled connection while the file is copied
+    db.session.commit()
+    
+    os.makedirs(target_folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=target_folder, suffix='.part')
+    os.close(fd)
+    try:
+        shutil.copyfile(source_path, temp_path)
+        with open(temp_path, 'rb') as copied:
+            os.fsync(copied.fileno())
+        if os.path.getsize(temp_path) != blob.file_size:
+            raise OSError(f'Copy of {source_path} has the wrong size')
+        file_path = place_file(temp_path, volume, blob.file_path, blob.hash)
+    except FileNotFoundError:
+        # The scrub finds missing files, there is nothing to move
+        return 0
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    
+    relocate_blob(blob, volume, file_path)
+    db.session.commit()
+    try:
+        os.remove(source_path)
+    except OSError as e:
+        logger.warning(f"Could not remove {source_path} after moving it: {e}")
+    return blob.file_size
+
+def pending_rebalance():
+    """Returns the queued or running rebalance job, if any"""
+    return Job.query.filter(Job.job_type == 'rebalance', Job.status.in_(['Pending', 'Running'])).first()
+
+def request_rebalance_if_uneven():
+    """Queues a rebalance when the drives' fill levels drift apart, committed with the upload"""
+    # A rebalance that is stuck waits as a delayed job, so uploads don't restart it
+    if len(configured_volumes()) == 1 or pending_rebalance() is not None:
+        return
+    if rebalance_plan() is not None:
+        enqueue('rebalance', {})
+
+def queue_rebalance():
+    """Queues a rebalance now, bringing a delayed one forward (caller commits)"""
+    job = pending_rebalance()
+    if job is None:
+        return enqueue('rebalance', {})
+    if job.status == 'Pending':
+        job.run_after = min(job.run_after, utcnow())
+    return job
+
+@job_handler('rebalance')
+def rebalance_batch(payload):
+    """Job handler that moves a batch of blobs from the fullest drive to the emptiest, then queues the rest"""
+    config = current_app.config
+    invalidate_usage()
+    plan = rebalance_plan()
+    if plan is None:
+        return
+    source, target, to_move = plan
+    
+    # Blobs whose file can't be moved are passed over for the rest of the pass
+    after = payload.get('after', '') if payload.get('source') == source else ''
+    blobs = Blob.query.filter(Blob.volume == source, Blob.hash > after).order_by(Blob.hash).limit(
+        config['STORAGE_REBALANCE_BATCH_SIZE']
+    ).all()
+    
+    moved = 0
+    deadline = time.monotonic() + config['STORAGE_REBALANCE_BATCH_SECONDS']
+    for blob in blobs:
+        after = blob.hash
+        moved += move_blob(blob, target)
+        if moved >= to_move or time.monotonic() > deadline:
+            break
+    
+    invalidate_usage()
+    logger.info(f"Moved {moved} bytes from volume {source} to {target}")
+    # A short batch that was worked through to its end means the source has nothing more to try
+    exhausted = len(blobs) < config['STORAGE_REBALANCE_BATCH_SIZE'] and (not blobs or after == blobs[-1].hash)
+    if moved and moved >= to_move:
+        # Plan again, another pair of drives may still be uneven
+        enqueue('rebalance', {})
+    elif exhausted:
+        # Starting over right away would only retry the files that couldn't move
+        logger.warning(f"Rebalance from volume {source} to {target} is stuck, retrying in {REBALANCE_RETRY_HOURS} hours")
+        job = enqueue('rebalance', {})
+        job.run_after = utcnow() + datetime.timedelta(hours=REBALANCE_RETRY_HOURS)
+    else:
+        enqueue('rebalance', {'source': source, 'after': after})
+
+def invalidate_usage():
+    """Drops cached disk usage and stored bytes, before and after moving files"""
+    invalidate_disk_usage()
+    with _stored_bytes_lock:
+        _stored_bytes_cache.clear()
+
+@click.command('rebalance')
+@with_appcontext
+def rebalance_command():
+    """Queue moving backups from the fullest drive to the emptiest."""
+    plan = rebalance_plan()
+    if plan is None:
+        click.echo('The drives are within STORAGE_REBALANCE_SPREAD_PERCENT of each other')
+        return
+    queue_rebalance()
+    db.session.commit()
+    source, target, to_move = plan
+    click.echo(f'Rebalance queued, about {to_move} bytes will move from {source} to {target}')
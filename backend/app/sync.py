@@ -0,0 +1,73 @@
+import uuid
+import base64
+from sqlalchemy import update
+from .jobs import utcnow
+from .models import DeviceSyncState, insert_for
+from . import db
+
+def start_scan(device_id):
+    """Begins a delta scan for a device, replacing any unfinished one (caller commits)"""
+    db.session.execute(
+        insert_for(DeviceSyncState).values(
+            device_id=device_id, synced_until=0, updated_at=utcnow()
+        ).on_conflict_do_nothing(index_elements=['device_id'])
+    )
+    state = db.session.get(DeviceSyncState, device_id, with_for_update=True)
+    state.scan_token = uuid.uuid4().hex
+    state.scan_since = state.synced_until
+    state.scan_min_needed = None
+    state.scan_max_seen = None
+    state.updated_at = utcnow()
+    return state
+
+def find_scan(device_id, scan_token):
+    """Returns the device's state if scan_token is its scan in progress, else None"""
+    state = db.session.get(DeviceSyncState, device_id, with_for_update=True)
+    if state is None or state.scan_token is None or state.scan_token != scan_token:
+        return None
+    return state
+
+def record_page(state, modified, needed):
+    """Folds one scanned page into the scan, modified holds each asset's time, needed the indexes to back up"""
+    if modified:
+        newest = max(modified)
+        state.scan_max_seen = newest if state.scan_max_seen is None else max(state.scan_max_seen, newest)
+    if needed:
+        oldest = min(modified[index] for index in needed)
+        state.scan_min_needed = oldest if state.scan_min_needed is None else min(state.scan_min_needed, oldest)
+    state.updated_at = utcnow()
+
+def finish_scan(state):
+    """Moves the high-water mark up to the oldest asset still needing backup, or past everything seen"""
+    if state.scan_min_needed is not None:
+        state.synced_until = state.scan_min_needed
+    elif state.scan_max_seen is not None:
+        state.synced_until = max(state.scan_since, state.scan_max_seen)
+    state.scan_token = None
+    state.updated_at = utcnow()
+
+def reset_sync_state(device_ids):
+    """Makes devices rescan their whole library, after files they were told are safe need uploading again"""
+    device_ids = [device_id for device_id in set(device_ids) if device_id is not None]
+    if not device_ids:
+        return
+    db.session.execute(
+        update(DeviceSyncState)
+        .where(DeviceSyncState.device_id.in_(device_ids))
+        .values(synced_until=0, scan_token=None, updated_at=utcnow())
+    )
+
+def encode_needed(needed, count):
+    """Returns the indexes of a page's assets to back up as a list or, when shorter, a bitmap.
+    
+    Bit i of the base64 bitmap (byte i // 8, least significant bit first) is set
+    when asset i needs a backup, so a page that is mostly new costs count / 6 bytes.
+    """
+    bitmap = bytearray((count + 7) // 8)
+    list_size = sum(len(str(index)) + 1 for index in needed)
+    if list_size <= (len(bitmap) + 2) // 3 * 4:
+        return {'needed': needed}
+    
+    for index in needed:
+        bitmap[index // 8] |= 1 << (index % 8)
+    return {'needed_bitmap': base64.b64encode(bytes(bitmap)).decode()}
@@ -0,0 +1,176 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+from flask import current_app
+from PIL import Image, ImageOps, UnidentifiedImageError
+from .jobs import enqueue, job_handler
+from .storage import DEFAULT_VOLUME, stored_path
+from . import db
+
+# Most iPhone photos are HEIC, pillow-heif from requirements.txt decodes them.
+# Without it they get no thumbnail, everything else still works.
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+logger = logging.getLogger(__name__)
+
+# Edge lengths a thumbnail request is snapped up to, so the cache stays small
+THUMBNAIL_SIZES = (128, 256, 512, 1024)
+
+# Sizes generated by the background workers right after an upload
+PREGENERATED_SIZES = (256,)
+
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+# Only refresh a cached file's mtime (used for LRU eviction) this often
+TOUCH_INTERVAL = 60 * 60
+
+# Approximate cache size in bytes, measured on first use and then kept up to date
+_cache_bytes = None
+_cache_lock = threading.Lock()
+
+def thumbnail_folder():
+    """Returns the derived-asset cache folder, next to the upload folder by default"""
+    return current_app.config.get('THUMBNAIL_FOLDER') or (
+        current_app.config['UPLOAD_FOLDER'].rstrip(os.sep) + '_thumbnails'
+    )
+
+def snap_size(size):
+    """Returns the smallest cached size at least as large as the requested one"""
+    for candidate in THUMBNAIL_SIZES:
+        if size <= candidate:
+            return candidate
+    return THUMBNAIL_SIZES[-1]
+
+def cache_key(backup):
+    """Returns the cache key for a backup, shared by every backup of the same content"""
+    return backup.content_hash or f'backup-{backup.id}'
+
+def thumbnail_path(key, size, fmt):
+    """Returns where a thumbnail is cached"""
+    return os.path.join(thumbnail_folder(), key[:2], f'{key}_{size}.{fmt}')
+
+def thumbnail_etag(key, size, fmt):
+    """Returns the ETag of a thumbnail, stable because the source content never changes"""
+    return f'{key}-{size}-{fmt}'
+
+def is_thumbnailable(backup):
+    """Returns whether thumbnails can be made for a backup (videos are not decoded)"""
+    return backup.file_type == 'photo' and backup.status == 'Completed'
+
+def generate_thumbnail(source_path, target_path, size, fmt):
+    """Renders a thumbnail of source_path, stores it atomically at target_path and returns its size"""
+    pil_format, _ = FORMATS[fmt]
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    
+    with Image.open(source_path) as image:
+        # Let the JPEG decoder downscale while decoding, far cheaper on a Pi
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ('RGB', 'RGBA') or pil_format == 'JPEG':
+            image = image.convert('RGB')
+        
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                image.save(temp_file, pil_format, quality=80)
+                file_size = temp_file.tell()
+            os.replace(temp_path, target_path)
+            return file_size
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+def get_thumbnail(backup, size, fmt):
+    """Returns the path of a cached thumbnail, generating it on a cache miss"""
+    target_path = thumbnail_path(cache_key(backup), size, fmt)
+    
+    try:
+        mtime = os.path.getmtime(target_path)
+        if time.time() - mtime > TOUCH_INTERVAL:
+            os.utime(target_path)
+        return target_path
+    except FileNotFoundError:
+        pass
+    
+    source_path = stored_path(backup.volume, backup.file_path)
+    file_size = generate_thumbnail(source_path, target_path, size, fmt)
+    record_cached_file(thumbnail_folder(), file_size, current_app.config['THUMBNAIL_CACHE_MAX_BYTES'])
+    return target_path
+
+def _scan_cache(folder):
+    """Returns (mtime, size, path) for every cached file and their total size"""
+    entries = []
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    return entries, total
+
+def record_cached_file(folder, file_size, max_bytes):
+    """Accounts for a new thumbnail and evicts least recently used ones when over budget"""
+    global _cache_bytes
+    with _cache_lock:
+        if _cache_bytes is None:
+            _cache_bytes = _scan_cache(folder)[1]
+        else:
+            _cache_bytes += file_size
+        
+        if _cache_bytes <= max_bytes:
+            return
+        
+        # Evict down to 90% so we don't rescan after every new thumbnail
+        entries, total = _scan_cache(folder)
+        target = max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        _cache_bytes = total
+
+@job_handler('thumbnails')
+def pregenerate_thumbnails(payload):
+    """Job handler that renders the default thumbnail sizes for a new photo"""
+    # Jobs queued before storage volumes have no volume
+    source_path = stored_path(payload.get('volume', DEFAULT_VOLUME), payload['file_path'])
+    for size in PREGENERATED_SIZES:
+        target_path = thumbnail_path(payload['key'], size, 'jpeg')
+        if os.path.exists(target_path):
+            continue
+        try:
+            file_size = generate_thumbnail(source_path, target_path, size, 'jpeg')
+        except UnidentifiedImageError as e:
+            # Retrying won't help, the photo will show without a thumbnail
+            logger.warning(f"Could not generate thumbnail for {source_path}: {e}")
+            return
+        record_cached_file(thumbnail_folder(), file_size, current_app.config['THUMBNAIL_CACHE_MAX_BYTES'])
+
+def enqueue_thumbnails(backups):
+    """Queues thumbnail generation for freshly stored photos, committed with the upload"""
+    if not current_app.config['THUMBNAIL_PREGENERATE']:
+        return
+    
+    # Backups without a content hash are keyed by id, which needs a flush
+    db.session.flush()
+    for backup in backups:
+        if is_thumbnailable(backup):
+            enqueue('thumbnails', {'key': cache_key(backup), 'volume': backup.volume, 'file_path': backup.file_path})
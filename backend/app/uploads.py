@@ -0,0 +1,231 @@
+import os
+import time
+import fcntl
+import hashlib
+import datetime
+import logging
+import tempfile
+import contextlib
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from .admission import throttle, upload_speed
+from .jobs import enqueue, job_handler, utcnow
+from .metrics import record_upload_io
+from .models import Backup, Blob, Job, UploadSession, insert_for
+from .prune import request_prune_if_low, request_release
+from .storage import (
+    DEFAULT_VOLUME, VolumeUnavailable, choose_volume, place_file, relocate_blob,
+    request_rebalance_if_uneven, stored_file_exists, stored_path, volume_folder, writing_to
+)
+from . import db
+
+logger = logging.getLogger(__name__)
+
+# Size of the reads used when copying request bodies to disk
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+def new_hasher():
+    """Returns the hash object used to address stored content"""
+    return hashlib.sha256()
+
+def build_destination(filename, volume=DEFAULT_VOLUME):
+    """Returns the path, relative to the volume, for a new file in its YYYY/MM layout"""
+    today = datetime.datetime.now()
+    year_month = f"{today.year}/{today.month:02d}"
+    
+    # Create directory if it doesn't exist
+    os.makedirs(os.path.join(volume_folder(volume), year_month), exist_ok=True)
+    
+    return os.path.join(year_month, filename)
+
+def find_backup(original_path, device_id):
+    """Returns the existing backup record for a device file, if any"""
+    return Backup.query.filter_by(
+        original_path=original_path,
+        device_id=device_id
+    ).first()
+
+def record_backup(existing_backup, filename, blob, original_path,
+                  file_type, mime_type, device_id):
+    """Creates or updates the backup record pointing at a stored blob (caller commits)"""
+    if existing_backup:
+        if existing_backup.content_hash != blob.hash:
+            # The file changed on the device, the old content may now be unused
+            request_release(existing_backup)
+        existing_backup.volume = blob.volume
+        existing_backup.file_path = blob.file_path
+        existing_backup.file_size = blob.file_size
+        existing_backup.content_hash = blob.hash
+        existing_backup.status = 'Completed'
+        existing_backup.timestamp = datetime.datetime.utcnow()
+        return existing_backup
+    
+    backup = Backup(
+        file_name=filename,
+        volume=blob.volume,
+        file_path=blob.file_path,
+        original_path=original_path,
+        file_size=blob.file_size,
+        file_type=file_type,
+        mime_type=mime_type,
+        device_id=device_id,
+        content_hash=blob.hash,
+        status='Completed'
+    )
+    db.session.add(backup)
+    return backup
+
+def staging_folder(volume=DEFAULT_VOLUME):
+    """Returns the folder holding partial uploads, on the same drive as the volume's backups"""
+    folder = os.path.join(volume_folder(volume), '.staging')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def staging_path(session_id, volume=DEFAULT_VOLUME):
+    """Returns the staging file path for an upload session"""
+    return os.path.join(staging_folder(volume), session_id)
+
+@contextlib.contextmanager
+def locked_staging_file(session_id, volume=DEFAULT_VOLUME):
+    """Opens a session's staging file for writing, locked so one request writes to it at a time.
+    
+    Raises BlockingIOError when another request holds the lock.
+    """
+    with open(staging_path(session_id, volume), 'r+b') as staging_file:
+        # Released when the file is closed, also when the worker dies
+        fcntl.flock(staging_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        yield staging_file
+
+def expire_upload_sessions():
+    """Removes upload sessions untouched for UPLOAD_SESSION_TTL_HOURS and their staging files.
+    
+    Returns how many were removed and when the oldest remaining session expires, or None.
+    """
+    ttl = datetime.timedelta(hours=current_app.config['UPLOAD_SESSION_TTL_HOURS'])
+    removed = 0
+    for session in UploadSession.query.filter(UploadSession.updated_at < utcnow() - ttl).all():
+        try:
+            # Sessions a chunk is being written to are in use, whatever their age
+            with locked_staging_file(session.id, session.volume):
+                os.remove(staging_path(session.id, session.volume))
+        except BlockingIOError:
+            continue
+        except (FileNotFoundError, VolumeUnavailable):
+            pass
+        db.session.delete(session)
+        removed += 1
+    db.session.commit()
+    
+    oldest = db.session.query(db.func.min(UploadSession.updated_at)).scalar()
+    return removed, (oldest + ttl if oldest else None)
+
+def request_upload_expiry():
+    """Queues a cleanup for when a new upload session could expire, committed with the session"""
+    if db.session.query(Job.id).filter(Job.job_type == 'upload_expiry', Job.status.in_(['Pending', 'Running'])).first():
+        return
+    job = enqueue('upload_expiry', {})
+    job.run_after = utcnow() + datetime.timedelta(hours=current_app.config['UPLOAD_SESSION_TTL_HOURS'])
+
+@job_handler('upload_expiry')
+def upload_expiry_job(payload):
+    """Job handler that removes expired upload sessions, then waits for the next to expire"""
+    removed, next_expiry = expire_upload_sessions()
+    if removed:
+        logger.info(f"Removed {removed} expired upload sessions")
+    if next_expiry is not None:
+        job = enqueue('upload_expiry', {})
+        job.run_after = max(next_expiry, utcnow())
+        db.session.commit()
+
+@click.command('expire-uploads')
+@with_appcontext
+def expire_uploads_command():
+    """Remove upload sessions untouched for UPLOAD_SESSION_TTL_HOURS."""
+    removed, _ = expire_upload_sessions()
+    click.echo(f'Removed {removed} expired upload sessions')
+
+def write_stream(stream, file_obj, hasher=None):
+    """Copies a stream to an open file in large blocks, returns the bytes written"""
+    written = 0
+    read_seconds = write_seconds = hash_seconds = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            block = stream.read(STREAM_BUFFER_SIZE)
+            read_done = time.perf_counter()
+            if not block:
+                break
+            throttle(len(block))
+            file_obj.write(block)
+            write_done = time.perf_counter()
+            if hasher is not None:
+                hasher.update(block)
+            hash_seconds += time.perf_counter() - write_done
+            read_seconds += read_done - started
+            write_seconds += write_done - read_done
+            written += len(block)
+    finally:
+        record_upload_io(written, read_seconds, write_seconds, hash_seconds)
+        upload_speed.observe(written, read_seconds, write_seconds)
+    return written
+
+def hash_file(file_path):
+    """Returns the content hash of a file already on disk"""
+    hasher = new_hasher()
+    with open(file_path, 'rb') as stored:
+        while True:
+            block = stored.read(STREAM_BUFFER_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def store_blob(temp_path, filename, file_size, content_hash, volume=DEFAULT_VOLUME):
+    """Moves a received file, staged on volume, into the store unless its content is already there"""
+    blob = db.session.get(Blob, content_hash)
+    
+    if blob is not None and stored_file_exists(blob.volume, blob.file_path):
+        os.remove(temp_path)
+        return blob
+    
+    # Only the hash policy needs the content to pick a drive, which may cost a copy
+    if current_app.config['STORAGE_PLACEMENT'] == 'hash':
+        volume = choose_volume(file_size, content_hash)
+    
+    # Atomic rename, readers never see a half-written file. Different content under
+    # an existing name gets a hash suffix instead of overwriting it.
+    relative_path = place_file(temp_path, volume, build_destination(filename, volume), content_hash)
+    request_prune_if_low()
+    request_rebalance_if_uneven()
+    
+    if blob is not None:
+        # The blob's file went missing, this upload restores it
+        relocate_blob(blob, volume, relative_path)
+        return blob
+    
+    result = db.session.execute(
+        insert_for(Blob).values(
+            hash=content_hash, volume=volume, file_path=relative_path, file_size=file_size
+        ).on_conflict_do_nothing(index_elements=['hash'])
+    )
+    blob = db.session.get(Blob, content_hash)
+    if result.rowcount == 0 and (blob.volume, blob.file_path) != (volume, relative_path):
+        # A concurrent upload of the same content got there first, keep its copy
+        os.remove(stored_path(volume, relative_path))
+    return blob
+
+def receive_blob(stream, filename, expected_size=None):
+    """Streams a body to a temp file on the chosen drive while hashing it, returns its Blob"""
+    volume = choose_volume(expected_size)
+    fd, temp_path = tempfile.mkstemp(dir=staging_folder(volume), suffix='.part')
+    try:
+        hasher = new_hasher()
+        with writing_to(volume):
+            with os.fdopen(fd, 'wb') as temp_file:
+                file_size = write_stream(stream, temp_file, hasher)
+        
+        return store_blob(temp_path, filename, file_size, hasher.hexdigest(), volume)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
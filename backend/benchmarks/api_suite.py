@@ -0,0 +1,279 @@
+"""Times the main API calls against synthetic libraries of increasing size.
+
+For every library size the database is migrated from empty and loaded with
+backups spread over many devices, then each scenario is run through the Flask
+test client so the numbers cover the app and the database, not the network:
+
+- /photos/new diffing a scan page, half of it already backed up
+- /storage/status
+- /backup/log and /backup/history first pages, and deep pages by cursor and by offset
+- single (multipart and raw body) and batch uploads of assorted file sizes
+
+Results are written as JSON with the commit they were measured at. Passing a
+previous file with --compare prints the change per scenario and exits with 1
+when one got slower than --tolerance, so regressions show up across commits.
+
+    python benchmarks/api_suite.py --sizes 10000,100000 --json results.json
+    python benchmarks/api_suite.py --database-url postgresql://... --compare results.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import datetime
+import statistics
+import subprocess
+from common import BACKEND_DIR
+from library import device_paths, seed_library
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import text
+from app import create_app, db
+from app.models import Backup
+from app.routes import encode_cursor
+from app.stats import rebuild_stats
+
+# (label, size in bytes, files per run): a JPEG, a HEIC burst, a short video
+UPLOAD_SIZES = (
+    ('100kb', 100 * 1024, 20),
+    ('3mb', 3 * 1024 * 1024, 10),
+    ('30mb', 30 * 1024 * 1024, 2)
+)
+BATCH_FILES = 50
+BATCH_FILE_SIZE = 100 * 1024
+SCAN_PAGE_SIZES = (1000, 5000)
+PAGE_LIMIT = 100
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the API against synthetic libraries')
+    parser.add_argument('--sizes', default='10000,100000', help='Comma separated library sizes in backups')
+    parser.add_argument('--devices', type=int, default=8, help='Devices the backups are spread over')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario, after one warm-up run')
+    parser.add_argument('--database-url', default=None, help='Empty database to use (default: temporary SQLite)')
+    parser.add_argument('--json', default=None, help='Write results to this JSON file')
+    parser.add_argument('--compare', default=None, help='Previous results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown before --compare fails')
+    return parser.parse_args()
+
+def timed(func, repeat):
+    """Runs func once to warm up, then repeat times, returning the durations in seconds"""
+    func()
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+def summarize(library_rows, scenario, durations, **extra):
+    ordered = sorted(durations)
+    return {
+        'library_rows': library_rows,
+        'scenario': scenario,
+        'runs': len(durations),
+        'median_ms': round(statistics.median(ordered) * 1000, 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        **extra
+    }
+
+def expect(response, status):
+    if response.status_code != status:
+        raise RuntimeError(f'{response.request.path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response
+
+class UploadNames:
+    """Hands out paths no earlier run used, so every upload does the full work"""
+
+    def __init__(self):
+        self.count = 0
+
+    def next(self, extension):
+        self.count += 1
+        return f'bench_{self.count:07d}{extension}', f'/DCIM/BENCH/bench_{self.count:07d}{extension}'
+
+def upload_body(size, names):
+    # A unique prefix keeps the content from being deduplicated against an earlier upload
+    return names.count.to_bytes(8, 'big') + b'\0' * (size - 8)
+
+def scan_scenarios(client, rows, devices, repeat):
+    results = []
+    for page_size in SCAN_PAGE_SIZES:
+        # Half of the page is already backed up, the other half is new
+        known = device_paths(0, rows - (page_size // 2 + 1) * devices, page_size // 2, devices)
+        new = device_paths(0, rows, page_size - len(known), devices)
+        payload = {
+            'device_id': 'device-0',
+            'files': [{'path': path, 'size': 3 * 1024 * 1024, 'type': 'photo'} for path in known + new]
+        }
+        durations = timed(lambda: expect(client.post('/photos/new', json=payload), 200), repeat)
+        results.append(summarize(
+            rows, f'photos_new_{page_size}', durations,
+            files_per_second=round(page_size / statistics.median(durations))
+        ))
+    return results
+
+def listing_scenarios(client, rows, repeat):
+    middle = db.session.query(Backup).order_by(Backup.timestamp.desc(), Backup.id.desc()).offset(rows // 2).first()
+    cursor = encode_cursor(middle)
+    middle_completed = db.session.query(Backup).filter_by(status='Completed').order_by(
+        Backup.timestamp.desc(), Backup.id.desc()
+    ).offset(rows // 2).first()
+    history_cursor = encode_cursor(middle_completed)
+    db.session.rollback()
+    
+    requests = {
+        'storage_status': '/storage/status',
+        'backup_log_first_page': f'/backup/log?limit={PAGE_LIMIT}',
+        'backup_log_deep_cursor': f'/backup/log?limit={PAGE_LIMIT}&cursor={cursor}',
+        'backup_log_deep_offset': f'/backup/log?limit={PAGE_LIMIT}&offset={rows // 2}',
+        'backup_history_first_page': f'/backup/history?limit={PAGE_LIMIT}',
+        'backup_history_deep_cursor': f'/backup/history?limit={PAGE_LIMIT}&cursor={history_cursor}'
+    }
+    return [
+        summarize(rows, scenario, timed(lambda url=url: expect(client.get(url), 200), repeat))
+        for scenario, url in requests.items()
+    ]
+
+def upload_scenarios(client, rows, repeat, names):
+    results = []
+    for label, size, files in UPLOAD_SIZES:
+        def upload_multipart():
+            for _ in range(files):
+                file_name, path = names.next('.jpg')
+                expect(client.post('/photos/upload', data={
+                    'file': (io.BytesIO(upload_body(size, names)), file_name),
+                    'original_path': path,
+                    'device_id': 'bench-uploads'
+                }, content_type='multipart/form-data'), 201)
+
+        def upload_stream():
+            for _ in range(files):
+                file_name, path = names.next('.jpg')
+                expect(client.post('/photos/upload/stream', query_string={
+                    'file_name': file_name, 'original_path': path, 'device_id': 'bench-uploads'
+                }, data=upload_body(size, names), content_type='image/jpeg'), 201)
+        
+        for mode, upload in (('multipart', upload_multipart), ('stream', upload_stream)):
+            durations = timed(upload, repeat)
+            results.append(summarize(
+                rows, f'upload_{mode}_{label}', [duration / files for duration in durations],
+                mb_per_second=round(size * files / statistics.median(durations) / (1024 * 1024), 2)
+            ))
+
+    def upload_batch():
+        fields = {'file': [], 'original_path': [], 'device_id': 'bench-uploads'}
+        for _ in range(BATCH_FILES):
+            file_name, path = names.next('.jpg')
+            fields['file'].append((io.BytesIO(upload_body(BATCH_FILE_SIZE, names)), file_name))
+            fields['original_path'].append(path)
+        expect(client.post('/photos/upload/batch', data=fields, content_type='multipart/form-data'), 200)
+    
+    durations = timed(upload_batch, repeat)
+    results.append(summarize(
+        rows, f'upload_batch_{BATCH_FILES}x100kb', durations,
+        files_per_second=round(BATCH_FILES / statistics.median(durations))
+    ))
+    return results
+
+def run_size(app, rows, args):
+    with app.app_context():
+        downgrade(revision='base')
+        upgrade()
+        started = time.perf_counter()
+        seed_library(rows, args.devices)
+        rebuild_stats()
+        # Fresh planner statistics, as autovacuum would have gathered on a real library
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+        print(f'Loaded {rows} backups in {time.perf_counter() - started:.1f}s')
+        
+        client = app.test_client()
+        names = UploadNames()
+        results = scan_scenarios(client, rows, args.devices, args.repeat)
+        results += listing_scenarios(client, rows, args.repeat)
+        results += upload_scenarios(client, rows, args.repeat, names)
+        db.session.remove()
+        downgrade(revision='base')
+    return results
+
+def git_commit():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BACKEND_DIR, capture_output=True, text=True
+        ).stdout.strip() != ''
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def compare(results, previous_path, tolerance):
+    """Prints the change against a previous run, returns the scenarios that slowed down"""
+    with open(previous_path) as previous_file:
+        previous = {
+            (result['library_rows'], result['scenario']): result
+            for result in json.load(previous_file)['results']
+        }
+    
+    regressions = []
+    print(f"\nCompared with {previous_path}:")
+    for result in results:
+        before = previous.get((result['library_rows'], result['scenario']))
+        if before is None or not before['median_ms']:
+            continue
+        change = result['median_ms'] / before['median_ms'] - 1
+        flag = '  REGRESSION' if change > tolerance else ''
+        print(f"{result['library_rows']:>8} {result['scenario']:<30} "
+              f"{before['median_ms']:>10.2f}ms -> {result['median_ms']:>10.2f}ms {change:+7.1%}{flag}")
+        if change > tolerance:
+            regressions.append(result['scenario'])
+    return regressions
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': database_url,
+            'UPLOAD_FOLDER': os.path.join(workdir, 'uploads')
+        })
+        results = []
+        for rows in sizes:
+            results += run_size(app, rows, args)
+        with app.app_context():
+            dialect = db.engine.dialect.name
+    
+    for result in results:
+        extra = ''.join(f', {key} {result[key]}' for key in ('files_per_second', 'mb_per_second') if key in result)
+        print(f"{result['library_rows']:>8} {result['scenario']:<30} "
+              f"median {result['median_ms']:>10.2f}ms  p95 {result['p95_ms']:>10.2f}ms{extra}")
+    
+    commit, dirty = git_commit()
+    report = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'database': dialect,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'created': datetime.datetime.now(datetime.UTC).isoformat(),
+            'devices': args.devices,
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+    
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Helpers shared by the benchmark scripts."""
+import os
+import sys
+import time
+import uuid
+import socket
+import http.client
+import urllib.parse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BLOCK_SIZE = 1024 * 1024
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def migrate_database(database_url, upload_folder):
+    """Brings the benchmark database to the latest schema, the server doesn't create tables"""
+    sys.path.insert(0, BACKEND_DIR)
+    from flask_migrate import upgrade
+    from app import create_app
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_url, 'UPLOAD_FOLDER': upload_folder})
+    with app.app_context():
+        upgrade()
+
+def wait_for_server(port, process, attempts=150):
+    """Polls /ping until the server answers, kills it if it never does"""
+    for _ in range(attempts):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/ping')
+            if conn.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Server did not start')
+
+def peak_rss_kb(pid):
+    """Returns VmHWM (peak resident set size) of a process in KB"""
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return None
+
+def send_body(conn, size, block):
+    remaining = size
+    while remaining > 0:
+        chunk = block[:min(remaining, len(block))]
+        conn.send(chunk)
+        remaining -= len(chunk)
+
+def upload_multipart(port, name, size, block, device_id='bench'):
+    boundary = uuid.uuid4().hex
+    fields = {'original_path': f'/bench/{name}', 'file_type': 'video', 'device_id': device_id}
+    head = ''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+        for key, value in fields.items()
+    )
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+        'Content-Type: video/mp4\r\n\r\n'
+    )
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    head = head.encode()
+
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.putrequest('POST', '/photos/upload')
+    conn.putheader('Content-Type', f'multipart/form-data; boundary={boundary}')
+    conn.putheader('Content-Length', str(len(head) + size + len(tail)))
+    conn.endheaders()
+    conn.send(head)
+    send_body(conn, size, block)
+    conn.send(tail)
+    return conn.getresponse().status
+
+def upload_stream(port, name, size, block, device_id='bench'):
+    query = urllib.parse.urlencode({
+        'file_name': name, 'original_path': f'/bench/{name}', 'file_type': 'video', 'device_id': device_id
+    })
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.putrequest('POST', f'/photos/upload/stream?{query}')
+    conn.putheader('Content-Type', 'video/mp4')
+    conn.putheader('Content-Length', str(size))
+    conn.endheaders()
+    send_body(conn, size, block)
+    return conn.getresponse().status
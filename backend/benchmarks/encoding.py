@@ -0,0 +1,106 @@
+"""Compares payload size and encoding time of the list endpoint response formats.
+
+Builds /backup/log pages of synthetic backups and encodes each one as plain JSON
+the way jsonify does, with the app's JSON encoder (orjson when installed), as
+columnar JSON and as MessagePack, each uncompressed, gzipped and with brotli.
+Times include compression, so they show what a page costs the server's CPU.
+
+    python benchmarks/encoding.py --rows 100,1000,5000
+"""
+import sys
+import json
+import hashlib
+import time
+import argparse
+import datetime
+import statistics
+from common import BACKEND_DIR
+
+sys.path.insert(0, BACKEND_DIR)
+from app import create_app, encoding
+from library import START, original_path
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark list response encodings')
+    parser.add_argument('--rows', default='100,1000,5000', help='Comma separated page sizes')
+    parser.add_argument('--repeat', type=int, default=20, help='Runs per format, the median is reported')
+    parser.add_argument('--json', default=None, help='Write results to this JSON file')
+    return parser.parse_args()
+
+def backup_page(rows):
+    """Returns a /backup/log payload with rows shaped like Backup.to_dict()"""
+    return {
+        'status': 'success',
+        'backups': [{
+            'id': i + 1,
+            'file_name': f'IMG_{i:07d}.JPG',
+            'file_path': f'2024/01/IMG_{i:07d}.JPG',
+            'file_size': 3 * 1024 * 1024 + i,
+            'file_type': 'video' if i % 10 == 0 else 'photo',
+            'mime_type': 'video/quicktime' if i % 10 == 0 else 'image/jpeg',
+            'content_hash': hashlib.sha256(str(i).encode()).hexdigest(),
+            'timestamp': (START + datetime.timedelta(seconds=i)).isoformat(),
+            'status': 'Completed'
+        } for i in range(rows)],
+        'count': rows,
+        'next_cursor': original_path(rows)
+    }
+
+def formats(app):
+    """Returns {name: function turning a payload into response bytes}"""
+    columnar = lambda payload: {**payload, 'backups': encoding.to_columns(payload['backups'])}
+    encoders = {
+        'jsonify': lambda payload: app.json.dumps(payload).encode(),
+        'json': encoding.dumps_json,
+        'columnar_json': lambda payload: encoding.dumps_json(columnar(payload)),
+    }
+    if encoding.msgpack is not None:
+        encoders['msgpack'] = lambda payload: encoding.msgpack.packb(columnar(payload))
+    
+    compressors = {
+        'identity': lambda data: data,
+        'gzip': lambda data: encoding.gzip.compress(data, encoding.GZIP_LEVEL, mtime=0)
+    }
+    if encoding.brotli is not None:
+        compressors['br'] = lambda data: encoding.brotli.compress(data, quality=encoding.BROTLI_QUALITY)
+    
+    return {
+        f'{name}+{compression}': (lambda payload, encode=encode, compress=compress: compress(encode(payload)))
+        for name, encode in encoders.items()
+        for compression, compress in compressors.items()
+    }
+
+def measure(encode, payload, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = encode(payload)
+        timings.append(time.perf_counter() - started)
+    return {'bytes': len(body), 'median_ms': round(statistics.median(timings) * 1000, 3)}
+
+def main():
+    args = parse_args()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    # Missing packages drop their formats, so results are only comparable with the same encoders
+    encoders = {
+        'orjson': encoding.orjson is not None,
+        'msgpack': encoding.msgpack is not None,
+        'brotli': encoding.brotli is not None
+    }
+    print(', '.join(f'{name}: {"used" if used else "not installed"}' for name, used in encoders.items()))
+    
+    results = []
+    for rows in [int(value) for value in args.rows.split(',')]:
+        payload = backup_page(rows)
+        print(f'\n{rows} rows')
+        for name, encode in formats(app).items():
+            result = {'rows': rows, 'format': name, **measure(encode, payload, args.repeat)}
+            results.append(result)
+            print(f"  {name:<24} {result['bytes']:>10} bytes {result['median_ms']:>9.3f}ms")
+    
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'encoders': encoders, 'results': results}, output, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Synthetic photo libraries shared by the database benchmarks."""
+import sys
+import datetime
+from common import BACKEND_DIR
+
+sys.path.insert(0, BACKEND_DIR)
+from sqlalchemy import insert
+from app import db
+from app.models import Backup, IgnoredFile
+
+INSERT_CHUNK_SIZE = 10000
+START = datetime.datetime(2024, 1, 1)
+
+def original_path(i):
+    """Returns the iPhone path of the i-th file, spread over DCIM folders like a real library"""
+    return f'/DCIM/{100 + i // 9999}APPLE/IMG_{i:07d}.JPG'
+
+def device_paths(device, start, count, devices):
+    """Returns count paths of one device from the i-th file on, the files go round-robin to devices"""
+    first = start + (device - start) % devices
+    return [original_path(i) for i in range(first, first + count * devices, devices)]
+
+def seed_library(rows, devices):
+    """Loads backups with 1% Failed and 1% Pending, plus an ignore for every 20th file"""
+    for start in range(0, rows, INSERT_CHUNK_SIZE):
+        backups = []
+        ignores = []
+        for i in range(start, min(start + INSERT_CHUNK_SIZE, rows)):
+            status = 'Failed' if i % 100 == 0 else 'Pending' if i % 100 == 1 else 'Completed'
+            backups.append({
+                'file_name': f'IMG_{i:07d}.JPG',
+                'file_path': f'2024/01/IMG_{i:07d}.JPG',
+                'original_path': original_path(i),
+                'file_size': 3 * 1024 * 1024,
+                'file_type': 'video' if i % 10 == 0 else 'photo',
+                'device_id': f'device-{i % devices}',
+                'timestamp': START + datetime.timedelta(seconds=i),
+                'status': status
+            })
+            if i % 20 == 0:
+                ignores.append({
+                    'file_name': f'IMG_{i:07d}.JPG',
+                    'device_id': f'device-{i % devices}',
+                    'original_path': original_path(i) + '.ignored'
+                })
+        db.session.execute(insert(Backup), backups)
+        if ignores:
+            db.session.execute(insert(IgnoredFile), ignores)
+        db.session.commit()
@@ -0,0 +1,133 @@
+"""Concurrent upload load test for each server mode.
+
+Starts the app under the Werkzeug dev server and under gunicorn with each worker
+class from gunicorn.conf.py, then has several simulated phones upload at once
+while /ping is probed in the background. Reports upload throughput and /ping
+latency per mode. gevent is skipped when it is not installed.
+
+    python benchmarks/load_test.py --clients 4 --files 5 --size-mb 32
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import importlib.util
+from common import BACKEND_DIR, BLOCK_SIZE, free_port, migrate_database, upload_stream, wait_for_server
+
+MODES = ('werkzeug', 'sync', 'gthread', 'gevent')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test concurrent uploads per server mode')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent uploading clients')
+    parser.add_argument('--files', type=int, default=5, help='Files uploaded by each client')
+    parser.add_argument('--size-mb', type=int, default=32, help='Size of each file in MB')
+    parser.add_argument('--modes', default=','.join(MODES), help='Comma separated modes to run')
+    parser.add_argument('--database-url', default=None, help='Database URL (default: temporary SQLite)')
+    parser.add_argument('--json', default=None, help='Write results to this JSON file')
+    return parser.parse_args()
+
+def start_server(mode, port, database_url, upload_folder):
+    env = dict(os.environ, DATABASE_URL=database_url, UPLOAD_FOLDER=upload_folder)
+    if mode == 'werkzeug':
+        command = [sys.executable, 'run.py', '-p', str(port)]
+    else:
+        env.update(GUNICORN_WORKER_CLASS=mode, GUNICORN_BIND=f'127.0.0.1:{port}')
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app']
+    server = subprocess.Popen(
+        command, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return wait_for_server(port, server)
+
+def probe_ping(port, stop, latencies):
+    """Measures /ping round trips until stop is set"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', '/ping')
+            conn.getresponse().read()
+            latencies.append(time.perf_counter() - started)
+        except OSError:
+            latencies.append(float('inf'))
+        stop.wait(0.1)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else None
+
+def run_mode(mode, args, block):
+    with tempfile.TemporaryDirectory() as workdir:
+        database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        migrate_database(database_url, os.path.join(workdir, 'uploads'))
+        port = free_port()
+        server = start_server(mode, port, database_url, os.path.join(workdir, 'uploads'))
+        size = args.size_mb * 1024 * 1024
+        failures = []
+        latencies = []
+        stop = threading.Event()
+
+        def client(index):
+            for _ in range(args.files):
+                try:
+                    status = upload_stream(port, f'{uuid.uuid4().hex}.mp4', size, block, device_id=f'phone{index}')
+                except OSError as e:
+                    status = str(e)
+                if status != 201:
+                    failures.append(status)
+
+        try:
+            pinger = threading.Thread(target=probe_ping, args=(port, stop, latencies))
+            pinger.start()
+            clients = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+            started = time.perf_counter()
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            pinger.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+        uploaded = args.clients * args.files - len(failures)
+        return {
+            'mode': mode,
+            'clients': args.clients,
+            'files': args.clients * args.files,
+            'failed': len(failures),
+            'seconds': round(elapsed, 3),
+            'mb_per_second': round(uploaded * args.size_mb / elapsed, 2),
+            'ping_p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+            'ping_p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+            'ping_max_ms': round(max(latencies) * 1000, 1)
+        }
+
+def main():
+    args = parse_args()
+    modes = [mode for mode in args.modes.split(',') if mode]
+    if 'gevent' in modes and importlib.util.find_spec('gevent') is None:
+        print('gevent is not installed, skipping the gevent mode')
+        modes.remove('gevent')
+
+    block = os.urandom(BLOCK_SIZE)
+    results = []
+    for mode in modes:
+        result = run_mode(mode, args, block)
+        results.append(result)
+        print(f"{mode:>9}: {result['mb_per_second']:8.2f} MB/s, {result['failed']} failed, "
+              f"/ping p50 {result['ping_p50_ms']}ms p95 {result['ping_p95_ms']}ms max {result['ping_max_ms']}ms")
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
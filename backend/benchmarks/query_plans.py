@@ -0,0 +1,143 @@
+"""Shows the plans and timings of the hot queries before and after the index migration.
+
+Migrates an empty database to the revision before the indexes, loads synthetic
+backups and ignores, runs each query, then upgrades to head and runs them again.
+The database is downgraded back to empty at the end. By default a throwaway
+SQLite file is used, pass --database-url with an empty Postgres database to see
+real EXPLAIN ANALYZE plans.
+
+    python benchmarks/query_plans.py --rows 200000 --database-url postgresql://...
+"""
+import os
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import statistics
+from library import START, original_path, seed_library
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import text
+from app import create_app, db
+
+# Head of the migrations before the backups and ignored_files indexes
+BEFORE_INDEXES = '21aa8ade8309'
+# Plans of the IN (...) queries list every path, cut them down when printing
+PLAN_LINE_WIDTH = 160
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare query plans before and after the index migration')
+    parser.add_argument('--rows', type=int, default=100000, help='Synthetic backups to load')
+    parser.add_argument('--devices', type=int, default=4, help='Devices the backups are spread over')
+    parser.add_argument('--repeat', type=int, default=20, help='Runs per query, the median is reported')
+    parser.add_argument('--database-url', default=None, help='Empty database to use (default: temporary SQLite)')
+    parser.add_argument('--json', default=None, help='Write results to this JSON file')
+    return parser.parse_args()
+
+def build_queries(rows, devices):
+    """Returns the hot queries of /photos/new, /backup/history and /backup/log"""
+    # A scan page of 1000 paths from one device, half of them already backed up
+    paths = [original_path(i) for i in range(rows // 2, rows * 2, devices)][:1000]
+    path_list = ', '.join(f"'{path}'" for path in paths)
+    ignored_list = ', '.join(f"'{path}.ignored'" for path in paths)
+    middle = START + datetime.timedelta(seconds=rows // 2)
+    columns = 'id, file_name, file_path, file_size, file_type, mime_type, content_hash, timestamp, status'
+    
+    return {
+        'scan_backed_up_paths': (
+            f"SELECT original_path FROM backups WHERE device_id = 'device-0' "
+            f"AND status = 'Completed' AND original_path IN ({path_list})"
+        ),
+        'scan_ignored_paths': (
+            f"SELECT original_path FROM ignored_files WHERE device_id = 'device-0' "
+            f"AND original_path IN ({ignored_list})"
+        ),
+        'history_first_page': (
+            f"SELECT {columns} FROM backups WHERE status = 'Completed' "
+            f"ORDER BY timestamp DESC, id DESC LIMIT 50"
+        ),
+        'history_deep_page': (
+            f"SELECT {columns} FROM backups WHERE status = 'Completed' "
+            f"AND (timestamp, id) < ('{middle:%Y-%m-%d %H:%M:%S}.000000', {rows // 2}) "
+            f"ORDER BY timestamp DESC, id DESC LIMIT 50"
+        ),
+        'device_log_page': (
+            f"SELECT {columns} FROM backups WHERE device_id = 'device-1' "
+            f"ORDER BY timestamp DESC, id DESC LIMIT 50"
+        ),
+        'failed_log_page': (
+            f"SELECT {columns} FROM backups WHERE status = 'Failed' "
+            f"ORDER BY timestamp DESC, id DESC LIMIT 50"
+        )
+    }
+
+def explain(sql):
+    """Returns the plan of a query, with actual row counts and timings on Postgres"""
+    if db.engine.dialect.name == 'postgresql':
+        rows = db.session.execute(text(f'EXPLAIN (ANALYZE, BUFFERS) {sql}')).all()
+        return [row[0] for row in rows]
+    rows = db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}')).all()
+    return [row[-1] for row in rows]
+
+def measure(queries, repeat):
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+    
+    results = {}
+    for name, sql in queries.items():
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            db.session.execute(text(sql)).all()
+            timings.append(time.perf_counter() - started)
+        results[name] = {
+            'median_ms': round(statistics.median(timings) * 1000, 3),
+            'plan': explain(sql)
+        }
+        db.session.rollback()
+    return results
+
+def run(args, database_url, workdir):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads')
+    })
+    with app.app_context():
+        upgrade(revision=BEFORE_INDEXES)
+        try:
+            seed_library(args.rows, args.devices)
+            queries = build_queries(args.rows, args.devices)
+            before = measure(queries, args.repeat)
+            upgrade()
+            after = measure(queries, args.repeat)
+        finally:
+            db.session.rollback()
+            downgrade(revision='base')
+    
+    return [
+        {'query': name, 'before': before[name], 'after': after[name]}
+        for name in queries
+    ]
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        results = run(args, database_url, workdir)
+    
+    for result in results:
+        before, after = result['before'], result['after']
+        print(f"\n{result['query']}: {before['median_ms']:.3f}ms -> {after['median_ms']:.3f}ms")
+        print('  before:')
+        for line in before['plan']:
+            print(f'    {line[:PLAN_LINE_WIDTH]}')
+        print('  after:')
+        for line in after['plan']:
+            print(f'    {line[:PLAN_LINE_WIDTH]}')
+    
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
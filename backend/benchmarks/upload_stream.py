@@ -0,0 +1,93 @@
+"""Compares the multipart and raw-body upload routes.
+
+Each mode gets a fresh server process so its peak RSS can be read back from
+/proc once the uploads are done. By default the server uses a throwaway
+SQLite database and upload folder, pass --database-url to hit Postgres.
+
+    python benchmarks/upload_stream.py --size-mb 256 --files 4
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import tempfile
+import subprocess
+from common import (
+    BACKEND_DIR, BLOCK_SIZE, free_port, migrate_database, peak_rss_kb, upload_multipart, upload_stream,
+    wait_for_server
+)
+
+MODES = ('multipart', 'stream')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark upload throughput and server memory')
+    parser.add_argument('--size-mb', type=int, default=128, help='Size of each uploaded file in MB')
+    parser.add_argument('--files', type=int, default=3, help='Number of files uploaded per mode')
+    parser.add_argument('--database-url', default=None, help='Database URL (default: temporary SQLite)')
+    parser.add_argument('--json', default=None, help='Write results to this JSON file')
+    parser.add_argument('--serve', type=int, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def serve(port):
+    """Runs the app the same way run.py does"""
+    sys.path.insert(0, BACKEND_DIR)
+    from werkzeug.serving import run_simple
+    from app import create_app
+    run_simple('127.0.0.1', port, create_app(), threaded=True)
+
+def start_server(port, database_url, upload_folder):
+    env = dict(os.environ, DATABASE_URL=database_url, UPLOAD_FOLDER=upload_folder)
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return wait_for_server(port, server)
+
+def run_mode(mode, args, block):
+    with tempfile.TemporaryDirectory() as workdir:
+        database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        migrate_database(database_url, os.path.join(workdir, 'uploads'))
+        port = free_port()
+        server = start_server(port, database_url, os.path.join(workdir, 'uploads'))
+        try:
+            upload = upload_multipart if mode == 'multipart' else upload_stream
+            size = args.size_mb * 1024 * 1024
+            started = time.perf_counter()
+            for i in range(args.files):
+                status = upload(port, f'{mode}_{uuid.uuid4().hex}.mp4', size, block)
+                if status != 201:
+                    raise RuntimeError(f'{mode} upload failed with HTTP {status}')
+            elapsed = time.perf_counter() - started
+            return {
+                'mode': mode,
+                'files': args.files,
+                'file_size_mb': args.size_mb,
+                'seconds': round(elapsed, 3),
+                'mb_per_second': round(args.size_mb * args.files / elapsed, 2),
+                'server_peak_rss_kb': peak_rss_kb(server.pid)
+            }
+        finally:
+            server.terminate()
+            server.wait()
+
+def main():
+    args = parse_args()
+    if args.serve is not None:
+        serve(args.serve)
+        return
+
+    block = os.urandom(BLOCK_SIZE)
+    results = [run_mode(mode, args, block) for mode in MODES]
+
+    for result in results:
+        print(f"{result['mode']:>10}: {result['mb_per_second']:8.2f} MB/s, "
+              f"peak RSS {result['server_peak_rss_kb'] / 1024:.1f} MB")
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
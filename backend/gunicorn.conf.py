@@ -0,0 +1,110 @@
+"""Gunicorn settings for running iClood in production.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+GUNICORN_WORKER_CLASS picks the worker model:
+
+- gthread (default): a few processes with a thread pool each. A slow upload
+  holds one thread, /ping and the stats calls are served by the others.
+- sync: one request per process. Simple, but every concurrent upload needs a
+  whole process, so it only suits a single phone.
+- gevent: cooperative greenlets, thousands of idle connections per process.
+  Needs `pip install gevent psycogreen` so database calls don't block the loop.
+
+Sizes are derived from the CPU count and RAM of the machine (a Raspberry Pi 4
+has 4 cores and 2-8GB) and can be overridden with GUNICORN_WORKERS,
+GUNICORN_THREADS and GUNICORN_WORKER_CONNECTIONS. Each worker's database pool is
+sized from the same settings (see app/pool.py), so the total number of Postgres
+connections is roughly workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+"""
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+# Rough resident size of one worker process, used to avoid swapping on small boards
+WORKER_MEMORY_MB = 120
+
+def _memory_mb():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 1024
+
+def _default_workers(worker_class):
+    cpus = multiprocessing.cpu_count()
+    # Leave half the RAM to Postgres, the page cache and the job workers
+    memory_cap = max(1, _memory_mb() // 2 // WORKER_MEMORY_MB)
+    if worker_class == 'sync':
+        wanted = cpus * 2 + 1
+    elif worker_class == 'gevent':
+        wanted = cpus
+    else:
+        # Uploads are I/O bound, threads do the concurrency, processes the CPU work
+        wanted = max(2, cpus // 2)
+    return min(wanted, memory_cap)
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8080')}")
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('GUNICORN_WORKERS', _default_workers(worker_class)))
+
+if worker_class == 'gthread':
+    threads = int(os.environ.get('GUNICORN_THREADS', 8))
+if worker_class == 'gevent':
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 200))
+
+# A 4K video over weak Wi-Fi can take many minutes, sync workers are killed after this
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 1800))
+graceful_timeout = 60
+keepalive = 5
+
+# Heartbeat files in RAM rather than on the SD card
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Workers add up their /metrics through files in RAM, cleared on every start. This
+# has to be set before the app, and with it prometheus_client, is imported.
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', os.path.join(worker_tmp_dir or tempfile.gettempdir(), 'iclood_metrics')
+)
+shutil.rmtree(metrics_dir, ignore_errors=True)
+os.makedirs(metrics_dir)
+
+# Build the app once in the master, the forks share its memory
+preload_app = True
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'warning')
+
+def on_starting(server):
+    """Warns when the workers could open more connections than Postgres accepts"""
+    from app.pool import default_pool_size
+    if os.environ.get('DB_PGBOUNCER', '0') == '1':
+        return
+    per_worker = int(os.environ.get('DB_POOL_SIZE', default_pool_size())) + int(os.environ.get('DB_MAX_OVERFLOW', 2))
+    limit = int(os.environ.get('DB_MAX_CONNECTIONS', 100))
+    if workers * per_worker > limit:
+        server.log.warning(
+            f'{workers} workers x {per_worker} connections exceeds DB_MAX_CONNECTIONS={limit}, '
+            'lower DB_POOL_SIZE or GUNICORN_WORKERS, or use PgBouncer'
+        )
+
+def post_fork(server, worker):
+    """Gives each worker fresh database connections and makes psycopg2 gevent friendly"""
+    if worker_class == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            server.log.warning('psycogreen is not installed, database calls will block the gevent loop')
+
+    from wsgi import app
+    from app import db
+    with app.app_context():
+        # Connections opened by the master must not be shared with the forks
+        db.engine.dispose(close=False)
+
+def child_exit(server, worker):
+    """Drops the in-flight gauges of a worker that exited"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,88 @@
+"""Content addressed blobs, upload sessions, stats and jobs
+
+Revision ID: 21aa8ade8309
+Revises: 855a3ff2e11d
+Create Date: 2026-10-17 00:31:57.686947
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '21aa8ade8309'
+down_revision = '855a3ff2e11d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'blobs',
+        sa.Column('hash', sa.String(length=64), nullable=False),
+        sa.Column('file_path', sa.String(), nullable=False),
+        sa.Column('file_size', sa.BigInteger(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('hash')
+    )
+
+    with op.batch_alter_table('backups') as batch_op:
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+        batch_op.create_foreign_key('backups_content_hash_fkey', 'blobs', ['content_hash'], ['hash'])
+        batch_op.create_index('ix_backups_content_hash', ['content_hash'])
+
+    op.create_table(
+        'upload_sessions',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('file_name', sa.String(), nullable=False),
+        sa.Column('original_path', sa.String(), nullable=True),
+        sa.Column('file_type', sa.String(), nullable=False),
+        sa.Column('mime_type', sa.String(), nullable=True),
+        sa.Column('device_id', sa.String(), nullable=True),
+        sa.Column('total_size', sa.BigInteger(), nullable=False),
+        sa.Column('received_bytes', sa.BigInteger(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    # Filled in by get_stats() on first use
+    op.create_table(
+        'backup_stats',
+        sa.Column('file_type', sa.String(), nullable=False),
+        sa.Column('file_count', sa.BigInteger(), nullable=False),
+        sa.Column('total_size', sa.BigInteger(), nullable=False),
+        sa.Column('last_backup', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('file_type')
+    )
+
+    op.create_table(
+        'jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('job_type', sa.String(), nullable=False),
+        sa.Column('payload', sa.JSON(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('max_attempts', sa.Integer(), nullable=False),
+        sa.Column('run_after', sa.DateTime(), nullable=False),
+        sa.Column('locked_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_jobs_job_type_status_run_after', 'jobs', ['job_type', 'status', 'run_after'])
+
+
+def downgrade():
+    op.drop_index('ix_jobs_job_type_status_run_after', table_name='jobs')
+    op.drop_table('jobs')
+    op.drop_table('backup_stats')
+    op.drop_table('upload_sessions')
+
+    with op.batch_alter_table('backups') as batch_op:
+        batch_op.drop_index('ix_backups_content_hash')
+        batch_op.drop_constraint('backups_content_hash_fkey', type_='foreignkey')
+        batch_op.drop_column('content_hash')
+
+    op.drop_table('blobs')
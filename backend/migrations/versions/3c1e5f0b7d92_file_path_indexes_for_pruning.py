@@ -0,0 +1,32 @@
+"""File path indexes for pruning
+
+Revision ID: 3c1e5f0b7d92
+Revises: a90f510c4bfb
+Create Date: 2026-10-17 11:02:15.624071
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1e5f0b7d92'
+down_revision = 'a90f510c4bfb'
+branch_labels = None
+depends_on = None
+
+
+LEGACY = sa.text('content_hash IS NULL')
+
+
+def upgrade():
+    op.create_index('ix_blobs_file_path', 'blobs', ['file_path'])
+    op.create_index(
+        'ix_backups_legacy_file_path', 'backups', ['file_path'],
+        postgresql_where=LEGACY, sqlite_where=LEGACY
+    )
+
+
+def downgrade():
+    op.drop_index('ix_backups_legacy_file_path', table_name='backups')
+    op.drop_index('ix_blobs_file_path', table_name='blobs')
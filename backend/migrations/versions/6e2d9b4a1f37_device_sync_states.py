@@ -0,0 +1,34 @@
+"""Device sync states for delta scans
+
+Revision ID: 6e2d9b4a1f37
+Revises: 3c1e5f0b7d92
+Create Date: 2026-10-17 13:24:51.907316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2d9b4a1f37'
+down_revision = '3c1e5f0b7d92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'device_sync_states',
+        sa.Column('device_id', sa.String(), nullable=False),
+        sa.Column('synced_until', sa.BigInteger(), nullable=False),
+        sa.Column('scan_token', sa.String(), nullable=True),
+        sa.Column('scan_since', sa.BigInteger(), nullable=True),
+        sa.Column('scan_min_needed', sa.BigInteger(), nullable=True),
+        sa.Column('scan_max_seen', sa.BigInteger(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('device_id')
+    )
+
+
+def downgrade():
+    op.drop_table('device_sync_states')
@@ -0,0 +1,94 @@
+"""Indexes and unique constraints for backups and ignored files
+
+Duplicate rows for the same file on a device are removed first, keeping the
+Completed row (or the newest one) for backups and the oldest ignore. The files
+of removed backups are kept on disk, those no other row refers to are logged
+so they can be checked and deleted by hand.
+
+Revision ID: 829fa0321ae6
+Revises: 21aa8ade8309
+Create Date: 2026-10-17 00:31:58.857986
+
+"""
+import logging
+from alembic import op
+import sqlalchemy as sa
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+
+# revision identifiers, used by Alembic.
+revision = '829fa0321ae6'
+down_revision = '21aa8ade8309'
+branch_labels = None
+depends_on = None
+
+
+COMPLETED = sa.text("status = 'Completed'")
+INCOMPLETE = sa.text("status <> 'Completed'")
+
+
+DUPLICATE_BACKUPS = """
+    SELECT id, file_path FROM (
+        SELECT id, file_path, row_number() OVER (
+            PARTITION BY device_id, original_path
+            ORDER BY CASE WHEN status = 'Completed' THEN 0 ELSE 1 END, id DESC
+        ) AS position
+        FROM backups
+    ) ranked
+    WHERE position > 1
+"""
+
+
+def upgrade():
+    connection = op.get_bind()
+    removed_paths = {row.file_path for row in connection.execute(sa.text(DUPLICATE_BACKUPS))}
+    op.execute(f"DELETE FROM backups WHERE id IN (SELECT id FROM ({DUPLICATE_BACKUPS}) duplicates)")
+
+    # Their files stay in UPLOAD_FOLDER, list the ones nothing refers to any more
+    for file_path in sorted(removed_paths):
+        in_use = connection.execute(
+            sa.text("SELECT 1 FROM backups WHERE file_path = :path UNION SELECT 1 FROM blobs WHERE file_path = :path"),
+            {'path': file_path}
+        ).first()
+        if in_use is None:
+            logger.warning(f"Removed a duplicate backup, its file {file_path} is no longer referenced")
+    op.execute("""
+        DELETE FROM ignored_files WHERE id IN (
+            SELECT id FROM (
+                SELECT id, row_number() OVER (PARTITION BY device_id, original_path ORDER BY id) AS position
+                FROM ignored_files
+            ) ranked
+            WHERE position > 1
+        )
+    """)
+    # Totals are rebuilt by get_stats() on the next read
+    op.execute("DELETE FROM backup_stats")
+
+    with op.batch_alter_table('backups') as batch_op:
+        batch_op.create_unique_constraint('uq_backups_device_id_original_path', ['device_id', 'original_path'])
+        batch_op.create_index('ix_backups_timestamp_id', ['timestamp', 'id'])
+        batch_op.create_index('ix_backups_device_id_timestamp_id', ['device_id', 'timestamp', 'id'])
+        batch_op.create_index(
+            'ix_backups_completed_timestamp_id', ['timestamp', 'id'],
+            postgresql_where=COMPLETED, sqlite_where=COMPLETED
+        )
+        batch_op.create_index(
+            'ix_backups_incomplete_status_timestamp_id', ['status', 'timestamp', 'id'],
+            postgresql_where=INCOMPLETE, sqlite_where=INCOMPLETE
+        )
+
+    with op.batch_alter_table('ignored_files') as batch_op:
+        batch_op.create_unique_constraint('uq_ignored_files_device_id_original_path', ['device_id', 'original_path'])
+
+
+def downgrade():
+    with op.batch_alter_table('ignored_files') as batch_op:
+        batch_op.drop_constraint('uq_ignored_files_device_id_original_path', type_='unique')
+
+    with op.batch_alter_table('backups') as batch_op:
+        batch_op.drop_index('ix_backups_incomplete_status_timestamp_id')
+        batch_op.drop_index('ix_backups_completed_timestamp_id')
+        batch_op.drop_index('ix_backups_device_id_timestamp_id')
+        batch_op.drop_index('ix_backups_timestamp_id')
+        batch_op.drop_constraint('uq_backups_device_id_original_path', type_='unique')
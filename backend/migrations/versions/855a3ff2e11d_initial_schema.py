@@ -0,0 +1,55 @@
+"""Initial schema
+
+The tables as the server created them with db.create_all() before migrations
+were introduced. Databases that already have them are adopted as they are.
+
+Revision ID: 855a3ff2e11d
+Revises: 
+Create Date: 2026-10-17 00:31:56.595551
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '855a3ff2e11d'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing_tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'backups' not in existing_tables:
+        op.create_table(
+            'backups',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('file_name', sa.String(), nullable=False),
+            sa.Column('file_path', sa.String(), nullable=False),
+            sa.Column('original_path', sa.String(), nullable=True),
+            sa.Column('file_size', sa.Integer(), nullable=False),
+            sa.Column('file_type', sa.String(), nullable=False),
+            sa.Column('mime_type', sa.String(), nullable=True),
+            sa.Column('device_id', sa.String(), nullable=True),
+            sa.Column('timestamp', sa.DateTime(), nullable=True),
+            sa.Column('status', sa.String(), nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if 'ignored_files' not in existing_tables:
+        op.create_table(
+            'ignored_files',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('file_name', sa.String(), nullable=False),
+            sa.Column('device_id', sa.String(), nullable=True),
+            sa.Column('original_path', sa.String(), nullable=False),
+            sa.Column('timestamp', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('ignored_files')
+    op.drop_table('backups')
@@ -0,0 +1,63 @@
+"""Integrity scrub runs and findings
+
+Revision ID: a90f510c4bfb
+Revises: 829fa0321ae6
+Create Date: 2026-10-17 09:12:40.318224
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a90f510c4bfb'
+down_revision = '829fa0321ae6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.add_column(sa.Column('verified_at', sa.DateTime(), nullable=True))
+
+    op.create_table(
+        'scrub_runs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('last_backup_id', sa.Integer(), nullable=False),
+        sa.Column('total_files', sa.Integer(), nullable=False),
+        sa.Column('checked_files', sa.Integer(), nullable=False),
+        sa.Column('checked_bytes', sa.BigInteger(), nullable=False),
+        sa.Column('hashed_files', sa.Integer(), nullable=False),
+        sa.Column('missing_files', sa.Integer(), nullable=False),
+        sa.Column('corrupt_files', sa.Integer(), nullable=False),
+        sa.Column('scheduled_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    op.create_table(
+        'scrub_findings',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('run_id', sa.Integer(), nullable=False),
+        sa.Column('backup_id', sa.Integer(), nullable=False),
+        sa.Column('file_path', sa.String(), nullable=False),
+        sa.Column('problem', sa.String(), nullable=False),
+        sa.Column('expected_hash', sa.String(length=64), nullable=True),
+        sa.Column('actual_hash', sa.String(length=64), nullable=True),
+        sa.Column('found_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['run_id'], ['scrub_runs.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_scrub_findings_run_id', 'scrub_findings', ['run_id'])
+
+
+def downgrade():
+    op.drop_index('ix_scrub_findings_run_id', table_name='scrub_findings')
+    op.drop_table('scrub_findings')
+    op.drop_table('scrub_runs')
+
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.drop_column('verified_at')
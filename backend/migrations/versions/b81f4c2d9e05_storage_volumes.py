@@ -0,0 +1,42 @@
+"""Storage volumes for blobs, backups and upload sessions
+
+Revision ID: b81f4c2d9e05
+Revises: 6e2d9b4a1f37
+Create Date: 2026-10-17 16:02:18.540127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b81f4c2d9e05'
+down_revision = '6e2d9b4a1f37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Everything stored so far is on the drive at UPLOAD_FOLDER, the default volume.
+    # A constant default doesn't rewrite the table on Postgres 11+.
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.add_column(sa.Column('volume', sa.String(), server_default='default', nullable=False))
+        batch_op.create_index('ix_blobs_volume_hash', ['volume', 'hash'])
+
+    with op.batch_alter_table('backups') as batch_op:
+        batch_op.add_column(sa.Column('volume', sa.String(), server_default='default', nullable=False))
+
+    with op.batch_alter_table('upload_sessions') as batch_op:
+        batch_op.add_column(sa.Column('volume', sa.String(), server_default='default', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('upload_sessions') as batch_op:
+        batch_op.drop_column('volume')
+
+    with op.batch_alter_table('backups') as batch_op:
+        batch_op.drop_column('volume')
+
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.drop_index('ix_blobs_volume_hash')
+        batch_op.drop_column('volume')
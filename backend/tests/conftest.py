@@ -72,7 +72,9 @@ def app():
     app = create_app({
         'TESTING': True,
         'SQLALCHEMY_DATABASE_URI': get_test_db_url(),
-        'UPLOAD_FOLDER': upload_dir
+        'UPLOAD_FOLDER': upload_dir,
+        'THUMBNAIL_FOLDER': os.path.join(upload_dir, '.thumbnails'),
+        'THUMBNAIL_PREGENERATE': False
     })
     
     # Create tables
@@ -1,10 +1,31 @@
+import io
 import os
+import pstats
 import pytest
 import tempfile
 import shutil
-from datetime import datetime, UTC
-from app import create_app, db
-from app.models import Backup, IgnoredFile
+import tarfile
+import zipfile
+import gzip
+import json
+import base64
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta, UTC
+from app import admission as admission_module, create_app, db, encoding, storage, uploads
+from app.encoding import COLUMNAR_JSON, MSGPACK
+from app.jobs import claim_job, enqueue, job_handler, run_job
+from app.models import Backup, Blob, IgnoredFile, Job, ScrubRun, UploadSession
+from app.pool import InstrumentedQueuePool, engine_options, pool_metrics
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool
+from werkzeug.wsgi import FileWrapper
+from PIL import Image
 
 # Import fixtures directly since they're now the default ones
 from conftest import app, client
@@ -22,6 +43,62 @@ def test_ping(client):
     assert json_data['status'] == 'success'
     assert json_data['message'] == 'iClood server is online'
 
+def test_engine_options(monkeypatch):
+    """Test pool settings follow the worker model and PgBouncer mode"""
+    monkeypatch.setenv('GUNICORN_WORKER_CLASS', 'gthread')
+    monkeypatch.setenv('GUNICORN_THREADS', '4')
+    monkeypatch.setenv('DB_STATEMENT_TIMEOUT', '5')
+    monkeypatch.delenv('DB_POOL_SIZE', raising=False)
+    monkeypatch.delenv('DB_PGBOUNCER', raising=False)
+    
+    options = engine_options('postgresql://iclooduser@localhost/iclood')
+    assert options['poolclass'] is InstrumentedQueuePool
+    assert options['pool_size'] == 4
+    assert options['pool_pre_ping'] is True
+    assert options['connect_args']['options'] == '-c statement_timeout=5000'
+    
+    monkeypatch.setenv('DB_PGBOUNCER', '1')
+    options = engine_options('postgresql://iclooduser@localhost:6432/iclood')
+    assert options['poolclass'] is NullPool
+    assert 'options' not in options['connect_args']
+    
+    assert engine_options('sqlite:///iclood.db') == {}
+
+def test_pool_checkout_metrics(tmp_path):
+    """Test the instrumented pool records checkouts and timeouts"""
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1
+    )
+    pool_metrics.reset()
+    
+    with engine.connect():
+        with pytest.raises(PoolTimeoutError):
+            engine.connect()
+    
+    metrics = pool_metrics.snapshot()
+    assert metrics['checkouts'] == 1
+    assert metrics['timeouts'] == 1
+    assert metrics['wait_seconds_max'] >= 0.1
+    engine.dispose()
+
+def test_migrations_match_models(tmp_path):
+    """Test the migrations build the schema the models declare, and undo it"""
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'migrations.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads')
+    })
+    with app.app_context():
+        upgrade()
+        with db.engine.connect() as connection:
+            assert compare_metadata(MigrationContext.configure(connection), db.metadata) == []
+        
+        indexes = {index['name'] for index in inspect(db.engine).get_indexes('backups')}
+        assert 'ix_backups_completed_timestamp_id' in indexes
+        
+        downgrade(revision='base')
+        assert inspect(db.engine).get_table_names() == ['alembic_version']
+
 @pytest.mark.db
 def test_storage_status_empty(client):
     """Test storage status with no backups"""
@@ -37,6 +114,36 @@ def test_storage_status_empty(client):
     assert json_data['backups']['photo_count'] == 0
     assert json_data['backups']['video_count'] == 0
 
+@pytest.mark.db
+def test_storage_status_tracks_uploads(client, app, runner):
+    """Test that storage totals follow uploads and match a full rebuild"""
+    before = client.get('/storage/status').get_json()['backups']
+    
+    for name, file_type, content in [('s1.jpg', 'photo', b'12345'), ('s2.mp4', 'video', b'1234567890')]:
+        response = client.post(
+            '/photos/upload/stream',
+            query_string={
+                'file_name': name,
+                'original_path': f'/stats/{name}',
+                'file_type': file_type,
+                'device_id': 'stats_device'
+            },
+            data=content
+        )
+        assert response.status_code == 201
+    
+    after = client.get('/storage/status').get_json()['backups']
+    assert after['photo_count'] == before['photo_count'] + 1
+    assert after['video_count'] == before['video_count'] + 1
+    assert after['total_size_bytes'] == before['total_size_bytes'] + 15
+    assert after['last_backup'] is not None
+    
+    result = runner.invoke(args=['rebuild-stats'])
+    assert 'rebuilt' in result.output
+    rebuilt = client.get('/storage/status').get_json()['backups']
+    assert rebuilt['total_count'] == after['total_count']
+    assert rebuilt['total_size_bytes'] == after['total_size_bytes']
+
 @pytest.mark.db
 def test_new_photos_empty(client):
     """Test new photos endpoint with no files"""
@@ -96,6 +203,93 @@ def test_new_photos_with_files(client, app):
     assert len(json_data['new_files']) == 1
     assert json_data['new_files'][0]['path'] == '/path/to/new.jpg'
 
+@pytest.mark.db
+def test_new_photos_excludes_ignored_files(client, app):
+    """Test that ignored files are filtered out of the new photos page"""
+    with app.app_context():
+        db.session.add(IgnoredFile(
+            file_name='skip.jpg',
+            original_path='/path/to/skip.jpg',
+            device_id='scan_device'
+        ))
+        db.session.commit()
+    
+    response = client.post('/photos/new', json={
+        'device_id': 'scan_device',
+        'files': [
+            {'id': '1', 'path': '/path/to/skip.jpg', 'name': 'skip.jpg'},
+            {'id': '2', 'path': '/path/to/keep.jpg', 'name': 'keep.jpg'}
+        ]
+    })
+    
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert json_data['count'] == 1
+    assert json_data['new_files'][0]['id'] == '2'
+
+@pytest.mark.db
+def test_new_photos_rejects_oversized_page(client, app):
+    """Test that a scan page larger than SCAN_BATCH_LIMIT is rejected"""
+    limit = app.config['SCAN_BATCH_LIMIT']
+    response = client.post('/photos/new', json={
+        'device_id': 'scan_device',
+        'files': [{'id': str(i), 'path': f'/path/{i}.jpg'} for i in range(limit + 1)]
+    })
+    assert response.status_code == 413
+
+@pytest.mark.db
+def test_delta_sync(client):
+    """Test that delta scans move the device's high-water mark and answer with indexes"""
+    def scan_page(scan, paths, modified, done=True):
+        return client.post('/photos/sync', json={
+            'device_id': 'sync_phone', 'scan': scan, 'paths': paths, 'modified': modified, 'done': done
+        })
+    
+    client.post(
+        '/photos/upload/stream',
+        query_string={'file_name': 'a.jpg', 'original_path': '/sync/a.jpg', 'device_id': 'sync_phone'},
+        data=b'synced content'
+    )
+    client.post('/photos/ignore', json={'device_id': 'sync_phone', 'files': [{'path': '/sync/c.jpg'}]})
+    
+    response = client.post('/photos/sync/start', json={'device_id': 'sync_phone'})
+    assert response.status_code == 200
+    scan = response.get_json()['scan']
+    assert response.get_json()['synced_until'] == 0
+    
+    paths = ['/sync/a.jpg', '/sync/b.jpg', '/sync/c.jpg', '/sync/d.jpg']
+    response = scan_page(scan, paths[:2], [1000, 2000], done=False)
+    assert response.get_json()['needed'] == [1]
+    response = scan_page(scan, paths[2:], [3000, 4000])
+    json_data = response.get_json()
+    assert json_data['needed'] == [1]
+    # b.jpg still needs a backup, so the next scan starts from it
+    assert json_data['synced_until'] == 2000
+    assert scan_page(scan, paths, [1000, 2000, 3000, 4000]).status_code == 409
+    
+    # Malformed modification times are a client error
+    assert scan_page(scan, paths[:1], ['yesterday']).status_code == 400
+    assert scan_page(scan, paths[:1], 1000).status_code == 400
+    
+    client.post('/photos/ignore', json={'device_id': 'sync_phone', 'files': [{'path': '/sync/b.jpg'}, {'path': '/sync/d.jpg'}]})
+    scan = client.post('/photos/sync/start', json={'device_id': 'sync_phone'}).get_json()['scan']
+    response = scan_page(scan, paths[1:], [2000, 3000, 4000])
+    assert response.get_json()['count'] == 0
+    assert response.get_json()['synced_until'] == 4000
+    
+    # A mostly new page comes back as a bitmap
+    scan = client.post('/photos/sync/start', json={'device_id': 'sync_phone'}).get_json()['scan']
+    new_paths = [f'/sync/new_{i}.jpg' for i in range(100)]
+    json_data = scan_page(scan, new_paths + ['/sync/a.jpg'], list(range(5000, 5101))).get_json()
+    bitmap = base64.b64decode(json_data['needed_bitmap'])
+    assert [i for i in range(101) if bitmap[i // 8] >> (i % 8) & 1] == list(range(100))
+    assert json_data['synced_until'] == 5000
+    
+    # Unignoring brings files below the mark back, so the device rescans everything
+    client.post('/photos/unignore', json={'device_id': 'sync_phone', 'files': [{'path': '/sync/c.jpg'}]})
+    response = client.post('/photos/sync/start', json={'device_id': 'sync_phone'})
+    assert response.get_json()['synced_until'] == 0
+
 @pytest.mark.db
 def test_backup_history_empty(client):
     """Test backup history with no backups"""
@@ -143,6 +337,129 @@ def test_backup_history_with_backups(client, app):
     assert 'timestamp' in first_backup
     assert first_backup['status'] == 'Completed'
 
+@pytest.mark.db
+def test_backup_log_cursor_pagination(client, app):
+    """Test walking /backup/log with cursors and filters"""
+    with app.app_context():
+        start = datetime(2024, 1, 1)
+        db.session.add_all([
+            Backup(
+                file_name=f'page{i}.jpg',
+                file_path=f'2024/01/page{i}.jpg',
+                original_path=f'/page/{i}.jpg',
+                file_size=10,
+                file_type='video' if i % 3 == 0 else 'photo',
+                device_id='page_device',
+                status='Completed',
+                # Pairs of rows share a timestamp so the id tie-breaker is exercised
+                timestamp=start + timedelta(minutes=i // 2)
+            )
+            for i in range(25)
+        ])
+        db.session.commit()
+    
+    seen = []
+    cursor = None
+    while True:
+        query = {'device_id': 'page_device', 'limit': 10}
+        if cursor:
+            query['cursor'] = cursor
+        json_data = client.get('/backup/log', query_string=query).get_json()
+        seen.extend(backup['file_name'] for backup in json_data['backups'])
+        cursor = json_data['next_cursor']
+        if cursor is None:
+            break
+    
+    assert len(seen) == 25
+    assert len(set(seen)) == 25
+    assert seen[0] == 'page24.jpg'
+    
+    # Older clients still page by offset
+    json_data = client.get('/backup/log', query_string={'device_id': 'page_device', 'limit': 10, 'offset': 20}).get_json()
+    assert [backup['file_name'] for backup in json_data['backups']] == seen[20:]
+    
+    json_data = client.get('/backup/history', query_string={
+        'device_id': 'page_device',
+        'file_type': 'video',
+        'since': '2024-01-01T00:03:00',
+        'until': '2024-01-01T00:09:00'
+    }).get_json()
+    assert [row['file_type'] for row in json_data['history']] == ['video'] * 4
+    
+    response = client.get('/backup/log', query_string={'cursor': 'not-a-cursor'})
+    assert response.status_code == 400
+    
+    # Out of range limits are clamped to a page of at least one backup
+    for path in ('/backup/log', '/backup/history'):
+        for limit in (0, -5):
+            response = client.get(path, query_string={'device_id': 'page_device', 'limit': limit})
+            assert response.status_code == 200
+            assert len(response.get_json()['backups' if path == '/backup/log' else 'history']) == 1
+    
+    # A negative offset starts from the first page
+    json_data = client.get('/backup/log', query_string={'device_id': 'page_device', 'limit': 10, 'offset': -5}).get_json()
+    assert [backup['file_name'] for backup in json_data['backups']] == seen[:10]
+
+@pytest.mark.db
+def test_compact_encodings(client, app):
+    """Test columnar and MessagePack list responses and response compression"""
+    with app.app_context():
+        db.session.add_all([
+            Backup(
+                file_name=f'enc{i}.jpg',
+                file_path=f'2024/01/enc{i}.jpg',
+                original_path=f'/enc/{i}.jpg',
+                file_size=10,
+                file_type='photo',
+                device_id='encoding_device',
+                status='Completed'
+            )
+            for i in range(40)
+        ])
+        db.session.commit()
+    
+    query = {'device_id': 'encoding_device', 'limit': 40}
+    rows = client.get('/backup/log', query_string=query).get_json()['backups']
+    
+    response = client.get('/backup/log', query_string=query, headers={'Accept': COLUMNAR_JSON})
+    assert response.mimetype == COLUMNAR_JSON
+    assert 'Accept' in response.vary
+    columns = json.loads(response.data)['backups']
+    assert columns['file_name'] == [row['file_name'] for row in rows]
+    assert set(columns) == set(rows[0])
+    
+    # Rows sent by the client may have different keys
+    files = [{'id': 'a', 'path': '/enc/new-a.jpg'}, {'id': 'b', 'path': '/enc/new-b.jpg', 'size': 5}]
+    response = client.post('/photos/new', json={'device_id': 'encoding_device', 'files': files},
+                           headers={'Accept': COLUMNAR_JSON})
+    assert json.loads(response.data)['new_files'] == {
+        'id': ['a', 'b'], 'path': ['/enc/new-a.jpg', '/enc/new-b.jpg'], 'size': [None, 5]
+    }
+    
+    if encoding.msgpack is not None:
+        response = client.get('/backup/log', query_string=query, headers={'Accept': MSGPACK})
+        assert response.mimetype == MSGPACK
+        assert encoding.msgpack.unpackb(response.data)['backups'] == columns
+    
+    # Pages above COMPRESS_MIN_BYTES are compressed, small responses aren't
+    response = client.get('/backup/log', query_string=query, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.vary
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert json.loads(gzip.decompress(response.data))['backups'] == rows
+    
+    if encoding.brotli is not None:
+        response = client.get('/backup/log', query_string=query, headers={'Accept-Encoding': 'gzip, br'})
+        assert response.headers['Content-Encoding'] == 'br'
+        assert json.loads(encoding.brotli.decompress(response.data))['backups'] == rows
+    
+    response = client.get('/backup/log', query_string={**query, 'limit': 1}, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    
+    app.config['COMPRESS_RESPONSES'] = False
+    response = client.get('/backup/log', query_string=query, headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
 @pytest.mark.db
 def test_ignore_files(client):
     """Test ignoring files"""
@@ -162,6 +479,25 @@ def test_ignore_files(client):
     assert json_data['status'] == 'success'
     assert json_data['ignored_count'] == 1
 
+@pytest.mark.db
+def test_ignore_files_bulk_and_unignore(client):
+    """Test that re-ignoring is a no-op and unignore brings files back"""
+    files = [{'id': str(i), 'path': f'/bulk/ignore_{i}.png'} for i in range(50)]
+    
+    response = client.post('/photos/ignore', json={'device_id': 'bulk_device', 'files': files[:30]})
+    assert response.get_json()['ignored_count'] == 30
+    
+    # Only the 20 paths not yet ignored are inserted
+    response = client.post('/photos/ignore', json={'device_id': 'bulk_device', 'files': files})
+    assert response.get_json()['ignored_count'] == 20
+    
+    response = client.post('/photos/unignore', json={'device_id': 'bulk_device', 'files': files[:10]})
+    assert response.status_code == 200
+    assert response.get_json()['unignored_count'] == 10
+    
+    response = client.post('/photos/new', json={'device_id': 'bulk_device', 'files': files})
+    assert response.get_json()['count'] == 10
+
 @pytest.mark.db
 def test_upload_photo(client, app):
     """Test photo upload"""
@@ -195,6 +531,834 @@ def test_upload_photo(client, app):
             assert backup.file_type == 'photo'
             assert backup.device_id == 'test_device'
 
+@pytest.mark.db
+def test_upload_photo_batch(client, app):
+    """Test uploading several files in one request"""
+    response = client.post(
+        '/photos/upload',
+        data={
+            'file': (io.BytesIO(b'already here'), 'old.jpg'),
+            'original_path': '/batch/old.jpg',
+            'device_id': 'batch_device'
+        },
+        content_type='multipart/form-data'
+    )
+    assert response.status_code == 201
+    
+    response = client.post(
+        '/photos/upload/batch',
+        data={
+            'file': [
+                (io.BytesIO(b'first photo'), 'one.jpg'),
+                (io.BytesIO(b'already here'), 'old.jpg'),
+                (io.BytesIO(b'a video'), 'two.mp4')
+            ],
+            'original_path': ['/batch/one.jpg', '/batch/old.jpg', '/batch/two.mp4'],
+            'file_type': ['photo', 'photo', 'video'],
+            'device_id': 'batch_device'
+        },
+        content_type='multipart/form-data'
+    )
+    
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert json_data['uploaded_count'] == 2
+    assert json_data['failed_count'] == 0
+    assert [result['status'] for result in json_data['results']] == ['uploaded', 'exists', 'uploaded']
+    assert json_data['results'][2]['backup']['file_type'] == 'video'
+    
+    with app.app_context():
+        assert Backup.query.filter_by(device_id='batch_device', status='Completed').count() == 3
+
+@pytest.mark.db
+def test_upload_photo_stream(client, app):
+    """Test uploading a file as a raw request body"""
+    content = b'raw image content'
+    response = client.post(
+        '/photos/upload/stream',
+        query_string={
+            'file_name': 'raw.jpg',
+            'original_path': '/path/to/raw.jpg',
+            'file_type': 'photo',
+            'device_id': 'stream_device'
+        },
+        data=content,
+        content_type='image/jpeg'
+    )
+    
+    assert response.status_code == 201
+    backup = response.get_json()['backup']
+    assert backup['file_size'] == len(content)
+    assert backup['mime_type'] == 'image/jpeg'
+    
+    stored_path = os.path.join(app.config['UPLOAD_FOLDER'], backup['file_path'])
+    with open(stored_path, 'rb') as stored:
+        assert stored.read() == content
+    
+    # No temp files are left behind in the staging folder
+    staging = os.path.join(app.config['UPLOAD_FOLDER'], '.staging')
+    assert not [name for name in os.listdir(staging) if name.endswith('.part')]
+
+@pytest.mark.db
+def test_upload_deduplicates_content(client, app):
+    """Test that identical content is stored once and same-named files do not collide"""
+    def upload(content, device_id, original_path):
+        return client.post(
+            '/photos/upload/stream',
+            query_string={
+                'file_name': 'IMG_0001.jpg',
+                'original_path': original_path,
+                'device_id': device_id
+            },
+            data=content,
+            content_type='image/jpeg'
+        ).get_json()['backup']
+    
+    first = upload(b'same content', 'dedupe_phone', '/DCIM/IMG_0001.jpg')
+    second = upload(b'same content', 'dedupe_tablet', '/DCIM/IMG_0001.jpg')
+    other = upload(b'other content', 'dedupe_phone', '/DCIM/100/IMG_0001.jpg')
+    
+    assert first['content_hash'] == second['content_hash']
+    assert first['file_path'] == second['file_path']
+    assert other['content_hash'] != first['content_hash']
+    assert other['file_path'] != first['file_path']
+    
+    upload_folder = app.config['UPLOAD_FOLDER']
+    with open(os.path.join(upload_folder, first['file_path']), 'rb') as stored:
+        assert stored.read() == b'same content'
+    with open(os.path.join(upload_folder, other['file_path']), 'rb') as stored:
+        assert stored.read() == b'other content'
+    
+    # Re-uploading a failed backup with new content drops the old copy once nothing uses it
+    with app.app_context():
+        Backup.query.filter(Backup.device_id == 'dedupe_phone').update({'status': 'Failed'})
+        db.session.commit()
+    edited = upload(b'edited content', 'dedupe_phone', '/DCIM/100/IMG_0001.jpg')
+    upload(b'edited again', 'dedupe_phone', '/DCIM/IMG_0001.jpg')
+    with app.app_context():
+        while (job := claim_job('prune')) is not None:
+            run_job(job)
+            assert job.status == 'Completed'
+        assert db.session.get(Blob, other['content_hash']) is None
+        assert db.session.get(Blob, first['content_hash']) is not None
+        assert db.session.get(Blob, edited['content_hash']) is not None
+    assert not os.path.exists(os.path.join(upload_folder, other['file_path']))
+    assert os.path.exists(os.path.join(upload_folder, first['file_path']))
+
+@pytest.mark.db
+def test_link_known_content(client):
+    """Test that files with an already stored hash are backed up without an upload"""
+    content = b'linked content'
+    response = client.post(
+        '/photos/upload/stream',
+        query_string={'file_name': 'a.jpg', 'original_path': '/a.jpg', 'device_id': 'link_phone'},
+        data=content
+    )
+    content_hash = response.get_json()['backup']['content_hash']
+    assert content_hash == hashlib.sha256(content).hexdigest()
+    
+    response = client.post('/photos/link', json={
+        'device_id': 'link_tablet',
+        'files': [
+            {'id': '1', 'path': '/b.jpg', 'name': 'b.jpg', 'hash': content_hash},
+            {'id': '2', 'path': '/c.jpg', 'name': 'c.jpg', 'hash': '0' * 64}
+        ]
+    })
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert json_data['linked_count'] == 1
+    assert json_data['linked'][0]['content_hash'] == content_hash
+    assert [file['id'] for file in json_data['missing']] == ['2']
+    
+    # The linked file no longer shows up as new
+    response = client.post('/photos/new', json={
+        'device_id': 'link_tablet',
+        'files': [{'id': '1', 'path': '/b.jpg'}]
+    })
+    assert response.get_json()['count'] == 0
+
+@pytest.mark.db
+def test_chunked_upload_session(client, app):
+    """Test creating, resuming and finalizing a chunked upload"""
+    content = b'0123456789' * 10
+    response = client.post('/photos/uploads', json={
+        'file_name': 'clip.mp4',
+        'original_path': '/path/to/clip.mp4',
+        'file_type': 'video',
+        'mime_type': 'video/mp4',
+        'device_id': 'chunk_device',
+        'total_size': len(content)
+    })
+    assert response.status_code == 201
+    session_id = response.get_json()['session']['id']
+    
+    response = client.put(
+        f'/photos/uploads/{session_id}',
+        data=content[:40],
+        headers={'Content-Range': f'bytes 0-39/{len(content)}'}
+    )
+    assert response.status_code == 200
+    
+    # Finalizing before every byte has arrived is refused
+    response = client.post(f'/photos/uploads/{session_id}/finalize')
+    assert response.status_code == 409
+    
+    # A chunk at the wrong offset reports where to resume
+    response = client.put(
+        f'/photos/uploads/{session_id}',
+        data=content[50:],
+        headers={'Content-Range': f'bytes 50-99/{len(content)}'}
+    )
+    assert response.status_code == 409
+    assert response.get_json()['session']['received_bytes'] == 40
+    
+    response = client.get(f'/photos/uploads/{session_id}')
+    assert response.get_json()['session']['received_bytes'] == 40
+    
+    # A chunk arriving while another request writes to the session is turned away
+    with app.app_context():
+        session = db.session.get(UploadSession, session_id)
+        with uploads.locked_staging_file(session.id, session.volume):
+            response = client.put(
+                f'/photos/uploads/{session_id}',
+                data=content[40:],
+                headers={'Content-Range': f'bytes 40-99/{len(content)}'}
+            )
+            assert response.status_code == 409
+    
+    response = client.put(
+        f'/photos/uploads/{session_id}',
+        data=content[40:],
+        headers={'Content-Range': f'bytes 40-99/{len(content)}'}
+    )
+    assert response.status_code == 200
+    
+    response = client.post(f'/photos/uploads/{session_id}/finalize')
+    assert response.status_code == 201
+    backup = response.get_json()['backup']
+    assert backup['file_size'] == len(content)
+    
+    stored_path = os.path.join(app.config['UPLOAD_FOLDER'], backup['file_path'])
+    with open(stored_path, 'rb') as stored:
+        assert stored.read() == content
+    
+    # The session is gone once finalized
+    response = client.get(f'/photos/uploads/{session_id}')
+    assert response.status_code == 404
+    
+    # An abandoned session expires with its staging file
+    response = client.post('/photos/uploads', json={
+        'file_name': 'abandoned.mp4',
+        'device_id': 'chunk_device',
+        'total_size': len(content)
+    })
+    session_id = response.get_json()['session']['id']
+    with app.app_context():
+        job = Job.query.filter_by(job_type='upload_expiry', status='Pending').one()
+        assert job.run_after > datetime.now(UTC).replace(tzinfo=None) + timedelta(hours=71)
+        
+        session = db.session.get(UploadSession, session_id)
+        staging_file = uploads.staging_path(session.id, session.volume)
+        assert os.path.exists(staging_file)
+        session.updated_at = datetime.now(UTC) - timedelta(hours=73)
+        db.session.commit()
+        
+        assert uploads.expire_upload_sessions() == (1, None)
+        assert not os.path.exists(staging_file)
+    response = client.get(f'/photos/uploads/{session_id}')
+    assert response.status_code == 404
+
+@pytest.mark.db
+def test_photo_thumbnail(client, app):
+    """Test thumbnail generation, format negotiation and conditional GETs"""
+    image_bytes = io.BytesIO()
+    Image.new('RGB', (800, 600), 'red').save(image_bytes, 'JPEG')
+    response = client.post(
+        '/photos/upload/stream',
+        query_string={'file_name': 'thumb.jpg', 'original_path': '/thumb.jpg', 'device_id': 'thumb_device'},
+        data=image_bytes.getvalue(),
+        content_type='image/jpeg'
+    )
+    backup_id = response.get_json()['backup']['id']
+    
+    response = client.get(f'/photos/{backup_id}/thumbnail', query_string={'size': 100})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    etag = response.headers['ETag']
+    with Image.open(io.BytesIO(response.data)) as thumbnail:
+        assert max(thumbnail.size) == 128
+    
+    response = client.get(f'/photos/{backup_id}/thumbnail', query_string={'size': 100},
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    
+    response = client.get(f'/photos/{backup_id}/thumbnail', headers={'Accept': 'image/webp'})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    
+    response = client.get('/photos/999999/thumbnail')
+    assert response.status_code == 404
+    
+    # iPhone photos are mostly HEIC
+    pytest.importorskip('pillow_heif')
+    image_bytes = io.BytesIO()
+    Image.new('RGB', (800, 600), 'blue').save(image_bytes, 'HEIF')
+    response = client.post(
+        '/photos/upload/stream',
+        query_string={'file_name': 'thumb.heic', 'original_path': '/thumb.heic', 'device_id': 'thumb_device'},
+        data=image_bytes.getvalue(),
+        content_type='image/heic'
+    )
+    response = client.get(f"/photos/{response.get_json()['backup']['id']}/thumbnail", query_string={'size': 100})
+    assert response.status_code == 200
+    with Image.open(io.BytesIO(response.data)) as thumbnail:
+        assert max(thumbnail.size) == 128
+
+@pytest.mark.db
+def test_photo_content_ranges(client, app):
+    """Test downloading a backed up file whole, by byte range and conditionally"""
+    content = bytes(range(256)) * 40
+    response = client.post(
+        '/photos/upload/stream',
+        query_string={'file_name': 'clip.mov', 'original_path': '/clip.mov', 'device_id': 'content_device'},
+        data=content,
+        content_type='video/quicktime'
+    )
+    backup_id = response.get_json()['backup']['id']
+    
+    response = client.get(f'/photos/{backup_id}/content')
+    assert response.status_code == 200
+    assert response.data == content
+    assert response.mimetype == 'video/quicktime'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['ETag'] == f'"{hashlib.sha256(content).hexdigest()}"'
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    
+    response = client.get(f'/photos/{backup_id}/content', headers={'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-1999/{len(content)}'
+    assert response.data == content[1000:2000]
+    
+    response = client.get(f'/photos/{backup_id}/content', headers={'Range': 'bytes=-100'})
+    assert response.data == content[-100:]
+    
+    # A range of a file that changed since gets the whole new file
+    response = client.get(f'/photos/{backup_id}/content', headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert len(response.data) == len(content)
+    
+    response = client.get(f'/photos/{backup_id}/content', headers={'Range': f'bytes={len(content)}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(content)}'
+    
+    assert client.get(f'/photos/{backup_id}/content', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(f'/photos/{backup_id}/content', headers={'If-Modified-Since': last_modified}).status_code == 304
+    
+    response = client.get(f'/photos/{backup_id}/content', query_string={'download': '1'})
+    assert response.headers['Content-Disposition'] == 'attachment; filename=clip.mov'
+    
+    # gunicorn sends the file from its position with sendfile(), up to Content-Length
+    response = client.get(f'/photos/{backup_id}/content', headers={'Range': 'bytes=1000-1999'}, environ_overrides={
+        'wsgi.file_wrapper': FileWrapper,
+        'SERVER_SOFTWARE': 'gunicorn/23.0.0'
+    })
+    assert response.headers['Content-Length'] == '1000'
+    assert response.data.startswith(content[1000:2000])
+    
+    with app.app_context():
+        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], db.session.get(Backup, backup_id).file_path))
+    assert client.get(f'/photos/{backup_id}/content').status_code == 404
+    assert client.get('/photos/999999/content').status_code == 404
+
+@pytest.mark.db
+def test_backup_archive(client, app):
+    """Test streaming a device's backups as tar and zip archives and resuming them"""
+    contents = {}
+    for i in range(3):
+        contents[f'archive_device/DCIM/IMG_{i}.JPG'] = os.urandom(1000 + i)
+        client.post(
+            '/photos/upload/stream',
+            query_string={'file_name': f'IMG_{i}.JPG', 'original_path': f'file:///DCIM/IMG_{i}.JPG', 'device_id': 'archive_device'},
+            data=contents[f'archive_device/DCIM/IMG_{i}.JPG'],
+            content_type='image/jpeg'
+        )
+    client.post(
+        '/photos/upload/stream',
+        query_string={'file_name': 'other.jpg', 'original_path': '/other.jpg', 'device_id': 'other_archive_device'},
+        data=b'other',
+        content_type='image/jpeg'
+    )
+    
+    response = client.get('/backup/archive', query_string={'device_id': 'archive_device'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-tar'
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        members = archive.getmembers()
+        assert {member.name: archive.extractfile(member).read() for member in members} == contents
+        cursor = members[0].pax_headers['comment'][len('ICLOOD.cursor='):]
+    
+    # Resume after the first entry
+    response = client.get('/backup/archive', query_string={'device_id': 'archive_device', 'cursor': cursor})
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        assert archive.getnames() == [member.name for member in members[1:]]
+    
+    response = client.get('/backup/archive', query_string={'device_id': 'archive_device', 'format': 'zip'})
+    assert response.mimetype == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert {info.filename: archive.read(info) for info in archive.infolist()} == contents
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+        assert archive.infolist()[0].comment.decode() == f'ICLOOD.cursor={cursor}'
+    
+    # A file missing from the drive is left out instead of breaking the archive
+    with app.app_context():
+        backup = Backup.query.filter_by(device_id='archive_device', file_name='IMG_1.JPG').one()
+        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], backup.file_path))
+    response = client.get('/backup/archive', query_string={'device_id': 'archive_device'})
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        assert len(archive.getnames()) == 2
+    
+    assert client.get('/backup/archive', query_string={'format': 'rar'}).status_code == 400
+    assert client.get('/backup/archive', query_string={'cursor': 'not-a-cursor'}).status_code == 400
+
+@pytest.mark.db
+def test_storage_volumes(client, app, monkeypatch, tmp_path):
+    """Test spreading uploads over two volumes and moving a file between them"""
+    monkeypatch.setitem(app.config, 'STORAGE_VOLUMES', f'extra={tmp_path}')
+    monkeypatch.setitem(app.config, 'STORAGE_PLACEMENT', 'round_robin')
+    monkeypatch.setitem(app.config, 'STORAGE_RESERVE_MB', 0)
+    
+    contents = {}
+    for i in range(2):
+        contents[f'IMG_{i}.JPG'] = os.urandom(2000 + i)
+        response = client.post(
+            '/photos/upload/stream',
+            query_string={'file_name': f'IMG_{i}.JPG', 'original_path': f'/volumes/IMG_{i}.JPG', 'device_id': 'volume_device'},
+            data=contents[f'IMG_{i}.JPG'],
+            content_type='image/jpeg'
+        )
+        assert response.status_code == 201
+    
+    with app.app_context():
+        backups = Backup.query.filter_by(device_id='volume_device').all()
+        assert {backup.volume for backup in backups} == {'default', 'extra'}
+        for backup in backups:
+            assert db.session.get(Blob, backup.content_hash).volume == backup.volume
+            assert storage.stored_file_exists(backup.volume, backup.file_path)
+            response = client.get(f'/photos/{backup.id}/content')
+            assert response.data == contents[backup.file_name]
+    
+    response = client.get('/storage/status')
+    assert [volume['name'] for volume in response.get_json()['storage']['volumes']] == ['default', 'extra']
+    
+    # Moving a blob repoints its backups and removes the old copy
+    with app.app_context():
+        backup = Backup.query.filter_by(device_id='volume_device', volume='default').one()
+        old_path = storage.stored_path('default', backup.file_path)
+        assert storage.move_blob(db.session.get(Blob, backup.content_hash), 'extra') == len(contents[backup.file_name])
+        backup = db.session.get(Backup, backup.id)
+        assert backup.volume == 'extra'
+        assert not os.path.exists(old_path)
+        assert client.get(f'/photos/{backup.id}/content').data == contents[backup.file_name]
+    
+    # Different content under a taken name gets a new name, never overwriting a file
+    with app.app_context():
+        names = []
+        for i in range(3):
+            source_path = tmp_path / f'clash_{i}.part'
+            source_path.write_bytes(b'clash %d' % i)
+            names.append(storage.place_file(str(source_path), 'extra', 'CLASH.JPG', 'ab' * 32))
+        assert names == ['CLASH.JPG', f'CLASH_{"ab" * 6}.JPG', f'CLASH_{"ab" * 6}_2.JPG']
+        assert (tmp_path / 'CLASH.JPG').read_bytes() == b'clash 0'
+    
+    # The plan evens out the backups stored on the drives, other files on them don't count
+    monkeypatch.setattr(storage, 'volume_usage', lambda: [
+        {'name': 'default', 'folder': '/a', 'device': 1, 'total': 5000, 'used': 4900, 'free': 100},
+        {'name': 'extra', 'folder': '/b', 'device': 2, 'total': 3000, 'used': 300, 'free': 2700}
+    ])
+    monkeypatch.setattr(storage, 'stored_bytes', lambda: {'default': 900, 'extra': 300})
+    with app.app_context():
+        assert storage.rebalance_plan() == ('default', 'extra', 600)
+        assert storage.total_usage() == (8000, 5200, 2800)
+    
+    # Two drives of their own, the full one only holding blobs whose files are gone
+    for name in ('full', 'empty'):
+        (tmp_path / name).mkdir()
+    monkeypatch.setitem(app.config, 'STORAGE_VOLUMES', f"full={tmp_path / 'full'},empty={tmp_path / 'empty'}")
+    monkeypatch.setitem(app.config, 'STORAGE_REBALANCE_BATCH_SIZE', 1)
+    monkeypatch.setattr(storage, 'volume_usage', lambda: [
+        {'name': 'full', 'folder': '/a', 'device': 1, 'total': 1000, 'used': 900, 'free': 100},
+        {'name': 'empty', 'folder': '/b', 'device': 2, 'total': 3000, 'used': 300, 'free': 2700}
+    ])
+    monkeypatch.setattr(storage, 'stored_bytes', lambda: {'full': 900, 'empty': 300})
+    with app.app_context():
+        Job.query.filter_by(job_type='rebalance').delete()
+        db.session.add_all([
+            Blob(hash=f'{i:02d}' * 32, volume='full', file_path=f'gone_{i}.jpg', file_size=450) for i in range(2)
+        ])
+        db.session.commit()
+        
+        # A batch of files that can't move carries on past them while the source has more
+        for i in range(2):
+            job = claim_job('rebalance') if i else None
+            storage.rebalance_batch(job.payload if job else {})
+            if job:
+                job.status = 'Completed'
+            db.session.commit()
+            job = Job.query.filter_by(job_type='rebalance', status='Pending').one()
+            assert job.payload == {'source': 'full', 'after': f'{i:02d}' * 32}
+            assert job.run_after <= datetime.now(UTC).replace(tzinfo=None)
+        
+        # Once the source is worked through, the pass waits instead of restarting on every upload
+        job = claim_job('rebalance')
+        storage.rebalance_batch(job.payload)
+        job.status = 'Completed'
+        db.session.commit()
+        job = Job.query.filter_by(job_type='rebalance', status='Pending').one()
+        assert job.run_after > datetime.now(UTC).replace(tzinfo=None) + timedelta(hours=23)
+        storage.request_rebalance_if_uneven()
+        assert Job.query.filter_by(job_type='rebalance', status='Pending').count() == 1
+        assert storage.queue_rebalance() is job
+        assert job.run_after <= datetime.now(UTC).replace(tzinfo=None)
+        
+        Job.query.filter_by(job_type='rebalance').delete()
+        Blob.query.filter_by(volume='full').delete()
+        db.session.commit()
+
+@pytest.mark.db
+def test_upload_admission(client, app, monkeypatch):
+    """Test uploads past the limits are queued fairly across devices or turned away with a 429"""
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_CONCURRENT', 2)
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_PER_DEVICE', 0)
+    monkeypatch.setitem(app.config, 'UPLOAD_QUEUE_SIZE', 0)
+    admission = app.extensions['upload_admission']
+    with app.app_context():
+        admission.acquire('busy_phone')
+        admission.acquire('busy_phone')
+    
+    response = client.post(
+        '/photos/upload/stream',
+        query_string={'file_name': 'queued.jpg', 'original_path': '/admission/queued.jpg', 'device_id': 'quiet_phone'},
+        data=b'queued',
+        content_type='image/jpeg'
+    )
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert 'iclood_upload_rejections_total{reason="queue_full"}' in client.get('/metrics').get_data(as_text=True)
+    
+    # The busy phone queued first, but the phone with nothing in progress gets the next free slot
+    monkeypatch.setitem(app.config, 'UPLOAD_QUEUE_SIZE', 2)
+    admitted = []
+
+    def wait_for_slot(device_id):
+        with app.app_context():
+            admission.acquire(device_id)
+            admitted.append(device_id)
+    
+    threads = []
+    for device_id in ('busy_phone', 'quiet_phone'):
+        threads.append(threading.Thread(target=wait_for_slot, args=(device_id,)))
+        threads[-1].start()
+        while device_id not in admission.waiting:
+            time.sleep(0.01)
+    with app.app_context():
+        admission.release('busy_phone', 1)
+        threads[1].join(5)
+        admission.release('quiet_phone', 1)
+        threads[0].join(5)
+        admission.release('busy_phone', 1)
+        admission.release('busy_phone', 1)
+    assert admitted == ['quiet_phone', 'busy_phone']
+    
+    response = client.post(
+        '/photos/upload/stream',
+        query_string={'file_name': 'queued.jpg', 'original_path': '/admission/queued.jpg', 'device_id': 'quiet_phone'},
+        data=b'queued',
+        content_type='image/jpeg'
+    )
+    assert response.status_code == 201
+    assert admission.total_active == 0
+
+@pytest.mark.db
+def test_upload_plan(client, app, monkeypatch):
+    """Test the upload plan shares the slots between devices and sizes chunks from the measured speed"""
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_CONCURRENT', 4)
+    monkeypatch.setitem(app.config, 'UPLOAD_MAX_PER_DEVICE', 0)
+    monkeypatch.setattr(admission_module, 'upload_speed', admission_module.UploadSpeed())
+    
+    plan = client.get('/photos/upload/plan', headers={'X-Device-Id': 'planning_phone'}).get_json()['plan']
+    assert plan['concurrency'] == 4
+    assert plan['chunk_size'] == admission_module.DEFAULT_CHUNK_SIZE
+    assert plan['retry_after'] is None
+    
+    # Another phone uploading gets half the slots
+    admission = app.extensions['upload_admission']
+    with app.app_context():
+        admission.acquire('other_phone')
+        try:
+            plan = client.get('/photos/upload/plan', query_string={'device_id': 'planning_phone'}).get_json()['plan']
+            assert plan['concurrency'] == 2
+            assert plan['uploads_in_progress'] == 1
+        finally:
+            admission.release('other_phone', 1)
+    
+    # 10MB/s uploads onto a drive writing 20MB/s: two at once, 32MB chunks at most
+    admission_module.upload_speed.observe(10 * 1024 * 1024, 1.0, 0.5)
+    plan = client.get('/photos/upload/plan', query_string={'device_id': 'planning_phone'}).get_json()['plan']
+    assert plan['concurrency'] == 2
+    assert plan['chunk_size'] == admission_module.MAX_CHUNK_SIZE
+    assert plan['batch_size'] == 10
+
+@pytest.mark.db
+def test_job_queue_retries_and_depth(client, app):
+    """Test that failed jobs are retried and the queue depth is reported"""
+    calls = []
+    
+    @job_handler('test_flaky')
+    def flaky(payload):
+        calls.append(payload['n'])
+        if len(calls) == 1:
+            raise RuntimeError('first attempt fails')
+    
+    app.config['JOB_RETRY_DELAY'] = 0
+    with app.app_context():
+        enqueue('test_flaky', {'n': 1})
+        db.session.commit()
+        
+        response = client.get('/jobs/status')
+        assert response.get_json()['queues']['test_flaky']['Pending'] == 1
+        
+        run_job(claim_job('test_flaky'))
+        run_job(claim_job('test_flaky'))
+        job = Job.query.filter_by(job_type='test_flaky').one()
+        assert calls == [1, 1]
+        assert job.status == 'Completed'
+        assert job.attempts == 2
+        assert claim_job('test_flaky') is None
+
+@pytest.mark.db
+def test_integrity_scrub(client, app):
+    """Test that a scrub flags missing and corrupt files, checksums old backups and resumes per file"""
+    def upload(content, device_id, original_path):
+        return client.post(
+            '/photos/upload/stream',
+            query_string={'file_name': 'scrub.jpg', 'original_path': original_path, 'device_id': device_id},
+            data=content,
+            content_type='image/jpeg'
+        ).get_json()['backup']
+    
+    upload_folder = app.config['UPLOAD_FOLDER']
+    intact = upload(b'intact content', 'scrub_phone', '/scrub/intact.jpg')
+    missing = upload(b'missing content', 'scrub_phone', '/scrub/missing.jpg')
+    corrupt = upload(b'corrupt content', 'scrub_phone', '/scrub/corrupt.jpg')
+    shared = upload(b'corrupt content', 'scrub_tablet', '/scrub/corrupt.jpg')
+    os.remove(os.path.join(upload_folder, missing['file_path']))
+    with open(os.path.join(upload_folder, corrupt['file_path']), 'wb') as stored:
+        stored.write(b'CORRUPT content')
+    
+    # Backups from before content hashes were stored, one a copy of content stored since
+    legacy_files = {'scrub_legacy.jpg': b'legacy content', 'scrub_legacy_copy.jpg': b'intact content'}
+    for name, content in legacy_files.items():
+        with open(os.path.join(upload_folder, name), 'wb') as stored:
+            stored.write(content)
+    with app.app_context():
+        legacy, legacy_copy = [Backup(
+            file_name=name, file_path=name, original_path=f'/scrub/{name}',
+            file_size=len(content), file_type='photo', device_id='scrub_phone', status='Completed'
+        ) for name, content in legacy_files.items()]
+        db.session.add_all([legacy, legacy_copy])
+        db.session.commit()
+        legacy_id, legacy_copy_id = legacy.id, legacy_copy.id
+    
+    app.config['SCRUB_MAX_MBPS'] = 0
+    app.config['SCRUB_BATCH_SIZE'] = 1
+    response = client.post('/admin/scrub')
+    assert response.status_code == 202
+    run_id = response.get_json()['run']['id']
+    
+    with app.app_context():
+        # Only check the backups made by this test
+        db.session.get(ScrubRun, run_id).last_backup_id = intact['id'] - 1
+        db.session.commit()
+        
+        run_job(claim_job('scrub'))
+        run = db.session.get(ScrubRun, run_id)
+        assert run.status == 'Running'
+        assert run.checked_files == 1
+        assert client.post('/admin/scrub').status_code == 409
+        
+        while (job := claim_job('scrub')) is not None:
+            run_job(job)
+        
+        statuses = {backup.id: backup.status for backup in Backup.query.filter(Backup.id >= intact['id'])}
+        assert statuses == {
+            intact['id']: 'Completed', missing['id']: 'Failed', corrupt['id']: 'Failed',
+            shared['id']: 'Failed', legacy_id: 'Completed', legacy_copy_id: 'Completed'
+        }
+        assert db.session.get(Backup, legacy_id).content_hash == hashlib.sha256(b'legacy content').hexdigest()
+        
+        # The old copy of known content now uses the blob's file, the duplicate is gone
+        legacy_copy = db.session.get(Backup, legacy_copy_id)
+        assert (legacy_copy.content_hash, legacy_copy.file_path) == (intact['content_hash'], intact['file_path'])
+        assert not os.path.exists(os.path.join(upload_folder, 'scrub_legacy_copy.jpg'))
+    
+    response = client.get('/admin/scrub')
+    assert response.status_code == 200
+    json_data = response.get_json()
+    assert json_data['run']['id'] == run_id
+    assert json_data['run']['status'] == 'Completed'
+    assert json_data['run']['missing_files'] == 1
+    assert json_data['run']['corrupt_files'] == 2
+    assert json_data['run']['hashed_files'] == 2
+    assert json_data['next_run_at'] is not None
+    assert {(finding['backup_id'], finding['problem']) for finding in json_data['findings']} == {
+        (missing['id'], 'missing'), (corrupt['id'], 'corrupt'), (shared['id'], 'corrupt')
+    }
+    
+    # The corrupt copy is moved aside, so uploading the file again restores it
+    assert not os.path.exists(os.path.join(upload_folder, corrupt['file_path']))
+    restored = upload(b'corrupt content', 'scrub_phone', '/scrub/corrupt.jpg')
+    assert restored['status'] == 'Completed'
+    with open(os.path.join(upload_folder, restored['file_path']), 'rb') as stored:
+        assert stored.read() == b'corrupt content'
+    
+    assert client.get('/admin/scrub?run_id=999999').status_code == 404
+
+@pytest.mark.db
+def test_prune_backups(client, app, monkeypatch):
+    """Test that pruning reports, deletes in batches, keeps shared content and frees space on a low drive"""
+    def upload(content, device_id, original_path):
+        return client.post(
+            '/photos/upload/stream',
+            query_string={'file_name': 'prune.jpg', 'original_path': original_path, 'device_id': device_id},
+            data=content,
+            content_type='image/jpeg'
+        ).get_json()['backup']
+    
+    upload_folder = app.config['UPLOAD_FOLDER']
+    old_own = upload(b'old own content', 'prune_phone', '/prune/old_own.jpg')
+    old_shared = upload(b'old shared content', 'prune_phone', '/prune/old_shared.jpg')
+    upload(b'old shared content', 'prune_tablet', '/prune/old_shared.jpg')
+    recent = upload(b'recent content', 'prune_phone', '/prune/recent.jpg')
+    with app.app_context():
+        for backup_id, days in ((old_own['id'], 100), (old_shared['id'], 90)):
+            db.session.get(Backup, backup_id).timestamp = datetime.utcnow() - timedelta(days=days)
+        db.session.commit()
+    before = client.get('/storage/status').get_json()['backups']
+    
+    policy = {'device_ids': ['prune_phone'], 'older_than_days': 30}
+    response = client.post('/admin/prune', json=policy)
+    assert response.status_code == 200
+    report = response.get_json()['report']
+    assert report['dry_run'] is True
+    assert report['pruned_files'] == 2
+    assert report['pruned_bytes'] == len(b'old own content') + len(b'old shared content')
+    # The tablet still has the shared content, only the other file frees space
+    assert report['reclaimed_bytes'] == len(b'old own content')
+    assert os.path.exists(os.path.join(upload_folder, old_own['file_path']))
+    
+    assert client.post('/admin/prune', json={'file_types': ['video']}).status_code == 400
+    
+    monkeypatch.setitem(app.config, 'PRUNE_BATCH_SIZE', 1)
+    response = client.post('/admin/prune', json={**policy, 'dry_run': False})
+    assert response.status_code == 202
+    with app.app_context():
+        run_job(claim_job('prune'))
+        remaining = {backup.id for backup in Backup.query.filter_by(device_id='prune_phone')}
+        assert remaining == {recent['id']}
+        assert db.session.get(Blob, old_own['content_hash']) is None
+        assert db.session.get(Blob, old_shared['content_hash']) is not None
+    assert not os.path.exists(os.path.join(upload_folder, old_own['file_path']))
+    assert os.path.exists(os.path.join(upload_folder, old_shared['file_path']))
+    
+    after = client.get('/storage/status').get_json()['backups']
+    assert after['photo_count'] == before['photo_count'] - 2
+    assert after['total_size_bytes'] == before['total_size_bytes'] - report['pruned_bytes']
+    
+    # Pruned files are not offered for backup again
+    response = client.post('/photos/new', json={
+        'device_id': 'prune_phone',
+        'files': [{'id': '1', 'path': '/prune/old_own.jpg'}, {'id': '2', 'path': '/prune/old_shared.jpg'}]
+    })
+    assert response.get_json()['count'] == 0
+    
+    # An upload onto a nearly full drive queues a prune of the oldest backups until enough is free
+    monkeypatch.setitem(app.config, 'PRUNE_MIN_FREE_PERCENT', 10)
+    monkeypatch.setitem(app.config, 'PRUNE_TARGET_FREE_PERCENT', 19)
+    monkeypatch.setitem(app.config, 'PRUNE_DEVICES', 'prune_phone')
+    monkeypatch.setitem(app.config, 'PRUNE_BATCH_SIZE', 200)
+    monkeypatch.setattr('app.prune.total_usage', lambda: (100, 95, 5))
+    newest = upload(b'newest content', 'prune_phone', '/prune/newest.jpg')
+    with app.app_context():
+        run_job(claim_job('prune'))
+        # 14 bytes are needed, the oldest backup is enough
+        remaining = {backup.id for backup in Backup.query.filter_by(device_id='prune_phone')}
+        assert remaining == {newest['id']}
+
+@pytest.mark.db
+def test_metrics_endpoint(client, app):
+    """Test /metrics reports route latency, database queries and upload bytes"""
+    client.get('/storage/status')
+    content = b'metrics content' * 1000
+    response = client.post(
+        '/photos/upload/stream',
+        query_string={
+            'file_name': 'metrics.jpg',
+            'original_path': '/path/to/metrics.jpg',
+            'device_id': 'metrics_device'
+        },
+        data=content,
+        content_type='image/jpeg'
+    )
+    assert response.status_code == 201
+    
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    
+    samples = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    
+    assert samples['iclood_request_duration_seconds_count{endpoint="/storage/status",method="GET"}'] >= 1
+    assert samples['iclood_requests_total{endpoint="/photos/upload/stream",method="POST",status="201"}'] >= 1
+    assert samples['iclood_db_queries_per_request_sum{endpoint="/photos/upload/stream"}'] >= 1
+    assert samples['iclood_upload_bytes_total'] >= len(content)
+    assert samples['iclood_uploads_in_flight'] == 0
+
+@pytest.mark.db
+def test_slow_request_profiles(client, app, monkeypatch, tmp_path):
+    """Test slow or flagged requests are profiled, rotated, listed and downloadable"""
+    monkeypatch.setitem(app.config, 'PROFILE_FOLDER', str(tmp_path))
+    monkeypatch.setitem(app.config, 'PROFILE_KEEP', 2)
+    monkeypatch.setitem(app.config, 'PROFILE_REQUESTS', True)
+    monkeypatch.setitem(app.config, 'PROFILE_SLOW_MS', 60000)
+    
+    # Requests under the threshold are not kept
+    client.get('/storage/status')
+    assert client.get('/admin/profiles').get_json()['count'] == 0
+    
+    # The header keeps a profile whatever the duration, the oldest are rotated out
+    for _ in range(3):
+        assert client.get('/storage/status', headers={'X-Profile': '1'}).status_code == 200
+    profiles = client.get('/admin/profiles').get_json()['profiles']
+    assert len(profiles) == 2
+    assert profiles[0]['path'] == '/storage/status'
+    assert profiles[0]['status'] == 200
+    
+    response = client.get(f"/admin/profiles/{profiles[0]['name']}")
+    assert response.status_code == 200
+    downloaded = tmp_path / 'downloaded.prof'
+    downloaded.write_bytes(response.data)
+    assert pstats.Stats(str(downloaded)).total_calls > 0
+    
+    response = client.get(f"/admin/profiles/{profiles[0]['name']}", query_string={'format': 'text', 'sort': 'tottime'})
+    assert response.status_code == 200
+    assert 'function calls' in response.get_data(as_text=True)
+    
+    assert client.get('/admin/profiles/missing.prof').status_code == 404
+
 def test_error_handling(client):
     """Test error handling for various scenarios"""
     # Test missing files in new photos request
@@ -304,5 +1468,5 @@ def test_backup_state_persistence(client, app):
             assert json_data['status'] == 'success'
             assert json_data['backups']['total_count'] == 1
             assert json_data['backups']['photo_count'] == 1
-            
+        
         print("\nDebug: Test completed successfully")
@@ -0,0 +1,62 @@
+from app import create_app, db
+from app.jobs import parse_concurrency, work
+import time
+import logging
+import signal
+import argparse
+import multiprocessing
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the background job workers')
+    parser.add_argument('-c', '--concurrency', default=None,
+                      help='Worker processes per job type, e.g. "thumbnails=2" (default: JOB_CONCURRENCY)')
+    return parser.parse_args()
+
+def run_worker(job_type, stop_event):
+    # Shutdown is driven by the parent through stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    
+    # Each process builds its own app so it gets its own database connections
+    app = create_app()
+    with app.app_context():
+        work(job_type, stop_event)
+
+if __name__ == '__main__':
+    args = parse_args()
+    app = create_app()
+    limits = parse_concurrency(args.concurrency or app.config['JOB_CONCURRENCY'])
+    
+    # Don't hand the parent's pooled connections down to the forked workers
+    with app.app_context():
+        db.engine.dispose()
+    
+    stop_event = multiprocessing.Event()
+    
+    # The handler only records the signal, setting the Event from it can deadlock
+    stop_signals = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_signals.append(signum))
+    
+    processes = []
+    for job_type, count in limits.items():
+        for _ in range(count):
+            process = multiprocessing.Process(target=run_worker, args=(job_type, stop_event), daemon=True)
+            process.start()
+            processes.append(process)
+    logger.info(f"Started {len(processes)} workers: {limits}")
+    
+    try:
+        while not stop_signals:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    
+    # Workers finish the job they are running, then exit
+    stop_event.set()
+    
+    for process in processes:
+        process.join()
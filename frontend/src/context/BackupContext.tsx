@@ -1,4 +1,4 @@
-import React, { createContext, useState, useContext, useEffect } from 'react';
+import React, { createContext, useState, useContext, useEffect, useRef } from 'react';
 import * as MediaLibrary from 'expo-media-library';
 import * as FileSystem from 'expo-file-system';
 import * as Device from 'expo-device';
@@ -22,6 +22,39 @@ interface MediaAsset {
   ignored?: boolean;
 }
 
+// Library assets sent per delta-sync request
+const SYNC_PAGE_SIZE = 200;
+
+// A delta scan in progress, kept between pages of new assets
+interface DeltaScan {
+  scan: string;
+  syncedUntil: number;
+  cursor?: string;
+  done: boolean;
+  pending: MediaAsset[];
+}
+
+// How many uploads to run at once and how to group them, advertised by the server
+interface UploadPlan {
+  concurrency: number;
+  chunkSize: number;
+  batchSize: number;
+}
+
+// Used with servers that don't advertise a plan: one upload at a time, one file per request
+const DEFAULT_UPLOAD_PLAN: UploadPlan = {
+  concurrency: 1,
+  chunkSize: 8 * 1024 * 1024,
+  batchSize: 1,
+};
+
+// Result of one upload request
+interface UploadResult {
+  uploaded: number;
+  failed: number;
+  retryAfter?: number;
+}
+
 interface BackupStats {
   totalFiles: number;
   totalSize: number;
@@ -103,6 +136,7 @@ export const BackupProvider: React.FC<{ children: React.ReactNode }> = ({ childr
   const [backupStats, setBackupStats] = useState<BackupStats>(initialBackupStats);
   const [backupProgress, setBackupProgress] = useState<BackupProgress>(initialBackupProgress);
   const [cancelBackupFlag, setCancelBackupFlag] = useState<boolean>(false);
+  const deltaScan = useRef<DeltaScan | null>(null);
 
   // Helper function to format server URL
   const getServerUrl = () => {
@@ -158,6 +192,135 @@ export const BackupProvider: React.FC<{ children: React.ReactNode }> = ({ childr
     return initialBackupStats;
   };
 
+  // Get detailed info for a library asset, including the local path the server knows it by
+  const toMediaAsset = async (asset: MediaLibrary.Asset): Promise<MediaAsset> => {
+    const assetInfo = await MediaLibrary.getAssetInfoAsync(asset);
+    // Get the proper URI that works on iOS
+    let properUri = asset.uri;
+    if (Platform.OS === 'ios' && assetInfo.localUri) {
+      // Convert ph:// URL to a local file URL
+      properUri = assetInfo.localUri;
+    }
+
+    return {
+      id: asset.id,
+      uri: properUri,
+      path: assetInfo.localUri || properUri,
+      filename: asset.filename,
+      fileSize: 0,
+      creationTime: asset.creationTime,
+      modificationTime: asset.modificationTime,
+      mediaType: asset.mediaType === 'video' ? 'video' : 'photo',
+      duration: asset.duration,
+      width: asset.width,
+      height: asset.height,
+      selected: true
+    };
+  };
+
+  // Read the indexes of a page's assets to back up, sent as a list or a base64 bitmap
+  const decodeNeeded = (data: any, count: number): number[] => {
+    if (Array.isArray(data.needed)) {
+      return data.needed;
+    }
+    const bitmap = atob(data.needed_bitmap || '');
+    const needed: number[] = [];
+    for (let index = 0; index < count; index++) {
+      if (bitmap.charCodeAt(index >> 3) & (1 << (index & 7))) {
+        needed.push(index);
+      }
+    }
+    return needed;
+  };
+
+  // Start a delta scan, returns null when the server doesn't support it
+  const startDeltaScan = async (): Promise<DeltaScan | null> => {
+    const response = await fetch(`${getServerUrl()}/photos/sync/start`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ device_id: Device.modelName || 'unknown' })
+    });
+    if (!response.ok) {
+      return null;
+    }
+    const data = await response.json();
+    return {
+      scan: data.scan,
+      syncedUntil: data.synced_until,
+      done: false,
+      pending: []
+    };
+  };
+
+  // Find the next assets needing backup with a delta scan, newest changes first.
+  // Assets modified before the server's high-water mark are skipped without
+  // looking them up, so a library that is already backed up costs one page.
+  // Returns whether more remain, or null to fall back to checking every asset.
+  const loadDeltaAssets = async (limit: number, restart: boolean): Promise<boolean | null> => {
+    if (restart || !deltaScan.current) {
+      deltaScan.current = await startDeltaScan();
+      if (!deltaScan.current) {
+        return null;
+      }
+    }
+    const state = deltaScan.current;
+
+    while (!state.done && state.pending.length < limit) {
+      const fetchedAssets = await MediaLibrary.getAssetsAsync({
+        mediaType: [MediaLibrary.MediaType.photo, MediaLibrary.MediaType.video],
+        sortBy: [['modificationTime', false]],
+        first: SYNC_PAGE_SIZE,
+        after: state.cursor
+      });
+
+      const changed = fetchedAssets.assets.filter(asset => asset.modificationTime >= state.syncedUntil);
+      const reachedMark = changed.length < fetchedAssets.assets.length || !fetchedAssets.hasNextPage;
+      const assetsData = await Promise.all(changed.map(toMediaAsset));
+
+      const response = await fetch(`${getServerUrl()}/photos/sync`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          device_id: Device.modelName || 'unknown',
+          scan: state.scan,
+          paths: assetsData.map(asset => asset.path),
+          modified: assetsData.map(asset => Math.floor(asset.modificationTime)),
+          done: reachedMark
+        })
+      });
+
+      if (response.status === 409) {
+        // The server started over, e.g. after a scrub found damaged backups
+        const restarted = await startDeltaScan();
+        if (!restarted) {
+          return null;
+        }
+        deltaScan.current = { ...restarted, pending: state.pending };
+        return loadDeltaAssets(limit, false);
+      }
+      if (!response.ok) {
+        throw new Error(`Sync failed with status ${response.status}`);
+      }
+
+      const data = await response.json();
+      for (const index of decodeNeeded(data, assetsData.length)) {
+        state.pending.push(assetsData[index]);
+      }
+      state.cursor = fetchedAssets.endCursor;
+      state.done = reachedMark;
+    }
+
+    const assetsToShow = state.pending.splice(0, limit);
+    if (restart) {
+      setNewAssets(assetsToShow);
+      setSelectedAssets(assetsToShow);
+    } else {
+      setNewAssets(prev => [...prev, ...assetsToShow]);
+      setSelectedAssets(prev => [...prev, ...assetsToShow]);
+    }
+    return !state.done || state.pending.length > 0;
+  };
+
   // Function to load new assets from the device
   const loadNewAssets = async (limit = 20, after?: string) => {
     try {
@@ -175,6 +338,18 @@ export const BackupProvider: React.FC<{ children: React.ReactNode }> = ({ childr
         return false;
       }
 
+      if (isServerReachable && settings.serverIP) {
+        try {
+          const hasMore = await loadDeltaAssets(limit, after === undefined);
+          if (hasMore !== null) {
+            return hasMore;
+          }
+        } catch (error) {
+          console.error('Delta sync failed, checking every asset:', error);
+          deltaScan.current = null;
+        }
+      }
+
       // Get all assets with pagination
       const fetchedAssets = await MediaLibrary.getAssetsAsync({
         mediaType: [MediaLibrary.MediaType.photo, MediaLibrary.MediaType.video],
@@ -184,39 +359,7 @@ export const BackupProvider: React.FC<{ children: React.ReactNode }> = ({ childr
       });
 
       // Get detailed info for each asset
-      const assetsData: MediaAsset[] = await Promise.all(
-        fetchedAssets.assets.map(async (asset) => {
-          const assetInfo = await MediaLibrary.getAssetInfoAsync(asset);
-          // Get the proper URI that works on iOS
-          let properUri = asset.uri;
-          if (Platform.OS === 'ios') {
-            try {
-              // Convert ph:// URL to a local file URL
-              const localUri = await MediaLibrary.getAssetInfoAsync(asset);
-              if (localUri.localUri) {
-                properUri = localUri.localUri;
-              }
-            } catch (error) {
-              console.error('Error getting local URI:', error);
-            }
-          }
-          
-          return {
-            id: asset.id,
-            uri: properUri,
-            path: assetInfo.localUri || properUri,
-            filename: asset.filename,
-            fileSize: 0,
-            creationTime: asset.creationTime,
-            modificationTime: asset.modificationTime,
-            mediaType: asset.mediaType === 'video' ? 'video' : 'photo',
-            duration: asset.duration,
-            width: asset.width,
-            height: asset.height,
-            selected: true
-          };
-        })
-      );
+      const assetsData: MediaAsset[] = await Promise.all(fetchedAssets.assets.map(toMediaAsset));
 
       // If this is the first page, replace the assets
       // Otherwise, append the new assets
@@ -327,6 +470,98 @@ export const BackupProvider: React.FC<{ children: React.ReactNode }> = ({ childr
     setSelectedAssets([]);
   };
 
+  const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
+
+  // Ask the server how many uploads to run at once and how large to make them
+  const fetchUploadPlan = async (): Promise<UploadPlan> => {
+    try {
+      const response = await fetch(`${getServerUrl()}/photos/upload/plan`, {
+        headers: { 'X-Device-Id': Device.modelName || 'unknown' },
+      });
+      if (!response.ok) {
+        return DEFAULT_UPLOAD_PLAN;
+      }
+      const { plan } = await response.json();
+      return {
+        concurrency: Math.max(1, plan.concurrency),
+        chunkSize: plan.chunk_size,
+        batchSize: Math.max(1, plan.batch_size),
+      };
+    } catch (error) {
+      return DEFAULT_UPLOAD_PLAN;
+    }
+  };
+
+  // Group photos into batch requests of up to batchSize files and about chunkSize bytes,
+  // videos and other large files go one per request. Returns the groups and the missing assets.
+  const groupUploads = async (assets: MediaAsset[], plan: UploadPlan) => {
+    const groups: MediaAsset[][] = [];
+    let batch: MediaAsset[] = [];
+    let batchBytes = 0;
+    let missing = 0;
+
+    for (const asset of assets) {
+      const fileInfo = await FileSystem.getInfoAsync(asset.path);
+      if (!fileInfo.exists) {
+        missing++;
+        continue;
+      }
+      if (asset.mediaType === 'video' || fileInfo.size >= plan.chunkSize || plan.batchSize === 1) {
+        groups.push([asset]);
+        continue;
+      }
+      if (batch.length >= plan.batchSize || batchBytes + fileInfo.size > plan.chunkSize) {
+        groups.push(batch);
+        batch = [];
+        batchBytes = 0;
+      }
+      batch.push(asset);
+      batchBytes += fileInfo.size;
+    }
+    if (batch.length > 0) {
+      groups.push(batch);
+    }
+    return { groups, missing };
+  };
+
+  // Upload a single file, or a group of photos in one batch request
+  const uploadGroup = async (group: MediaAsset[]): Promise<UploadResult> => {
+    const formData = new FormData();
+    for (const asset of group) {
+      formData.append('file', {
+        uri: asset.path,
+        name: asset.filename,
+        type: asset.mediaType === 'photo' ? 'image/jpeg' : 'video/mp4',
+      } as any);
+      formData.append('original_path', asset.path);
+      formData.append('file_type', asset.mediaType);
+    }
+    formData.append('device_id', Device.modelName || 'unknown');
+
+    const endpoint = group.length > 1 ? '/photos/upload/batch' : '/photos/upload';
+    const response = await fetch(`${getServerUrl()}${endpoint}`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'multipart/form-data',
+        // Lets the server queue this device's uploads fairly without reading the body
+        'X-Device-Id': Device.modelName || 'unknown',
+      },
+      body: formData,
+    });
+
+    if (response.status === 429) {
+      return { uploaded: 0, failed: 0, retryAfter: Number(response.headers.get('Retry-After')) || 1 };
+    }
+    if (!response.ok) {
+      return { uploaded: 0, failed: group.length };
+    }
+    if (group.length > 1) {
+      const data = await response.json();
+      return { uploaded: group.length - data.failed_count, failed: data.failed_count };
+    }
+    return { uploaded: 1, failed: 0 };
+  };
+
   // Function to start backup process
   const startBackup = async () => {
     if (!isServerReachable || !settings.serverIP) {
@@ -351,63 +586,66 @@ export const BackupProvider: React.FC<{ children: React.ReactNode }> = ({ childr
       percentage: 0,
     });
 
+    // Run up to the plan's number of uploads at once. A 429 halves that number and
+    // pauses every worker for Retry-After, each run of successes adds one back.
+    let plan = await fetchUploadPlan();
+    const { groups, missing } = await groupUploads(selectedAssets, plan);
+    const queue = [...groups];
+    const workerCount = plan.concurrency;
+    let limit = plan.concurrency;
+    let successStreak = 0;
+    let inFlight = 0;
+    let pausedUntil = 0;
+    let finishedCount = missing;
     let successCount = 0;
-    let failedCount = 0;
-
-    for (let i = 0; i < selectedAssets.length; i++) {
-      // Check if backup was canceled
-      if (cancelBackupFlag) {
-        break;
-      }
+    let failedCount = missing;
 
-      const asset = selectedAssets[i];
-      
-      // Update progress
-      setBackupProgress(prev => ({
-        ...prev,
-        currentFile: i + 1,
-        currentFileName: asset.filename,
-        percentage: Math.round(((i + 1) / selectedAssets.length) * 100),
-      }));
-
-      try {
-        // Get the file info
-        const fileInfo = await FileSystem.getInfoAsync(asset.path);
-        if (!fileInfo.exists) {
-          failedCount++;
+    const worker = async (slot: number) => {
+      while (!cancelBackupFlag && (queue.length > 0 || inFlight > 0)) {
+        if (slot >= limit || queue.length === 0 || Date.now() < pausedUntil) {
+          await sleep(250);
           continue;
         }
 
-        // Create form data for file upload
-        const formData = new FormData();
-        formData.append('file', {
-          uri: asset.path,
-          name: asset.filename,
-          type: asset.mediaType === 'photo' ? 'image/jpeg' : 'video/mp4',
-        } as any);
-        formData.append('original_path', asset.path);
-        formData.append('file_type', asset.mediaType);
-        formData.append('device_id', Device.modelName || 'unknown');
-
-        // Upload the file
-        const response = await fetch(`${getServerUrl()}/photos/upload`, {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'multipart/form-data',
-          },
-          body: formData,
-        });
-
-        if (response.ok) {
-          successCount++;
-        } else {
-          failedCount++;
+        const group = queue.shift()!;
+        inFlight++;
+        setBackupProgress(prev => ({ ...prev, currentFileName: group[0].filename }));
+        try {
+          const result = await uploadGroup(group);
+          if (result.retryAfter !== undefined) {
+            // The server is full, try this group again once it has room
+            queue.unshift(group);
+            pausedUntil = Date.now() + result.retryAfter * 1000;
+            limit = Math.max(1, Math.floor(limit / 2));
+            successStreak = 0;
+            plan = await fetchUploadPlan();
+            continue;
+          }
+
+          successCount += result.uploaded;
+          failedCount += result.failed;
+          successStreak++;
+          if (successStreak >= limit && limit < Math.min(workerCount, plan.concurrency)) {
+            limit++;
+            successStreak = 0;
+          }
+        } catch (error) {
+          console.error(`Failed to upload ${group.map(asset => asset.filename).join(', ')}:`, error);
+          failedCount += group.length;
+        } finally {
+          inFlight--;
         }
-      } catch (error) {
-        console.error(`Failed to upload asset ${asset.filename}:`, error);
-        failedCount++;
+
+        finishedCount += group.length;
+        setBackupProgress(prev => ({
+          ...prev,
+          currentFile: finishedCount,
+          percentage: Math.round((finishedCount / selectedAssets.length) * 100),
+        }));
       }
-    }
+    };
+
+    await Promise.all(Array.from({ length: workerCount }, (_, slot) => worker(slot)));
 
     // Complete backup process
     setBackupProgress(initialBackupProgress);